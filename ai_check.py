@@ -1,8 +1,18 @@
 import os
+import asyncio
+import logging
+import random
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
 from dotenv import load_dotenv
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
+import metrics
+import moderation_cache
+import prefilter
+
 load_dotenv()
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
@@ -24,54 +34,155 @@ model = genai.GenerativeModel(
     safety_settings=safety_settings
 )
 
-async def check_image(image_path):
-    max_retries = 2
-    retry_count = 0
+# Сколько запросов к Gemini выполняется одновременно, таймаут одной попытки и повторы
+MODERATION_CONCURRENCY = int(os.getenv("MODERATION_CONCURRENCY", "4"))
+MODERATION_TIMEOUT = float(os.getenv("MODERATION_TIMEOUT", "30"))
+MODERATION_MAX_RETRIES = int(os.getenv("MODERATION_MAX_RETRIES", "3"))
+MODERATION_BACKOFF_BASE = 1.0
+MODERATION_BACKOFF_MAX = 10.0
+
+# SDK синхронный - вызываем его в отдельных потоках, чтобы не замораживать event loop бота
+# Фото до этого размера уходят в запрос inline; большие - через File API из временного файла в tmpfs
+MODERATION_INLINE_MAX_BYTES = int(os.getenv("MODERATION_INLINE_MAX_BYTES", str(4 * 1024 * 1024)))
+MODERATION_SPILL_DIR = os.getenv("MODERATION_SPILL_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+GEMINI_SECONDS = metrics.histogram(
+    "moderation_gemini_seconds", "Gemini moderation call latency per attempt", ("outcome",)
+)
+GEMINI_RETRIES = metrics.counter("moderation_gemini_retries_total", "Gemini moderation attempts that were retried")
+MODERATION_CACHE_HITS = metrics.counter(
+    "moderation_cache_hits_total", "Verdicts answered without Gemini", ("match",)
+)
+
+_executor = ThreadPoolExecutor(max_workers=MODERATION_CONCURRENCY, thread_name_prefix="gemini")
+_semaphore = None
+
+# PROMPT IN ENGLISH
+MODERATION_PROMPT = (
+    "You are a strict content moderator. "
+    "Analyze the image and any text inside it."
+    "\n\n"
+    "STRICTLY FORBIDDEN CONTENT (Return 'FAIL'):\n"
+    "1. POLITICS & LEADERS: NO images/mentions of Putin, Zelensky, Biden, Trump, etc. NO political symbols.\n"
+    "2. WAR & MILITARY: NO Russia-Ukraine conflict, Z/V symbols, weapons, guns, tanks, soldiers. NO dead bodies.\n"
+    "3. HATE SPEECH & SLURS: NO racism, no n-word, no ethnic slurs.\n"
+    "4. ADULT CONTENT: NO nudity, pornography, sexual organs.\n"
+    "\n"
+    "ALLOWED CONTENT:\n"
+    "Selfies, ads, memes, landscapes, art.\n"
+    "\n"
+    "RESPONSE FORMAT:\n"
+    "If ALLOWED, return exactly: 'OK'.\n"
+    "If FORBIDDEN, return exactly: 'FAIL: <short reason in English>'. Example: 'FAIL: Politics forbidden'."
+)
+
+async def check_image(image_bytes, file_unique_id=None):
+    """Модерация фото по байтам JPEG: (allowed, reason). Повторы и почти-дубликаты отвечаются из кэша вердиктов"""
+    if file_unique_id:
+        cached = moderation_cache.get(file_unique_id)
+        if cached is not None:
+            logging.debug(f"Moderation cache hit for {file_unique_id}")
+            MODERATION_CACHE_HITS.inc("exact")
+            return cached
+    
+    phash = None
+    try:
+        phash = await asyncio.to_thread(moderation_cache.dhash, image_bytes)
+    except Exception as e:
+        logging.debug(f"Cannot hash image: {e}")
+    
+    if phash is not None:
+        similar = moderation_cache.find_similar(phash)
+        if similar is not None:
+            logging.debug(f"Moderation cache hit by perceptual hash {phash:016x}")
+            MODERATION_CACHE_HITS.inc("similar")
+            await _remember_verdict(file_unique_id, phash, *similar)
+            return similar
+    
+    allowed, reason, final = await _ask_gemini(image_bytes)
+    # Ошибки сервиса и непонятные ответы не кэшируем - только окончательные OK/FAIL
+    if final and phash is not None:
+        await _remember_verdict(file_unique_id, phash, allowed, reason)
+    if final and not allowed:
+        # Точная копия этой картинки больше не дойдет до Gemini - ее отклонит пред-модерация
+        await prefilter.remember_bad_image(image_bytes, reason)
+    return allowed, reason
+
+async def _remember_verdict(file_unique_id, phash, allowed, reason):
+    if not file_unique_id:
+        return
+    try:
+        await moderation_cache.remember(file_unique_id, phash, allowed, reason)
+    except Exception as e:
+        logging.warning(f"Saving moderation verdict failed: {e}")
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MODERATION_CONCURRENCY)
+    return _semaphore
+
+def _backoff_delay(attempt):
+    """Экспоненциальная задержка с jitter: случайное значение в [0, base * 2^(attempt-1)], не больше max"""
+    return random.uniform(0, min(MODERATION_BACKOFF_MAX, MODERATION_BACKOFF_BASE * 2 ** (attempt - 1)))
+
+def _generate_sync(image_bytes):
+    """Блокирующие вызовы SDK (выполняются в пуле потоков, не в event loop)"""
+    if len(image_bytes) <= MODERATION_INLINE_MAX_BYTES:
+        image_part = {"mime_type": "image/jpeg", "data": image_bytes}
+        return _generate(image_part)
+    # Слишком большое для inline: уникальный временный файл в tmpfs, удаляется сразу после загрузки
+    with tempfile.NamedTemporaryFile(dir=MODERATION_SPILL_DIR, suffix=".jpg") as spill:
+        spill.write(image_bytes)
+        spill.flush()
+        image_part = genai.upload_file(path=spill.name, mime_type="image/jpeg", display_name="User Photo")
+    return _generate(image_part)
+
+def _generate(image_part):
+    response = model.generate_content(
+        [image_part, MODERATION_PROMPT],
+        request_options={"timeout": MODERATION_TIMEOUT}
+    )
+    return response.text.strip()
+
+async def _ask_gemini(image_bytes):
+    """Запрос к Gemini: (allowed, reason, final), final=False для ошибок, которые нельзя кэшировать"""
+    loop = asyncio.get_running_loop()
     
-    while retry_count < max_retries:
+    for attempt in range(1, MODERATION_MAX_RETRIES + 1):
+        started = None
         try:
-            print(f"DEBUG: Uploading {image_path} to Gemini... (Attempt {retry_count + 1}/{max_retries})")
+            logging.debug(f"Sending {len(image_bytes)} bytes to Gemini... (Attempt {attempt}/{MODERATION_MAX_RETRIES})")
             
-            sample_file = genai.upload_file(path=image_path, display_name="User Photo")
-            
-            # PROMPT IN ENGLISH
-            prompt = (
-                "You are a strict content moderator. "
-                "Analyze the image and any text inside it."
-                "\n\n"
-                "STRICTLY FORBIDDEN CONTENT (Return 'FAIL'):\n"
-                "1. POLITICS & LEADERS: NO images/mentions of Putin, Zelensky, Biden, Trump, etc. NO political symbols.\n"
-                "2. WAR & MILITARY: NO Russia-Ukraine conflict, Z/V symbols, weapons, guns, tanks, soldiers. NO dead bodies.\n"
-                "3. HATE SPEECH & SLURS: NO racism, no n-word, no ethnic slurs.\n"
-                "4. ADULT CONTENT: NO nudity, pornography, sexual organs.\n"
-                "\n"
-                "ALLOWED CONTENT:\n"
-                "Selfies, ads, memes, landscapes, art.\n"
-                "\n"
-                "RESPONSE FORMAT:\n"
-                "If ALLOWED, return exactly: 'OK'.\n"
-                "If FORBIDDEN, return exactly: 'FAIL: <short reason in English>'. Example: 'FAIL: Politics forbidden'."
-            )
-    
-            response = model.generate_content([sample_file, prompt])
-            text = response.text.strip()
-            print(f"DEBUG: Gemini Response: {text}")
+            # Семафор ограничивает число одновременных запросов к Gemini; на время паузы перед повтором отпускаем его
+            async with _get_semaphore():
+                started = time.perf_counter()
+                text = await asyncio.wait_for(
+                    loop.run_in_executor(_executor, _generate_sync, image_bytes),
+                    MODERATION_TIMEOUT
+                )
+            elapsed = time.perf_counter() - started
+            logging.debug(f"Gemini Response: {text}")
     
             if text.startswith("OK"):
-                return True, "OK"
+                GEMINI_SECONDS.observe(elapsed, "ok")
+                return True, "OK", True
             elif text.startswith("FAIL"):
+                GEMINI_SECONDS.observe(elapsed, "fail")
                 reason = text.replace("FAIL:", "").strip()
-                return False, reason
+                return False, reason, True
             else:
-                return False, "AI returned unknown response. Try another photo."
+                GEMINI_SECONDS.observe(elapsed, "unknown")
+                return False, "AI returned unknown response. Try another photo.", False
     
         except Exception as e:
-            retry_count += 1
-            print(f"ERROR in ai_check (attempt {retry_count}): {e}")
+            logging.warning(f"Gemini moderation failed (attempt {attempt}): {e!r}")
+            if started is not None:
+                outcome = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+                GEMINI_SECONDS.observe(time.perf_counter() - started, outcome)
             
-            if retry_count >= max_retries:
-                return False, f"Service temporarily unavailable. Please try again later."
+            if attempt >= MODERATION_MAX_RETRIES:
+                return False, f"Service temporarily unavailable. Please try again later.", False
             
-            # Небольшая задержка перед повтором
-            import asyncio
-            await asyncio.sleep(2)
\ No newline at end of file
+            GEMINI_RETRIES.inc()
+            await asyncio.sleep(_backoff_delay(attempt))
@@ -0,0 +1,302 @@
+"""
+Архив журнала game_events по месяцам.
+
+События старше ARCHIVE_HORIZON_DAYS переносятся в таблицы-партиции
+game_events_ГГГГ_ММ (по месяцу created_at), в том числе покупки текущей эпохи:
+Hall of Fame читает свою таблицу hall_of_fame, а история для админа
+(get_history) - журнал вместе с архивом. В game_events остаются текущее и
+предыдущее состояние (для отката). Партиции старше ARCHIVE_EXPORT_AFTER_MONTHS выгружаются в
+ARCHIVE_DIR/<партиция>.jsonl.gz, и таблица удаляется. Каталог партиций -
+таблица archive_partitions.
+
+get_event_log читает журнал целиком: горячую таблицу, партиции и выгрузки.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from collections import Counter, defaultdict
+
+import database
+from database import get_db, transaction
+
+ARCHIVE_HORIZON_DAYS = int(os.getenv("ARCHIVE_HORIZON_DAYS", "90"))
+ARCHIVE_EXPORT_AFTER_MONTHS = int(os.getenv("ARCHIVE_EXPORT_AFTER_MONTHS", "12"))  # 0 - не выгружать в файлы
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "3600"))
+# Событий за одну транзакцию: запись в базу не блокируется надолго
+ARCHIVE_BATCH = 5000
+EVENT_LOG_MAX_LIMIT = 100
+# Откаты нужны истории покупок, чтобы пропустить отмененные
+HISTORY_KINDS = ("purchase", "rollback")
+
+EVENT_COLUMNS = "id, epoch, kind, user_id, price, photo_id, text, user_link, prev_id, purchase_id, created_at"
+PARTITION_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY,
+        epoch INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        user_id INTEGER,
+        price INTEGER,
+        photo_id TEXT,
+        text TEXT,
+        user_link TEXT,
+        prev_id INTEGER,
+        purchase_id INTEGER,
+        created_at TIMESTAMP
+    )
+"""
+# Что можно убрать из горячей таблицы: все старше горизонта, кроме двух состояний, нужных откату.
+# Откат всегда новее своей покупки, поэтому покупка не может остаться в журнале без него
+SQL_ARCHIVE_CANDIDATES = """
+    SELECT e.id, strftime('%Y_%m', e.created_at)
+    FROM game_events AS e, game_snapshot AS s
+    WHERE s.id = 1
+      AND e.created_at < datetime('now', ?)
+      AND e.id != s.head_id AND e.id IS NOT s.prev_id
+    ORDER BY e.id
+    LIMIT ?
+"""
+SQL_UPDATE_PARTITION = """
+    UPDATE archive_partitions
+    SET rows = rows + ?, min_id = MIN(COALESCE(min_id, ?), ?), max_id = MAX(COALESCE(max_id, ?), ?)
+    WHERE name = ?
+"""
+SQL_CLAIM_ARCHIVE_RUN = """
+    UPDATE game_meta SET value = ? WHERE key = 'archived_at' AND value <= ? RETURNING value
+"""
+
+
+def partition_name(month):
+    return f"game_events_{month}"
+
+
+async def init_archive():
+    """Создает каталог партиций и подключает архив к откату (database.rollback_last_entry)"""
+    async with transaction() as db:
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS archive_partitions (
+                name TEXT PRIMARY KEY,
+                month TEXT NOT NULL,
+                rows INTEGER NOT NULL DEFAULT 0,
+                min_id INTEGER,
+                max_id INTEGER,
+                export_path TEXT
+            )
+        """)
+        await db.execute("INSERT OR IGNORE INTO game_meta (key, value) VALUES ('archived_at', 0)")
+    database.archived_event_reader = read_archived_state_event
+
+
+async def read_archived_state_event(db, event_id):
+    """Событие-состояние из партиции (как SQL_STATE_EVENT); из выгруженных в файл не читаем"""
+    async with db.execute(
+        "SELECT name FROM archive_partitions WHERE export_path IS NULL AND ? BETWEEN min_id AND max_id",
+        (event_id,),
+    ) as cursor:
+        partitions = await cursor.fetchall()
+    for (name,) in partitions:
+        async with db.execute(f"""
+            SELECT price, user_id, photo_id, text, user_link, prev_id,
+                   CASE kind WHEN 'purchase' THEN id ELSE purchase_id END
+            FROM {name} WHERE id = ?
+        """, (event_id,)) as cursor:
+            row = await cursor.fetchone()
+        if row is not None:
+            return row
+    return None
+
+
+async def _partition(db, month):
+    """(имя, путь выгрузки или None); таблица создается при первом обращении"""
+    name = partition_name(month)
+    await db.execute("INSERT OR IGNORE INTO archive_partitions (name, month) VALUES (?, ?)", (name, month))
+    async with db.execute("SELECT export_path FROM archive_partitions WHERE name = ?", (name,)) as cursor:
+        (export_path,) = await cursor.fetchone()
+    if export_path is None:
+        await db.execute(PARTITION_SCHEMA.format(name=name))
+    return name, export_path
+
+
+def _write_export(path, rows, append=False):
+    """Строки событий в gzip JSON lines. Дописывание - новый gzip-член в конце файла"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    columns = EVENT_COLUMNS.split(", ")
+    target = path if append else f"{path}.{os.getpid()}.tmp"
+    with gzip.open(target, "at" if append else "wt", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+    if not append:
+        os.replace(target, path)
+
+
+def _read_export(path, before_id, limit, kinds=None):
+    """Последние limit событий файла с id < before_id (новые первыми).
+    Повторы от дописывания после сбоя убираются до отсечки по limit"""
+    columns = EVENT_COLUMNS.split(", ")
+    rows = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for event in map(json.loads, f):
+            if event["id"] < before_id and (kinds is None or event["kind"] in kinds):
+                rows[event["id"]] = tuple(event[column] for column in columns)
+    return [rows[event_id] for event_id in sorted(rows, reverse=True)[:limit]]
+
+
+async def archive_old_events(horizon_days=ARCHIVE_HORIZON_DAYS):
+    """Переносит старые события в партиции. Возвращает {месяц: перенесено}"""
+    horizon = f"-{horizon_days} days"
+    moved = Counter()
+    while True:
+        async with transaction() as db:
+            candidates = await db.execute_fetchall(
+                SQL_ARCHIVE_CANDIDATES, (horizon, ARCHIVE_BATCH)
+            )
+            by_month = defaultdict(list)
+            for event_id, month in candidates:
+                by_month[month].append((event_id,))
+            for month, ids in by_month.items():
+                name, export_path = await _partition(db, month)
+                if export_path is None:
+                    await db.executemany(
+                        f"INSERT OR IGNORE INTO {name} SELECT {EVENT_COLUMNS} FROM game_events WHERE id = ?", ids
+                    )
+                else:
+                    # Месяц уже выгружен: дописываем в файл (при сбое строка может повториться - читатели убирают дубли)
+                    rows = await db.execute_fetchall(
+                        f"SELECT {EVENT_COLUMNS} FROM game_events WHERE id IN ({','.join('?' * len(ids))})",
+                        [event_id for (event_id,) in ids],
+                    )
+                    await asyncio.to_thread(_write_export, export_path, rows, True)
+                await db.executemany("DELETE FROM game_events WHERE id = ?", ids)
+                low, high = ids[0][0], ids[-1][0]
+                await db.execute(SQL_UPDATE_PARTITION, (len(ids), low, low, high, high, name))
+                moved[month] += len(ids)
+        if len(candidates) < ARCHIVE_BATCH:
+            return dict(moved)
+
+
+async def export_old_partitions(after_months=ARCHIVE_EXPORT_AFTER_MONTHS):
+    """Выгружает партиции старше after_months месяцев в gzip-файлы и удаляет их таблицы"""
+    if after_months <= 0:
+        return []
+    db = await get_db()
+    partitions = await db.execute_fetchall(
+        "SELECT name FROM archive_partitions WHERE export_path IS NULL AND month < strftime('%Y_%m', 'now', ?)",
+        (f"-{after_months} months",),
+    )
+    exported = []
+    for (name,) in partitions:
+        rows = await db.execute_fetchall(f"SELECT {EVENT_COLUMNS} FROM {name} ORDER BY id")
+        path = os.path.join(ARCHIVE_DIR, f"{name}.jsonl.gz")
+        await asyncio.to_thread(_write_export, path, rows)
+        async with transaction() as tx:
+            async with tx.execute(
+                "UPDATE archive_partitions SET export_path = ? WHERE name = ? AND export_path IS NULL", (path, name)
+            ) as cursor:
+                claimed = cursor.rowcount
+            if claimed:
+                await tx.execute(f"DROP TABLE IF EXISTS {name}")
+        if claimed:
+            exported.append(path)
+    return exported
+
+
+async def run_archiver():
+    """Проход архивации, если за ARCHIVE_INTERVAL его не сделал другой процесс бота"""
+    now = int(time.time())
+    async with transaction() as db:
+        async with db.execute(SQL_CLAIM_ARCHIVE_RUN, (now, now - ARCHIVE_INTERVAL)) as cursor:
+            if await cursor.fetchone() is None:
+                return None
+    moved = await archive_old_events()
+    exported = await export_old_partitions()
+    if moved or exported:
+        logging.info(f"Archived events: {moved}, exported partitions: {exported}")
+    return moved, exported
+
+
+def _event_entry(row, source):
+    return {
+        "id": row[0],
+        "epoch": row[1],
+        "kind": row[2],
+        "user_id": row[3],
+        "price": row[4],
+        "text": row[6],
+        "user_link": row[7],
+        "purchase_id": row[9],
+        "created_at": row[10],
+        "source": source,
+    }
+
+
+async def get_event_log(limit=20, before_id=None, kinds=None):
+    """Последние события журнала (новые первыми) из горячей таблицы, партиций и выгрузок.
+    Следующая страница - before_id = id последнего события; kinds - только события этих видов"""
+    limit = max(1, min(int(limit), EVENT_LOG_MAX_LIMIT))
+    before_id = before_id or 2**63 - 1
+    kind_filter = f"AND kind IN ({','.join('?' * len(kinds))})" if kinds else ""
+    kind_params = tuple(kinds or ())
+    db = await get_db()
+    rows = {
+        row[0]: (row, "hot")
+        for row in await db.execute_fetchall(
+            f"SELECT {EVENT_COLUMNS} FROM game_events WHERE id < ? {kind_filter} ORDER BY id DESC LIMIT ?",
+            (before_id, *kind_params, limit),
+        )
+    }
+    partitions = await db.execute_fetchall(
+        "SELECT name, max_id, export_path FROM archive_partitions WHERE min_id < ? ORDER BY max_id DESC",
+        (before_id,),
+    )
+    for name, max_id, export_path in partitions:
+        # Партиции идут по убыванию max_id: дальше только события старше уже набранных
+        if len(rows) >= limit and max_id < sorted(rows, reverse=True)[limit - 1]:
+            break
+        if export_path is None:
+            found = await db.execute_fetchall(
+                f"SELECT {EVENT_COLUMNS} FROM {name} WHERE id < ? {kind_filter} ORDER BY id DESC LIMIT ?",
+                (before_id, *kind_params, limit),
+            )
+            source = "archive"
+        else:
+            found = await asyncio.to_thread(_read_export, export_path, before_id, limit, kinds)
+            source = "export"
+        for row in found:
+            rows.setdefault(row[0], (row, source))
+    newest = sorted(rows, reverse=True)[:limit]
+    return [_event_entry(*rows[event_id]) for event_id in newest]
+
+
+async def get_history(limit=10):
+    """Последние N покупок текущей эпохи для админа, включая ушедшие в архив (без отмененных откатом)"""
+    db = await get_db()
+    async with db.execute("SELECT epoch FROM game_snapshot WHERE id = 1") as cursor:
+        (epoch,) = await cursor.fetchone()
+    history = []
+    rolled_back = set()
+    before_id = None
+    while True:
+        events = await get_event_log(EVENT_LOG_MAX_LIMIT, before_id, kinds=HISTORY_KINDS)
+        for event in events:
+            # Новые первыми: откат всегда встречается раньше своей покупки, а эпоха кончается сбросом
+            if event["epoch"] != epoch:
+                return history
+            if event["kind"] == "rollback":
+                rolled_back.add(event["purchase_id"])
+            elif event["user_id"] > 0 and event["id"] not in rolled_back:
+                history.append({
+                    "id": event["id"],
+                    "user_id": event["user_id"],
+                    "user_link": event["user_link"],
+                    "price": event["price"],
+                    "text": event["text"],
+                    "created_at": event["created_at"],
+                })
+                if len(history) >= limit:
+                    return history
+        if len(events) < EVENT_LOG_MAX_LIMIT:
+            return history
+        before_id = events[-1]["id"]
@@ -0,0 +1,301 @@
+"""
+Покупка трона: котировка цены, атомарная заявка и коронация.
+
+Следующая цена считается от price_basis (game_meta) - цены текущего царя или,
+если больше, суммы оплаты, которая еще ждет фото. Котировка привязана к
+bid_version, и номер версии зашит в payload счета
+("king_buy_<множитель>_<версия>"). На pre-checkout заявка проходит одну
+транзакцию BEGIN IMMEDIATE: проверка суммы и compare-and-set версии. Из двух
+покупателей, получивших счет по одной цене, оплатить сможет только первый,
+второй получит отказ до списания Stars.
+
+Заявка (status claimed) держит трон только до оплаты, не дольше
+BID_PAYMENT_TTL: это секунды, и новые pre-checkout в это время получают
+отказ. Оплата (paid) поднимает price_basis, и следующие счета выставляются
+уже выше нее. Оплаченная заявка ждет принятого фото до BID_PHOTO_TTL, но
+трон не держит. Гонку оплаченных заявок решает crown: в одной транзакции он
+проверяет, что заявка еще жива и ее сумма не ниже следующей цены после
+текущего царя, записывает царя и закрывает заявку. Опоздавшей заявке
+(outbid) и просроченной (released) бот возвращает Stars. price_basis при
+этом снова считается от царя и оставшихся оплат.
+"""
+import logging
+import math
+import os
+import sqlite3
+import time
+from typing import NamedTuple
+
+import metrics
+from database import (
+    get_current_state, transaction, state_cache,
+    _append_purchase, _bump_state_version, _read_current_state, _state_changed,
+)
+
+PRICE_STEP = 1.1
+MULTIPLIERS = (1, 10, 100)
+PAYLOAD_PREFIX = "king_buy_"
+# Сколько заявка держит трон до оплаты и сколько оплаченная ждет принятого фото, сек
+BID_PAYMENT_TTL = int(os.getenv("BID_PAYMENT_TTL", "60"))
+BID_PHOTO_TTL = int(os.getenv("BID_PHOTO_TTL", "900"))
+# Как часто бот снимает просроченные оплаченные заявки (и возвращает Stars), сек
+BID_RELEASE_INTERVAL = 30
+
+SQL_CLAIM_BID_VERSION = "UPDATE game_meta SET value = value + 1 WHERE key = 'bid_version' AND value = ? RETURNING value"
+SQL_PRICE_BASIS = "SELECT value FROM game_meta WHERE key = 'price_basis'"
+SQL_INSERT_BID = """
+    INSERT INTO bids (version, user_id, multiplier, amount, created_at, status, expires_at)
+    VALUES (?, ?, ?, ?, ?, 'claimed', ?)
+"""
+# Жизнь заявки: claimed (до оплаты) -> paid (до принятого фото) -> settled;
+# не дошедшая до конца - released (истекла, отменена) или outbid (перекуплена до фото)
+SQL_RELEASE_EXPIRED_CLAIMS = "UPDATE bids SET status = 'released' WHERE status = 'claimed' AND expires_at < ?"
+SQL_RELEASE_EXPIRED = """
+    UPDATE bids SET status = 'released'
+    WHERE status IN ('claimed', 'paid') AND expires_at < ?
+    RETURNING version, user_id, amount, charge_id
+"""
+SQL_PENDING_CLAIM = "SELECT 1 FROM bids WHERE status = 'claimed' LIMIT 1"
+SQL_OTHER_PENDING_CLAIM = "SELECT 1 FROM bids WHERE status = 'claimed' AND version != ? LIMIT 1"
+SQL_GET_BID = "SELECT status, amount FROM bids WHERE version = ? AND user_id = ?"
+SQL_PAY_BID = "UPDATE bids SET status = 'paid', expires_at = ?, charge_id = ? WHERE version = ?"
+SQL_REFUSE_PAYMENT = "UPDATE bids SET charge_id = ? WHERE version = ?"
+SQL_LIVE_BID = """
+    SELECT version, amount, charge_id, expires_at FROM bids
+    WHERE user_id = ? AND status = 'paid' ORDER BY version DESC LIMIT 1
+"""
+SQL_SET_BID_STATUS = "UPDATE bids SET status = ? WHERE version = ?"
+SQL_RELEASE_CLAIMS = "UPDATE bids SET status = 'released' WHERE user_id = ? AND status = 'claimed'"
+SQL_KING_PRICE = "SELECT current_price FROM game_snapshot WHERE id = 1"
+SQL_RAISE_PRICE_BASIS = "UPDATE game_meta SET value = MAX(value, ?) WHERE key = 'price_basis'"
+# После снятия оплаченной заявки цена снова считается от царя и оставшихся оплат
+SQL_RESTORE_PRICE_BASIS = """
+    UPDATE game_meta SET value = MAX(
+        (SELECT current_price FROM game_snapshot WHERE id = 1),
+        COALESCE((SELECT MAX(amount) FROM bids WHERE status = 'paid'), 0)
+    )
+    WHERE key = 'price_basis'
+"""
+
+STALE_QUOTE_ERROR = "The price has just changed - someone bought the throne first. Please request a new invoice."
+BUSY_ERROR = "Too many purchases right now. Please try again in a moment."
+PENDING_ERROR = "Someone is paying for the throne right now. Please try again in a moment."
+
+# Результаты crown
+CROWNED = "crowned"
+OUTBID = "outbid"
+EXPIRED = "expired"
+
+BID_CLAIMS = metrics.counter("bid_claims_total", "Throne claims at pre-checkout by result", ("result",))
+BID_RELEASES = metrics.counter("bid_claims_released_total", "Throne claims that did not end with a crown", ("reason",))
+CLAIM_SECONDS = metrics.histogram("bid_claim_seconds", "Throne claim latency at pre-checkout")
+
+
+class Bid(NamedTuple):
+    version: int
+    user_id: int
+    amount: int
+    charge_id: str
+
+
+class Quote(NamedTuple):
+    version: int
+    base_price: int
+    multiplier: int
+    price: int
+
+    @property
+    def payload(self):
+        return f"{PAYLOAD_PREFIX}{self.multiplier}_{self.version}"
+
+
+def next_base_price(price_basis):
+    """Предыдущая оплата + 10% с округлением вверх"""
+    return math.ceil(price_basis * PRICE_STEP)
+
+
+async def quote(multiplier=1):
+    """Текущая цена трона с множителем (из кэша состояния; устаревшую отсеет pre-checkout)"""
+    state = await get_current_state()
+    base_price = next_base_price(state["price_basis"])
+    return Quote(state["bid_version"], base_price, multiplier, base_price * multiplier)
+
+
+def parse_payload(payload):
+    """(multiplier, version) из payload счета или None"""
+    if not payload or not payload.startswith(PAYLOAD_PREFIX):
+        return None
+    parts = payload[len(PAYLOAD_PREFIX):].split("_")
+    if len(parts) != 2 or not all(part.isdigit() for part in parts):
+        return None
+    multiplier, version = int(parts[0]), int(parts[1])
+    if multiplier not in MULTIPLIERS:
+        return None
+    return multiplier, version
+
+
+async def claim_throne(user_id, payload, amount):
+    """Заявка на трон при pre-checkout: (True, None) или (False, причина отказа)"""
+    parsed = parse_payload(payload)
+    if parsed is None:
+        BID_CLAIMS.inc("invalid")
+        return False, "This invoice is no longer valid. Please request a new one."
+    multiplier, version = parsed
+    started = time.perf_counter()
+    try:
+        won, error = await _claim(user_id, multiplier, version, amount)
+    except sqlite3.OperationalError as e:
+        # База занята дольше busy_timeout - лучше отказать сразу, чем не ответить на pre-checkout
+        logging.warning(f"Throne claim by {user_id} failed: {e}")
+        won, error = False, BUSY_ERROR
+    CLAIM_SECONDS.observe(time.perf_counter() - started)
+    BID_CLAIMS.inc("won" if won else "busy" if error == BUSY_ERROR else "pending" if error == PENDING_ERROR else "stale")
+    return won, error
+
+
+async def _claim(user_id, multiplier, version, amount):
+    now = time.time()
+    async with transaction() as db:
+        # Неоплаченные заявки снимаем сразу: на цену они не влияли, возвращать нечего
+        await db.execute(SQL_RELEASE_EXPIRED_CLAIMS, (now,))
+        async with db.execute(SQL_PENDING_CLAIM) as cursor:
+            if await cursor.fetchone() is not None:
+                # Кто-то оплачивает счет: после оплаты цена вырастет, и этот счет все равно устареет
+                return False, PENDING_ERROR
+        async with db.execute(SQL_PRICE_BASIS) as cursor:
+            price_basis = (await cursor.fetchone())[0]
+        claimed = None
+        if amount == next_base_price(price_basis) * multiplier:
+            # Compare-and-set: версия не изменилась с момента котировки
+            async with db.execute(SQL_CLAIM_BID_VERSION, (version,)) as cursor:
+                claimed = await cursor.fetchone()
+        if claimed is None:
+            # Котировка устарела (трон перекупили, возможно в другом процессе) - следующая пусть идет в базу
+            state_cache.invalidate()
+            return False, STALE_QUOTE_ERROR
+        await db.execute(SQL_INSERT_BID, (version, user_id, multiplier, amount, now, now + BID_PAYMENT_TTL))
+    # Версия ставок сменилась, цена - нет: следующая котировка возьмет новую версию из базы
+    state_cache.invalidate()
+    return True, None
+
+
+async def confirm_payment(user_id, payload, charge_id):
+    """Оплата прошла: заявка ждет фото до BID_PHOTO_TTL, цена для следующих - от этой оплаты.
+    False - оплату принять нельзя (заявки нет, или она уже снята, а трон оплачивает другой): Stars вернуть"""
+    parsed = parse_payload(payload)
+    if parsed is None:
+        logging.warning(f"Payment by {user_id} has invalid payload {payload}")
+        return False
+    version = parsed[1]
+    async with transaction() as db:
+        async with db.execute(SQL_GET_BID, (version, user_id)) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            logging.warning(f"Payment by {user_id} for {payload} has no claim")
+            return False
+        status, amount = row
+        if status == "released":
+            # Оплата пришла после срока заявки: принимаем, только если трон никто другой не оплачивает
+            async with db.execute(SQL_OTHER_PENDING_CLAIM, (version,)) as cursor:
+                if await cursor.fetchone() is not None:
+                    await db.execute(SQL_REFUSE_PAYMENT, (charge_id, version))
+                    logging.warning(f"Late payment by {user_id} for {payload} refused: another claim is pending")
+                    return False
+        elif status != "claimed":
+            logging.warning(f"Payment by {user_id} for {payload} repeats a {status} claim")
+            return False
+        await db.execute(SQL_PAY_BID, (time.time() + BID_PHOTO_TTL, charge_id, version))
+        await db.execute(SQL_RAISE_PRICE_BASIS, (amount,))
+        # Новая цена видна котировкам и Mini App
+        state_version = await _bump_state_version(db)
+        state = await _read_current_state(db)
+    _state_changed(state_version, state)
+    return True
+
+
+async def crown(user_id, photo_id, text, user_link):
+    """Делает оплатившего царем, если его заявка жива и ее не перекупили.
+    (CROWNED, Bid) или (OUTBID / EXPIRED, Bid или None) - тогда Stars по Bid надо вернуть"""
+    now = time.time()
+    changed = None
+    async with transaction() as db:
+        async with db.execute(SQL_LIVE_BID, (user_id,)) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            # Заявку уже сняли (и вернули Stars) или ее не было
+            return EXPIRED, None
+        version, amount, charge_id, expires_at = row
+        bid = Bid(version, user_id, amount, charge_id)
+        async with db.execute(SQL_KING_PRICE) as cursor:
+            (king_price,) = await cursor.fetchone()
+        if expires_at < now:
+            result = EXPIRED
+            await db.execute(SQL_SET_BID_STATUS, ("released", version))
+        elif amount < next_base_price(king_price):
+            # Пока ждали фото, царем стал тот, кто заплатил не меньше
+            result = OUTBID
+            await db.execute(SQL_SET_BID_STATUS, ("outbid", version))
+        else:
+            changed = await _append_purchase(db, user_id, photo_id, text, user_link, amount)
+            await db.execute(SQL_SET_BID_STATUS, ("settled", version))
+            result = CROWNED
+        if result != CROWNED:
+            BID_RELEASES.inc(result)
+            await db.execute(SQL_RESTORE_PRICE_BASIS)
+            changed = (await _bump_state_version(db), await _read_current_state(db))
+    _state_changed(*changed)
+    return result, bid
+
+
+async def release_expired_claims():
+    """Снимает просроченные заявки; оплаченные возвращает списком Bid - по ним бот возвращает Stars"""
+    now = time.time()
+    changed = None
+    async with transaction() as db:
+        async with db.execute(SQL_RELEASE_EXPIRED, (now,)) as cursor:
+            released = await cursor.fetchall()
+        # charge_id есть только у оплаченных
+        paid = [Bid(*row) for row in released if row[3] is not None]
+        if paid:
+            await db.execute(SQL_RESTORE_PRICE_BASIS)
+            changed = (await _bump_state_version(db), await _read_current_state(db))
+    for bid in paid:
+        BID_RELEASES.inc(EXPIRED)
+        logging.info(f"Paid throne claim {bid.version} by {bid.user_id} expired without a photo")
+    if changed is not None:
+        _state_changed(*changed)
+    return paid
+
+
+async def release_claim(user_id):
+    """Неоплаченная заявка не состоится (покупателя заблокировали): трон свободен сразу, а не по истечении"""
+    async with transaction() as db:
+        async with db.execute(SQL_RELEASE_CLAIMS, (user_id,)) as cursor:
+            if cursor.rowcount:
+                BID_RELEASES.inc("cancelled", amount=cursor.rowcount)
+
+
+async def init_bid_engine():
+    """Создает журнал заявок"""
+    async with transaction() as db:
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS bids (
+                version INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                multiplier INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'settled',
+                expires_at REAL,
+                charge_id TEXT
+            )
+        """)
+        # Базы, созданные раньше: недостающие колонки, старые заявки считаются завершенными
+        columns = [row[1] for row in await db.execute_fetchall("PRAGMA table_info(bids)")]
+        for column, definition in (
+            ("status", "TEXT NOT NULL DEFAULT 'settled'"), ("expires_at", "REAL"), ("charge_id", "TEXT"),
+        ):
+            if column not in columns:
+                await db.execute(f"ALTER TABLE bids ADD COLUMN {column} {definition}")
+        await db.execute("DROP INDEX IF EXISTS idx_bids_active")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_bids_status ON bids(status, user_id)")
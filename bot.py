@@ -1,16 +1,38 @@
 import os
 import asyncio
 import logging
-import math
+import multiprocessing
+import re
+import signal
+import time
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.types import Message, LabeledPrice, PreCheckoutQuery, WebAppInfo, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from dotenv import load_dotenv
 
-from database import init_db, get_game_state, update_game_state, rollback_last_entry, get_history, block_user, is_user_blocked, reset_database, set_base_price
+import metrics
+from database import open_db, close_db, init_db, rollback_last_entry, block_users, is_user_blocked, load_blocklist, refresh_blocklist, reset_database, set_base_price
 from ai_check import check_image
+from moderation_cache import init_moderation_cache
+from moderation_queue import ModerationQueue, SUPERSEDED
+from prefilter import prefilter, init_prefilter
+from fsm_storage import SQLiteStorage, init_fsm_storage
+from bid_engine import (
+    quote, claim_throne, confirm_payment, crown, release_claim, release_expired_claims, init_bid_engine,
+    Bid, CROWNED, OUTBID, BID_RELEASE_INTERVAL,
+)
+from throttling import ThrottlingMiddleware
+from outbox import OutboxSender, enqueue, init_outbox, get_outbox_stats
+from archive import init_archive, run_archiver, get_event_log, get_history, ARCHIVE_INTERVAL
+from photo_cache import photo_cache
+from thumbnails import generate_thumbnails, shutdown_pool
 
 logging.basicConfig(level=logging.INFO)
 load_dotenv()
@@ -20,13 +42,88 @@ CHANNEL_ID = os.getenv("CHANNEL_ID")
 WEBAPP_URL = os.getenv("WEBAPP_URL", "https://your-ngrok-url.ngrok.io")  # URL твоего Mini App
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")  # Админ пароль
 ADMIN_ID = 114776357  # Твой Telegram ID для уведомлений
+BLOCKLIST_FILE_MAX_SIZE = 1024 * 1024  # Максимальный размер файла для массовой блокировки
+PHOTO_MAX_SIZE = 10 * 1024 * 1024  # Больше фото не скачиваем и не модерируем
+BLOCKLIST_REFRESH_INTERVAL = 5  # Как часто подхватывать блокировки, сделанные другими процессами (сек)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # Свой Bot API сервер или заглушка для тестов
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+# Режим работы: polling (один процесс) или webhook (aiohttp за nginx, можно несколько воркеров)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный https-адрес, на который Telegram шлет обновления
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+BOT_HOST = os.getenv("BOT_HOST", "127.0.0.1")
+BOT_PORT = int(os.getenv("BOT_PORT", "8080"))
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))  # Сколько ждать текущие обновления при остановке
+# /metrics процесса в режиме polling (в webhook-режиме - на порту webhook); порт 0 - выключено
+BOT_METRICS_HOST = os.getenv("BOT_METRICS_HOST", "127.0.0.1")
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9101"))
+
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session)
+# FSM в общей SQLite: состояние оплаты видят все воркеры и оно переживает перезапуск
+dp = Dispatcher(storage=SQLiteStorage())
+# Спам командами и кнопками отсекаем до обработчиков (лимиты общие для воркеров webhook)
+throttling = ThrottlingMiddleware(name=f"bot{bot.id}", exempt_user_ids=(ADMIN_ID,))
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+# Посты в канал уходят из outbox фоновой отправкой, а не из обработчика
+outbox_sender = OutboxSender(bot, name=f"bot{bot.id}_outbox")
+
+# Все фото проходят AI-модерацию через общую очередь (VIP-покупатели - первыми)
+moderation_queue = ModerationQueue(check_image)
+
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Bot handler latency", ("handler",))
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Bot handlers that raised", ("handler",))
+metrics.callback(
+    "bot_throttled_updates_total", "Updates skipped by the throttling middleware",
+    lambda: {(reason,): throttling.counters[reason] for reason in ("coalesced", "dropped_user", "dropped_global")},
+    kind="counter", labels=("reason",),
+)
+metrics.callback("moderation_queue_depth", "Photos waiting for AI moderation", lambda: moderation_queue.depth)
+metrics.callback("moderation_in_flight", "Photos being checked by AI moderation", lambda: moderation_queue.in_flight)
+
+async def handler_metrics(handler, event, data):
+    """Время каждого обработчика (inner middleware: фильтры уже выбрали обработчик)"""
+    name = data["handler"].callback.__name__
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        HANDLER_ERRORS.inc(name)
+        raise
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+for observer in (dp.message, dp.callback_query, dp.pre_checkout_query):
+    observer.middleware(handler_metrics)
+
+blocklist_refresher = None
+archiver = None
+claim_releaser = None
+
+# Фоновые задачи (держим ссылки, чтобы их не собрал GC до завершения)
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def warm_photo_cache(file_id, image_bytes):
+    """Кладет фото нового короля и его квадратные превью в общий кэш фото"""
+    try:
+        await asyncio.to_thread(photo_cache.put, file_id, image_bytes)
+        await generate_thumbnails(file_id, image_bytes)
+    except Exception as e:
+        logging.warning(f"Photo cache warm-up failed: {e}")
 
 class GameStates(StatesGroup):
     waiting_for_photo = State()
     waiting_for_admin_password = State()
+    waiting_for_block_ids = State()
 
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
@@ -45,12 +142,8 @@ async def cmd_start(message: Message):
             await send_invoice_with_multiplier(message, multiplier)
             return
     
-    state = await get_game_state()
-    # state = (current_price, current_king_id, photo_id, text, user_link)
-    last_paid_price = state[0]
-    
-    # Вычисляем следующую цену для нового покупателя (предыдущая + 10%)
-    next_price = math.ceil(last_paid_price * 1.1)
+    # Следующая цена для нового покупателя (предыдущая оплата + 10%)
+    next_price = (await quote()).base_price
     
     # Создаем кнопку для открытия Mini App
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -76,11 +169,8 @@ async def cmd_buy(message: Message):
         [InlineKeyboardButton(text="💎 100 ⭐ Stars (100x VIP)", callback_data="buy_100")]
     ])
     
-    state = await get_game_state()
-    last_paid_price = state[0]
-    
-    # Вычисляем следующую цену для нового покупателя (предыдущая + 10%)
-    next_price = math.ceil(last_paid_price * 1.1)
+    # Следующая цена для нового покупателя (предыдущая оплата + 10%)
+    next_price = (await quote()).base_price
     
     await message.answer(
         f"<b>Choose Your Entry</b>\n\n"
@@ -97,22 +187,16 @@ async def cmd_buy(message: Message):
 # Функция для отправки invoice с множителем
 async def send_invoice_with_multiplier(message: Message, multiplier: int):
     """Отправляет invoice с указанным множителем"""
-    state = await get_game_state()
-    last_paid_price = state[0]
-    
-    # Вычисляем следующую базовую цену (предыдущая + 10%)
-    next_base_price = math.ceil(last_paid_price * 1.1)
-    
-    # Вычисляем финальную цену с множителем
-    final_price = next_base_price * multiplier
+    # Котировка привязана к версии ставок: если трон купят раньше, pre-checkout отклонит этот счет
+    price = await quote(multiplier)
     
     await bot.send_invoice(
-        chat_id=message.from_user.id if hasattr(message, 'from_user') else message.chat.id,
+        chat_id=message.chat.id,  # из кнопки message - сообщение бота, его from_user - сам бот
         title=f"The World's Frame ({multiplier}x)",
-        description=f"Become THE ONE. Base: {next_base_price} ⭐ × {multiplier} = {final_price} ⭐",
-        payload=f"king_buy_{multiplier}",
+        description=f"Become THE ONE. Base: {price.base_price} ⭐ × {multiplier} = {price.price} ⭐",
+        payload=price.payload,
         currency="XTR",
-        prices=[LabeledPrice(label=f"Throne Access {multiplier}x", amount=final_price)],
+        prices=[LabeledPrice(label=f"Throne Access {multiplier}x", amount=price.price)],
         provider_token=""
     )
 
@@ -125,12 +209,30 @@ async def callback_buy_multiplier(callback: CallbackQuery):
 
 @dp.pre_checkout_query()
 async def process_pre_checkout(pre_checkout_query: PreCheckoutQuery):
+    # Заблокированных отклоняем до оплаты (проверка в памяти, без запроса к БД)
+    if is_user_blocked(pre_checkout_query.from_user.id):
+        await bot.answer_pre_checkout_query(
+            pre_checkout_query.id,
+            ok=False,
+            error_message="Your account has been restricted from using this service."
+        )
+        return
+    # Атомарная заявка: цена счета должна совпадать с текущей, и трон в этот момент никто не перекупил
+    ok, error = await claim_throne(
+        pre_checkout_query.from_user.id,
+        pre_checkout_query.invoice_payload,
+        pre_checkout_query.total_amount
+    )
+    if not ok:
+        await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=False, error_message=error)
+        return
     await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
 
 @dp.message(F.successful_payment)
 async def process_successful_payment(message: Message, state: FSMContext):
-    # Проверка блокировки
-    if await is_user_blocked(message.from_user.id):
+    # Повторная проверка блокировки (на случай блокировки между pre-checkout и оплатой)
+    if is_user_blocked(message.from_user.id):
+        await release_claim(message.from_user.id)
         await message.answer(
             "❌ <b>Access Denied</b>\n\n"
             "Your account has been restricted from using this service.",
@@ -138,7 +240,15 @@ async def process_successful_payment(message: Message, state: FSMContext):
         )
         return
     
-    paid_amount = message.successful_payment.total_amount
+    payment = message.successful_payment
+    paid_amount = payment.total_amount
+    # Оплаченная заявка ждет фото до BID_PHOTO_TTL; если принять оплату нельзя - сразу возвращаем Stars
+    if not await confirm_payment(message.from_user.id, payment.invoice_payload, payment.telegram_payment_charge_id):
+        await refund_stars(
+            Bid(None, message.from_user.id, paid_amount, payment.telegram_payment_charge_id),
+            "Someone else was paying for the throne at the same time."
+        )
+        return
     
     await state.update_data(paid_amount=paid_amount)
     await state.set_state(GameStates.waiting_for_photo)
@@ -201,22 +311,48 @@ async def process_photo(message: Message, state: FSMContext):
         await message.answer("⚠️ Caption too long! Max 100 characters. Please try again.")
         return
     
+    # Размер известен до скачивания: слишком большое фото не тянем в память
+    if photo.file_size and photo.file_size > PHOTO_MAX_SIZE:
+        await message.answer("⚠️ Photo too large. Max 10 MB. Please send a smaller one.")
+        return
+    
     file = await bot.get_file(file_id)
     file_path = file.file_path
+    if file.file_size and file.file_size > PHOTO_MAX_SIZE:
+        await message.answer("⚠️ Photo too large. Max 10 MB. Please send a smaller one.")
+        return
     
+    # Скачиваем в память (BytesIO) и передаем байты дальше без временных файлов
     downloaded_file = await bot.download_file(file_path)
-    local_path = f"temp_{message.from_user.id}.jpg"
-    
-    with open(local_path, "wb") as new_file:
-        new_file.write(downloaded_file.read())
+    image_bytes = downloaded_file.getvalue()
         
-    msg = await message.answer("🤖 AI is checking your photo... (Wait 3 sec)")
+    # Очевидные отказы решаем локально, без очереди и запроса к Gemini
+    is_allowed, reason = prefilter.run(image_bytes, user_caption)
+    if not is_allowed:
+        await message.answer(
+            f"❌ <b>Submission Rejected</b>\n\n"
+            f"Reason: {reason}\n\n"
+            "Please submit a different image. Your payment remains secure.",
+            parse_mode="HTML"
+        )
+        return
     
-    is_allowed, reason = await check_image(local_path)
+    data = await state.get_data()
+    paid_amount = data.get("paid_amount", 1)
+    
+    job = moderation_queue.submit(message.from_user.id, paid_amount, image_bytes, file_unique_id=photo.file_unique_id)
+    position = moderation_queue.position(job)
+    if position > 1:
+        msg = await message.answer(f"🤖 AI is checking your photo... (#{position} in queue)")
+    else:
+        msg = await message.answer("🤖 AI is checking your photo...")
     
-    # Clean up
-    if os.path.exists(local_path):
-        os.remove(local_path)
+    result = await job.future
+    if result is SUPERSEDED:
+        # Пользователь прислал новое фото - проверяется оно, это сообщение больше не нужно
+        await msg.delete()
+        return
+    is_allowed, reason = result
     
     if not is_allowed:
         await msg.delete() # Remove "Checking..." message
@@ -244,7 +380,6 @@ async def process_photo(message: Message, state: FSMContext):
         return
 
     data = await state.get_data()
-    paid_amount = data.get("paid_amount", 1)
     show_username = data.get("show_username", True)  # По умолчанию показываем
     
     user_name = message.from_user.username or message.from_user.first_name
@@ -255,14 +390,23 @@ async def process_photo(message: Message, state: FSMContext):
     else:
         user_link = "Anonymous"  # Анонимный пользователь
     
-    # Сохраняем в БД то что реально заплатил пользователь (для Hall of Fame)
-    await update_game_state(
-        user_id=message.from_user.id,
-        photo_id=file_id,
-        text=user_caption,
-        user_link=user_link,
-        new_price=paid_amount  # Сохраняем то, что реально заплатили
-    )
+    # Царем делает только живая оплаченная заявка, и в той же транзакции она закрывается
+    result, bid = await crown(message.from_user.id, file_id, user_caption, user_link)
+    if result != CROWNED:
+        await msg.delete()
+        if bid is None:
+            # Заявку уже сняли по сроку, Stars вернул release_claims_periodically
+            await message.answer("⌛ Your photo slot has expired and your Stars were refunded. Use /buy to try again.")
+        elif result == OUTBID:
+            await refund_stars(bid, "Someone claimed the throne at a higher price before your photo was approved.")
+        else:
+            await refund_stars(bid, "Your photo slot has expired.")
+        await state.clear()
+        return
+    paid_amount = bid.amount  # Сохранено то, что реально заплатили (для Hall of Fame)
+    
+    # Прогреваем кэш фото и превью в фоне: Mini App отдаст нового короля без похода в Telegram
+    run_in_background(warm_photo_cache(file_id, image_bytes))
     
     # Формируем caption для канала с кликабельными ссылками
     channel_caption = f"👑 <b>THE ONE</b>\n\n"
@@ -276,16 +420,16 @@ async def process_photo(message: Message, state: FSMContext):
     else:
         channel_caption += f"Anonymous • {paid_amount} ⭐"
     
-    try:
-        await bot.send_photo(
-            chat_id=CHANNEL_ID,
+    if CHANNEL_ID:
+        # Пост уйдет из outbox; несколько царей за пару секунд дадут один пост о последнем
+        await enqueue(
+            "send_photo",
+            CHANNEL_ID,
+            coalesce_key=f"king:{CHANNEL_ID}",
             photo=file_id,
             caption=channel_caption,
             parse_mode="HTML"
         )
-    except Exception as e:
-        print(f"Channel Error: {e}")
-        await message.answer(f"(Dev info: Channel post failed: {e})")
 
     await msg.delete()
     await message.answer(
@@ -342,20 +486,21 @@ async def process_admin_password(message: Message, state: FSMContext):
             await reset_database()
             await message.answer(
                 "✅ <b>Database Reset Complete</b>\n\n"
-                "All Hall of Fame entries have been deleted.\n"
+                "Hall of Fame has been cleared (history is kept in the event log).\n"
                 "Initial entry created (price: 1 ⭐)",
                 parse_mode="HTML"
             )
             await state.clear()
             return
         elif action == "block":
-            # Ждем ввода user_id для блокировки
+            # Ждем ввода user_id (один или список) для блокировки
+            await state.set_state(GameStates.waiting_for_block_ids)
             await message.answer(
-                "🚫 <b>Block User</b>\n\n"
-                "Send user ID to block (numeric):",
+                "🚫 <b>Block Users</b>\n\n"
+                "Send one or more user IDs (separated by spaces, commas or new lines),\n"
+                "or a .txt/.csv file with IDs for bulk import:",
                 parse_mode="HTML"
             )
-            # Не очищаем state, ждём ID
             return
         
         # Обычный вход в админку
@@ -364,13 +509,23 @@ async def process_admin_password(message: Message, state: FSMContext):
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="📊 View History", callback_data="admin_history")],
+            [InlineKeyboardButton(text="🗄 Event Log", callback_data="admin_events")],
             [InlineKeyboardButton(text="↩️ Rollback Last", callback_data="admin_rollback")],
             [InlineKeyboardButton(text="🚫 Block User", callback_data="admin_block")],
             [InlineKeyboardButton(text="🗑️ Reset Database", callback_data="admin_reset")]
         ])
         
+        queue = moderation_queue.stats()
+        outbox = await get_outbox_stats()
         await message.answer(
             "✅ <b>Admin Access Granted</b>\n\n"
+            f"🤖 Moderation queue: {queue['depth']} waiting, {queue['in_flight']} checking, "
+            f"avg wait {queue['avg_wait']:.1f}s (max {queue['max_wait']:.1f}s)\n"
+            f"🧹 Pre-filter: {prefilter.saved_calls} of {prefilter.checked} photos rejected locally\n"
+            f"🛡 Throttling: {throttling.counters['coalesced']} repeats coalesced, "
+            f"{throttling.counters['dropped_user'] + throttling.counters['dropped_global']} updates dropped\n"
+            f"📤 Channel outbox: {outbox['pending'] + outbox['sending']} queued, {outbox['failed']} failed, "
+            f"{outbox['superseded']} coalesced\n\n"
             "Choose action:",
             parse_mode="HTML",
             reply_markup=keyboard
@@ -399,6 +554,24 @@ async def callback_admin_history(callback: CallbackQuery):
     await callback.message.answer(text, parse_mode="HTML")
     await callback.answer()
 
+EVENT_ICONS = {"purchase": "👑", "price_override": "✏️", "rollback": "↩️", "reset": "🗑️"}
+
+@dp.callback_query(F.data == "admin_events")
+async def callback_admin_events(callback: CallbackQuery):
+    """Показать последние события журнала, включая архив"""
+    events = await get_event_log(limit=15)
+    
+    text = "<b>🗄 Event Log (last 15):</b>\n\n"
+    for event in events:
+        icon = EVENT_ICONS.get(event['kind'], "•")
+        who = event['user_link'] or ""
+        archived = " 📦" if event['source'] != "hot" else ""
+        text += f"{icon} #{event['id']} {event['kind']} {who} {event['price']} ⭐ (epoch {event['epoch']}){archived}\n"
+        text += f"   🕒 {event['created_at']}\n"
+    
+    await callback.message.answer(text, parse_mode="HTML")
+    await callback.answer()
+
 @dp.callback_query(F.data == "admin_rollback")
 async def callback_admin_rollback(callback: CallbackQuery):
     """Откатить последнюю запись"""
@@ -418,13 +591,13 @@ async def callback_admin_rollback(callback: CallbackQuery):
 async def callback_admin_block(callback: CallbackQuery, state: FSMContext):
     """Запросить ID пользователя для блокировки"""
     await callback.answer()
+    await state.set_state(GameStates.waiting_for_admin_password)  # Reusing state
+    await state.update_data(admin_action="block")
     await callback.message.answer(
-        "🚫 <b>Block User</b>\n\n"
-        "Send user ID to block (numeric):",
+        "🚫 <b>Block Users</b>\n\n"
+        "Enter admin password to confirm:",
         parse_mode="HTML"
     )
-    await state.set_state(GameStates.waiting_for_admin_password)  # Reusing state
-    await state.update_data(admin_action="block")
 
 @dp.callback_query(F.data == "admin_reset")
 async def callback_admin_reset(callback: CallbackQuery, state: FSMContext):
@@ -434,39 +607,246 @@ async def callback_admin_reset(callback: CallbackQuery, state: FSMContext):
     await state.update_data(admin_action="reset_db")
     await callback.message.answer(
         "⚠️ <b>Database Reset</b>\n\n"
-        "This will delete ALL Hall of Fame entries!\n\n"
+        "This will clear the Hall of Fame and start a new epoch!\n\n"
         "Enter admin password to confirm:",
         parse_mode="HTML"
     )
 
-# Обработчик для блокировки пользователя
-@dp.message(lambda message: message.text and message.text.isdigit())
-async def process_admin_block_user(message: Message, state: FSMContext):
-    """Блокировка пользователя по ID"""
-    data = await state.get_data()
+# Обработчик для блокировки пользователей (один ID, список или файл)
+@dp.message(GameStates.waiting_for_block_ids)
+async def process_admin_block_users(message: Message, state: FSMContext):
+    """Блокировка пользователей по ID (включая массовый импорт из файла)"""
+    if message.document:
+        if message.document.file_size and message.document.file_size > BLOCKLIST_FILE_MAX_SIZE:
+            await message.answer("⚠️ File too large. Max 1 MB.")
+            return
+        downloaded = await bot.download(message.document)
+        raw_ids = downloaded.read().decode("utf-8", errors="ignore")
+    else:
+        raw_ids = message.text or ""
     
-    if data.get("admin_action") == "block":
-        user_id = int(message.text)
-        await block_user(user_id)
-        await message.answer(
-            f"✅ User {user_id} has been blocked.",
-            parse_mode="HTML"
-        )
-        await state.clear()
+    user_ids = [int(user_id) for user_id in re.findall(r"\d+", raw_ids)]
+    if not user_ids:
+        await message.answer("⚠️ No numeric user IDs found. Please try again.")
+        return
+    
+    added = await block_users(user_ids, reason="Admin action")
+    await message.answer(
+        f"✅ Blocked {added} new user(s) ({len(set(user_ids))} IDs processed).",
+        parse_mode="HTML"
+    )
+    await state.clear()
 
 # Проверка блокировки перед успешной оплатой
-async def check_if_blocked(user_id: int) -> bool:
+def check_if_blocked(user_id: int) -> bool:
     """Проверяет, заблокирован ли пользователь"""
-    return await is_user_blocked(user_id)
+    return is_user_blocked(user_id)
 
 
-async def main():
+async def refresh_blocklist_periodically():
+    """Подхватывает блокировки, сделанные другими воркерами"""
+    while True:
+        await asyncio.sleep(BLOCKLIST_REFRESH_INTERVAL)
+        try:
+            await refresh_blocklist()
+        except Exception as e:
+            logging.warning(f"Blocklist refresh failed: {e}")
+
+async def refund_stars(bid, reason):
+    """Возвращает Stars за покупку, которая не стала царем, и сообщает покупателю"""
+    try:
+        await bot.refund_star_payment(user_id=bid.user_id, telegram_payment_charge_id=bid.charge_id)
+    except Exception as e:
+        logging.error(f"Refund of {bid.amount} Stars to {bid.user_id} failed: {e}")
+        try:
+            await bot.send_message(
+                ADMIN_ID,
+                f"🚨 <b>Refund failed</b>\n\nUser ID: {bid.user_id}\nAmount: {bid.amount} ⭐\n"
+                f"Charge: <code>{bid.charge_id}</code>\nError: {e}",
+                parse_mode="HTML"
+            )
+        except Exception:
+            pass
+        return
+    try:
+        await bot.send_message(
+            bid.user_id,
+            f"↩️ <b>Purchase cancelled</b>\n\n{reason}\n{bid.amount} ⭐ have been refunded. Use /buy to try again.",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logging.warning(f"Refund notice to {bid.user_id} failed: {e}")
+
+async def release_claims_periodically():
+    """Снимает оплаченные заявки, не дождавшиеся фото: состояние диалога сбрасывается, Stars возвращаются"""
+    while True:
+        await asyncio.sleep(BID_RELEASE_INTERVAL)
+        try:
+            for bid in await release_expired_claims():
+                key = StorageKey(bot_id=bot.id, chat_id=bid.user_id, user_id=bid.user_id)
+                await FSMContext(storage=dp.storage, key=key).clear()
+                await refund_stars(bid, "Your photo slot has expired.")
+        except Exception as e:
+            logging.warning(f"Releasing expired claims failed: {e}")
+
+async def archive_periodically():
+    """Переносит старые события журнала в архив (проход делает один процесс за интервал)"""
+    while True:
+        try:
+            await run_archiver()
+        except Exception as e:
+            logging.warning(f"Archiver failed: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+@dp.startup()
+async def on_startup():
+    global blocklist_refresher, archiver, claim_releaser
+    metrics.start("bot")
+    await open_db()
     await init_db()
+    await init_archive()
+    await init_fsm_storage()
+    await init_bid_engine()
+    await init_outbox()
+    await load_blocklist()
+    await init_moderation_cache()
+    await init_prefilter()
+    moderation_queue.start()
+    outbox_sender.start()
+    blocklist_refresher = asyncio.create_task(refresh_blocklist_periodically())
+    archiver = asyncio.create_task(archive_periodically())
+    claim_releaser = asyncio.create_task(release_claims_periodically())
     print("Bot started!")
-    await dp.start_polling(bot)
 
-if __name__ == "__main__":
+@dp.shutdown()
+async def on_shutdown():
+    blocklist_refresher.cancel()
+    archiver.cancel()
+    claim_releaser.cancel()
+    await outbox_sender.stop()
+    await moderation_queue.stop()
+    await dp.storage.close()
+    shutdown_pool()
+    await close_db()
+
+async def metrics_view(request):
+    """Метрики бота в формате Prometheus (все процессы бота)"""
+    if not metrics.authorized(request.headers.get("Authorization")):
+        return web.Response(status=401)
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+async def start_metrics_sidecar():
+    """Отдельный HTTP-сервер с /metrics для режима polling; None, если выключен"""
+    if not BOT_METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, BOT_METRICS_HOST, BOT_METRICS_PORT).start()
+    return runner
+
+async def main():
+    runner = await start_metrics_sidecar()
     try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        print("Stop")
\ No newline at end of file
+        await dp.start_polling(bot)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+def register_webhook(app):
+    """Добавляет в aiohttp-приложение прием обновлений на WEBHOOK_PATH и запуск/остановку бота"""
+    # Отвечаем Telegram сразу, обновление обрабатывается фоновой задачей: фото с модерацией
+    # идет дольше таймаутов nginx и Telegram, и по 504 Telegram прислал бы его повторно
+    handler = SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=True,
+    )
+    # Без handler.register(): его on_shutdown закрыл бы сессию бота раньше, чем задачи доработают
+    app.router.add_post(WEBHOOK_PATH, handler.handle)
+
+    async def on_app_startup(app):
+        await dp.emit_startup(bot=bot, dispatcher=dp)
+
+    async def on_app_cleanup(app):
+        # Новых запросов уже нет: ждем начатые обновления (aiogram 3.13 держит их задачи
+        # в этом множестве), затем останавливаем бота
+        tasks = set(handler._background_feed_update_tasks)
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=WEBHOOK_DRAIN_TIMEOUT)
+            if pending:
+                logging.warning(f"Webhook: {len(pending)} updates still running at shutdown, cancelling")
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending)
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+
+    app.on_startup.append(on_app_startup)
+    # Первым: бот дописывает в БД раньше, чем другие обработчики приложения ее закроют
+    app.on_cleanup.insert(0, on_app_cleanup)
+
+def create_webhook_app():
+    """aiohttp-приложение, принимающее обновления от Telegram"""
+    app = web.Application()
+    register_webhook(app)
+    app.router.add_get("/metrics", metrics_view)
+    return app
+
+def run_webhook_worker(worker):
+    # reuse_port: все воркеры слушают один порт, ядро распределяет соединения между ними
+    web.run_app(
+        create_webhook_app(),
+        host=BOT_HOST,
+        port=BOT_PORT,
+        reuse_port=BOT_WORKERS > 1,
+        shutdown_timeout=WEBHOOK_DRAIN_TIMEOUT,
+        print=None,
+    )
+
+async def set_webhook():
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    await bot.session.close()
+
+def run_workers(target, count, name):
+    """Запускает count процессов target(номер воркера) (spawn) и ждет их; SIGTERM передается всем"""
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=target, args=(i,), name=f"{name}-{i}") for i in range(count)]
+    for worker in workers:
+        worker.start()
+
+    # SIGTERM от systemd передаем воркерам: каждый дорабатывает свои обновления и выходит
+    def stop_workers(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, stop_workers)
+    # Ctrl+C терминал и так отправляет всей группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for worker in workers:
+        worker.join()
+
+def run_webhook():
+    """Webhook-режим: BOT_WORKERS процессов на BOT_HOST:BOT_PORT"""
+    if WEBHOOK_URL:
+        asyncio.run(set_webhook())
+    print(f"Webhook server on http://{BOT_HOST}:{BOT_PORT}{WEBHOOK_PATH} ({BOT_WORKERS} workers)")
+    if BOT_WORKERS <= 1:
+        run_webhook_worker(0)
+        return
+    run_workers(run_webhook_worker, BOT_WORKERS, "bot-worker")
+
+if __name__ == "__main__":
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            print("Stop")
@@ -0,0 +1,139 @@
+"""
+Шина сброса кэшей между процессами runtime.py на одной машине.
+
+Каждый процесс слушает свой unix-сокет (датаграммы)
+CACHE_BUS_DIR/the_one_bus_<хэш пути БД>_<pid>.sock; соседи - все сокеты с тем
+же хэшем, то есть процессы, работающие с той же базой. После своей записи
+процесс рассылает соседям одну строку: "state <version>" (новый царь) или
+"blocklist". Получатель одним запросом сверяет версию в БД и будит своих
+подписчиков (state_cache, SSE, снимки API) сразу, а не через STATE_CACHE_TTL
+или STREAM_POLL_INTERVAL. Сообщение - только подсказка: если оно потерялось,
+изменение все равно придет обычным опросом.
+
+Фото не требуют сброса: file_id неизменяем, а дисковый кэш photo_cache общий.
+"""
+import asyncio
+import glob
+import hashlib
+import logging
+import os
+import socket
+
+import database
+import metrics
+from database import (
+    check_state_version, refresh_blocklist, state_cache, state_listeners, blocklist_listeners, _state_changed,
+)
+
+CACHE_BUS_DIR = os.getenv("CACHE_BUS_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else "")
+
+CACHE_BUS_MESSAGES = metrics.counter("cache_bus_messages_total", "Cache bus datagrams by direction", ("direction",))
+
+
+class CacheBus:
+    """Рассылает соседям свои изменения и применяет чужие"""
+
+    def __init__(self, directory=CACHE_BUS_DIR):
+        self.directory = directory
+        self._prefix = None
+        self._path = None
+        self._sock = None
+        self._seen_version = None
+        self._dirty = set()
+        self._task = None
+
+    def start(self):
+        """Открывает сокет и подписывается на изменения этого процесса; без CACHE_BUS_DIR - ничего"""
+        if not self.directory:
+            return
+        db_hash = hashlib.sha256(os.path.abspath(database.DB_NAME).encode()).hexdigest()[:16]
+        self._prefix = os.path.join(self.directory, f"the_one_bus_{db_hash}_")
+        self._path = f"{self._prefix}{os.getpid()}.sock"
+        if os.path.exists(self._path):
+            os.remove(self._path)  # остался от процесса с тем же pid
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._sock.bind(self._path)
+        self._seen_version = state_cache.version
+        asyncio.get_running_loop().add_reader(self._sock.fileno(), self._on_readable)
+        state_listeners.append(self._on_state)
+        blocklist_listeners.append(self._on_blocklist)
+
+    async def stop(self):
+        if self._sock is None:
+            return
+        state_listeners.remove(self._on_state)
+        blocklist_listeners.remove(self._on_blocklist)
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def send(self, message):
+        """Отправляет строку всем соседям; сокеты умерших процессов удаляет"""
+        data = message.encode()
+        for path in glob.glob(f"{self._prefix}*.sock"):
+            if path == self._path:
+                continue
+            try:
+                self._sock.sendto(data, path)
+                CACHE_BUS_MESSAGES.inc("sent")
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            except BlockingIOError:
+                CACHE_BUS_MESSAGES.inc("dropped")  # очередь соседа полна - он отстал, догонит опросом
+
+    def _on_state(self, version, state):
+        # Свое изменение - рассылаем; чужое, примененное в _sync, обратно не отправляем
+        if self._seen_version is not None and version <= self._seen_version:
+            return
+        self._seen_version = version
+        self.send(f"state {version}")
+
+    def _on_blocklist(self):
+        self.send("blocklist")
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self._sock.recv(64)
+            except BlockingIOError:
+                return
+            CACHE_BUS_MESSAGES.inc("received")
+            topic, _, version = data.decode(errors="replace").partition(" ")
+            if topic == "state":
+                if version.isdigit() and self._seen_version is not None and int(version) <= self._seen_version:
+                    continue
+            elif topic != "blocklist":
+                continue
+            # Пачку сообщений применяем одной задачей: один запрос вместо одного на сообщение
+            self._dirty.add(topic)
+            if self._task is None or self._task.done():
+                self._task = asyncio.create_task(self._sync())
+
+    async def _sync(self):
+        while self._dirty:
+            topics, self._dirty = self._dirty, set()
+            try:
+                if "state" in topics:
+                    changed = await check_state_version(self._seen_version)
+                    if changed is not None:
+                        self._seen_version = changed[0]
+                        _state_changed(*changed)
+                if "blocklist" in topics:
+                    await refresh_blocklist()
+            except Exception as e:
+                logging.warning(f"Cache bus sync failed: {e}")
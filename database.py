@@ -1,23 +1,393 @@
 import aiosqlite
+import asyncio
 import os
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager
+
+import metrics
 
 DB_NAME = "game_database.db"
 
+DB_CALL_SECONDS = metrics.histogram("db_call_seconds", "Time spent in database.py functions", ("function",))
+DB_LOCK_WAIT_SECONDS = metrics.histogram("db_write_lock_wait_seconds", "Wait for the write lock: shared connection and BEGIN IMMEDIATE")
+
+# Pragma для всех соединений: WAL позволяет Flask читать, пока бот пишет
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",      # ~16 MB page cache
+    "PRAGMA mmap_size=134217728",    # 128 MB memory-mapped I/O
+)
+# Размер кэша подготовленных выражений sqlite3 (ключ - текст SQL)
+STATEMENT_CACHE_SIZE = 128
+# Повторы BEGIN IMMEDIATE, если SQLite ответил "database is locked", не дожидаясь busy_timeout
+BEGIN_RETRIES = 5
+
+# Горячие запросы держим константами, чтобы текст SQL совпадал и выражение бралось из кэша
+# Текущий царь - одна строка game_snapshot; вместе с ним читаем цену, от которой считается
+# следующая покупка, и версию ставок (см. bid_engine.py)
+SQL_CURRENT_STATE = """
+    SELECT current_price, user_id, photo_id, text, user_link,
+           (SELECT value FROM game_meta WHERE key = 'price_basis'),
+           (SELECT value FROM game_meta WHERE key = 'bid_version')
+    FROM game_snapshot WHERE id = 1
+"""
+SQL_SNAPSHOT = """
+    SELECT epoch, head_id, prev_id, purchase_id, current_price, user_id, photo_id, text, user_link
+    FROM game_snapshot WHERE id = 1
+"""
+# История - неизменяемый журнал game_events: покупки, правки цены, откаты и сбросы.
+# Событие-состояние (purchase/price_override/reset) хранит царя целиком и prev_id - состояние до него,
+# поэтому откат - чтение одной строки по первичному ключу, а сброс - новая эпоха, а не DELETE
+SQL_INSERT_EVENT = """
+    INSERT INTO game_events (epoch, kind, user_id, price, photo_id, text, user_link, prev_id, purchase_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    RETURNING id
+"""
+SQL_STATE_EVENT = """
+    SELECT price, user_id, photo_id, text, user_link, prev_id,
+           CASE kind WHEN 'purchase' THEN id ELSE purchase_id END
+    FROM game_events WHERE id = ?
+"""
+SQL_SET_SNAPSHOT = """
+    UPDATE game_snapshot
+    SET epoch = ?, head_id = ?, prev_id = ?, purchase_id = ?,
+        current_price = ?, user_id = ?, photo_id = ?, text = ?, user_link = ?
+    WHERE id = 1
+"""
+# Старые базы хранили историю в game_state: переносим ее в журнал с теми же id (таблица остается как была)
+SQL_IMPORT_LEGACY_HISTORY = """
+    INSERT INTO game_events (id, epoch, kind, user_id, price, photo_id, text, user_link, prev_id, created_at)
+    SELECT id, 0, CASE WHEN user_id > 0 THEN 'purchase' ELSE 'reset' END,
+           user_id, current_price, photo_id, text, user_link,
+           CASE WHEN user_id > 0 THEN LAG(id) OVER (ORDER BY id) END, created_at
+    FROM game_state ORDER BY id
+"""
+# Покупки текущей эпохи, которые не откатил админ
+SQL_LIVE_PURCHASES = """
+    FROM game_events AS e
+    WHERE e.kind = 'purchase' AND e.user_id > 0
+      AND e.epoch = (SELECT epoch FROM game_snapshot WHERE id = 1)
+      AND NOT EXISTS (SELECT 1 FROM game_events AS r WHERE r.kind = 'rollback' AND r.purchase_id = e.id)
+"""
+# Hall of Fame - отдельная таблица лучших HALL_OF_FAME_SIZE покупок эпохи, которую ведут покупки,
+# откаты и сбросы; поэтому старые покупки могут уходить из game_events в архив (archive.py).
+# Чтение идет по индексу idx_hall_of_fame: сортировка не нужна, а следующая страница ищется
+# по ключу (keyset), поэтому стоимость зависит от limit, а не от истории
+SQL_HALL_OF_FAME = """
+    SELECT id, user_id, user_link, price, photo_id, text FROM hall_of_fame
+    WHERE epoch = (SELECT epoch FROM game_snapshot WHERE id = 1)
+    ORDER BY price DESC, id
+    LIMIT ?
+"""
+SQL_HALL_OF_FAME_AFTER = """
+    SELECT id, user_id, user_link, price, photo_id, text FROM hall_of_fame
+    WHERE epoch = (SELECT epoch FROM game_snapshot WHERE id = 1)
+      AND price <= ? AND (price < ? OR id > ?)
+    ORDER BY price DESC, id
+    LIMIT ?
+"""
+SQL_HALL_INSERT = """
+    INSERT OR IGNORE INTO hall_of_fame (id, epoch, user_id, user_link, price, photo_id, text)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+# Заполнение из журнала при переходе со старой схемы
+SQL_HALL_REFILL = f"""
+    INSERT OR IGNORE INTO hall_of_fame (id, epoch, user_id, user_link, price, photo_id, text)
+    SELECT e.id, e.epoch, e.user_id, e.user_link, e.price, e.photo_id, e.text
+    {SQL_LIVE_PURCHASES}
+    ORDER BY e.price DESC, e.id
+    LIMIT ?
+"""
+# Следующая после последнего места покупка (вытесненная из таблицы, если она еще в журнале)
+SQL_HALL_REFILL_NEXT = f"""
+    INSERT OR IGNORE INTO hall_of_fame (id, epoch, user_id, user_link, price, photo_id, text)
+    SELECT e.id, e.epoch, e.user_id, e.user_link, e.price, e.photo_id, e.text
+    {SQL_LIVE_PURCHASES}
+      AND e.price <= ? AND (e.price < ? OR e.id > ?)
+    ORDER BY e.price DESC, e.id
+    LIMIT 1
+"""
+SQL_HALL_LAST = "SELECT price, id FROM hall_of_fame WHERE epoch = ? ORDER BY price, id DESC LIMIT 1"
+# Прошлые эпохи и все, что ниже первых HALL_OF_FAME_SIZE мест текущей
+SQL_HALL_TRIM = """
+    DELETE FROM hall_of_fame WHERE epoch < ? OR id IN (
+        SELECT id FROM hall_of_fame WHERE epoch = ? ORDER BY price DESC, id LIMIT -1 OFFSET ?
+    )
+"""
+SQL_BLOCK_USER = "INSERT OR REPLACE INTO blocked_users (user_id, reason) VALUES (?, ?)"
+SQL_STATE_VERSION = "SELECT value FROM game_meta WHERE key = 'state_version'"
+SQL_BUMP_STATE_VERSION = "UPDATE game_meta SET value = value + 1 WHERE key = 'state_version' RETURNING value"
+# Версия блоклиста: по ней другие процессы бота узнают, что пора перечитать blocked_users
+SQL_BLOCKLIST_VERSION = "SELECT value FROM game_meta WHERE key = 'blocklist_version'"
+SQL_BUMP_BLOCKLIST_VERSION = "UPDATE game_meta SET value = value + 1 WHERE key = 'blocklist_version'"
+# Цена последней покупки меняется только вместе с версией ставок, иначе выставленные счета остались бы в силе
+SQL_BUMP_BID_VERSION = "UPDATE game_meta SET value = value + 1 WHERE key = 'bid_version'"
+SQL_RAISE_PRICE_BASIS = "UPDATE game_meta SET value = MAX(value, ?) WHERE key = 'price_basis'"
+SQL_RESET_PRICE_BASIS = """
+    UPDATE game_meta SET value = (SELECT current_price FROM game_snapshot WHERE id = 1)
+    WHERE key = 'price_basis'
+"""
+
+# "Нулевой царь" после создания базы и после сброса: (price, user_id, photo_id, text, user_link)
+INITIAL_KING = (1, 0, "", "Throne awaits its first ruler", "")
+
+# Максимальный размер страницы Hall of Fame и сколько мест в нем всего
+HALL_OF_FAME_MAX_LIMIT = 50
+HALL_OF_FAME_SIZE = int(os.getenv("HALL_OF_FAME_SIZE", "1000"))
+
+# Сколько секунд доверяем кэшу текущего царя, прежде чем сверить версию в БД.
+# Это верхняя граница задержки, с которой другой процесс (бот/веб) увидит изменение.
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "1.0"))
+
+_db = None
+_reader = None
+_write_lock = None
+_sync_local = threading.local()
+
+async def _connect(*pragmas):
+    db = await aiosqlite.connect(
+        DB_NAME,
+        isolation_level=None,  # транзакциями управляем сами через transaction()
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    for pragma in SQLITE_PRAGMAS + pragmas:
+        await db.execute(pragma)
+    return db
+
+async def open_db():
+    """Открывает общие долгоживущие соединения (один раз на процесс): пишущее для
+    transaction() и читающее для get_db(). Читающее не видит незакоммиченных строк
+    открытой транзакции, поэтому в кэши не попадет состояние, которое потом откатится"""
+    global _db, _reader, _write_lock
+    if _reader is not None:
+        return _reader
+    db = await _connect()
+    reader = await _connect("PRAGMA query_only=ON")
+    if _reader is not None:
+        # Пока мы ждали, соединения уже открыла другая корутина
+        await db.close()
+        await reader.close()
+        return _reader
+    _db, _reader = db, reader
+    _write_lock = asyncio.Lock()
+    return _reader
+
+async def close_db():
+    """Закрывает общие соединения при остановке"""
+    global _db, _reader
+    if _reader is not None:
+        db, reader, _db, _reader = _db, _reader, None, None
+        await reader.close()
+        await db.close()
+
+async def get_db():
+    """Соединение для чтения вне транзакций (только закоммиченные данные), открывается при первом обращении"""
+    if _reader is None:
+        return await open_db()
+    return _reader
+
+async def _begin_immediate(db):
+    """BEGIN IMMEDIATE с повтором при SQLITE_BUSY без ожидания.
+
+    Если соединение еще держит старый снимок WAL, а другой процесс успел записать, SQLite
+    отказывает сразу (busy_timeout не помогает) - ждем и пробуем снова.
+    """
+    for attempt in range(BEGIN_RETRIES):
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or attempt == BEGIN_RETRIES - 1:
+                raise
+        await asyncio.sleep(0.005 * 2 ** attempt)
+
+@asynccontextmanager
+async def transaction():
+    """Пишущая транзакция на общем пишущем соединении (BEGIN IMMEDIATE ... COMMIT)"""
+    await get_db()
+    db = _db
+    started = time.perf_counter()
+    async with _write_lock:
+        await _begin_immediate(db)
+        DB_LOCK_WAIT_SECONDS.observe(time.perf_counter() - started)
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+
+class StateCache:
+    """Кэш текущего царя в памяти процесса с номером версии из game_meta"""
+
+    def __init__(self):
+        # (version, state, checked_at) - меняем целиком, чтобы потоки Flask не видели половину
+        self.entry = None
+
+    def get(self):
+        """Возвращает state, если он проверялся не дольше STATE_CACHE_TTL назад"""
+        entry = self.get_versioned()
+        return entry[1] if entry is not None else None
+
+    def get_versioned(self):
+        """(version, state), если запись проверялась не дольше STATE_CACHE_TTL назад"""
+        entry = self.entry
+        if entry is not None and time.monotonic() - entry[2] < STATE_CACHE_TTL:
+            return entry[0], entry[1]
+        return None
+
+    def store(self, version, state):
+        self.entry = (version, state, time.monotonic())
+
+    def revalidate(self, version):
+        """Продлевает запись, если версия не изменилась. Возвращает state или None"""
+        entry = self.entry
+        if entry is not None and entry[0] == version:
+            self.entry = (version, entry[1], time.monotonic())
+            return entry[1]
+        return None
+
+    def invalidate(self):
+        self.entry = None
+
+    @property
+    def version(self):
+        entry = self.entry
+        return entry[0] if entry is not None else None
+
+state_cache = StateCache()
+
+# Заблокированные пользователи в памяти (write-through: block_users пишет и в БД, и сюда)
+blocked_user_ids = set()
+_blocklist_version = None
+
+# Подписчики на изменения состояния, сделанные этим процессом: callback(version, state)
+state_listeners = []
+# Подписчики на блокировки, сделанные этим процессом: callback()
+blocklist_listeners = []
+
+# Поиск события-состояния, уже перенесенного в архив (задает archive.py): async reader(db, event_id) -> row | None
+archived_event_reader = None
+
+def _state_changed(version, state):
+    """Вызывается после COMMIT любой записи, меняющей текущего царя"""
+    state_cache.store(version, state)
+    for listener in state_listeners:
+        listener(version, state)
+
+def _state_from_row(row):
+    if row:
+        return {
+            "current_price": row[0],
+            "user_id": row[1],
+            "photo_id": row[2],
+            "text": row[3],
+            "user_link": row[4],
+            "price_basis": row[5] if row[5] is not None else row[0],
+            "bid_version": row[6] or 0
+        }
+    return {"current_price": 1, "user_id": 0, "photo_id": "", "text": "", "user_link": "", "price_basis": 1, "bid_version": 0}
+
+def _state_as_tuple(state):
+    return (state["current_price"], state["user_id"], state["photo_id"], state["text"], state["user_link"])
+
+async def _bump_state_version(db):
+    """Увеличивает версию состояния внутри открытой транзакции"""
+    async with db.execute(SQL_BUMP_STATE_VERSION) as cursor:
+        row = await cursor.fetchone()
+    return row[0]
+
+async def _reset_price_basis(db):
+    """После правки истории админом цена снова считается от текущего царя; старые счета недействительны"""
+    await db.execute(SQL_RESET_PRICE_BASIS)
+    await db.execute(SQL_BUMP_BID_VERSION)
+
+async def _read_snapshot(db):
+    async with db.execute(SQL_SNAPSHOT) as cursor:
+        return await cursor.fetchone()
+
+async def _append_state(db, epoch, kind, king, prev_id, purchase_id=None):
+    """Пишет событие-состояние в журнал и делает его текущим (внутри транзакции).
+    king - (price, user_id, photo_id, text, user_link)"""
+    price, user_id, photo_id, text, user_link = king
+    params = (epoch, kind, user_id, price, photo_id, text, user_link, prev_id, purchase_id)
+    async with db.execute(SQL_INSERT_EVENT, params) as cursor:
+        event_id = (await cursor.fetchone())[0]
+    if kind == "purchase":
+        purchase_id = event_id
+        if user_id > 0:
+            await db.execute(SQL_HALL_INSERT, (event_id, epoch, user_id, user_link, price, photo_id, text))
+            await _trim_hall_of_fame(db, epoch)
+    await db.execute(SQL_SET_SNAPSHOT, (epoch, event_id, prev_id, purchase_id, *king))
+    return event_id
+
+async def _trim_hall_of_fame(db, epoch):
+    await db.execute(SQL_HALL_TRIM, (epoch, epoch, HALL_OF_FAME_SIZE))
+
+async def _read_state_event(db, event_id):
+    """Событие-состояние по id: из журнала, а если его уже архивировали - из архива"""
+    async with db.execute(SQL_STATE_EVENT, (event_id,)) as cursor:
+        row = await cursor.fetchone()
+    if row is None and archived_event_reader is not None:
+        row = await archived_event_reader(db, event_id)
+    return row
+
+async def _read_current_state(db):
+    """Перечитывает текущую запись внутри транзакции (кэш обновляем уже после COMMIT)"""
+    async with db.execute(SQL_CURRENT_STATE) as cursor:
+        return _state_from_row(await cursor.fetchone())
+
+def _get_sync_conn():
+    """Соединение sqlite3 для синхронного кода (одно на поток)"""
+    conn = getattr(_sync_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_NAME, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        _sync_local.conn = conn
+    return conn
+
 async def init_db():
-    """Создает таблицы, если их нет, и добавляет первую запись"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    """Создает таблицы, если их нет, и начальное состояние"""
+    async with transaction() as db:
+        # Журнал событий игры: строки только добавляются
         await db.execute("""
-            CREATE TABLE IF NOT EXISTS game_state (
+            CREATE TABLE IF NOT EXISTS game_events (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                epoch INTEGER NOT NULL,
+                kind TEXT NOT NULL,
                 user_id INTEGER,
-                current_price INTEGER,
+                price INTEGER,
                 photo_id TEXT,
                 text TEXT,
                 user_link TEXT,
+                prev_id INTEGER,
+                purchase_id INTEGER,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
         
+        # Снимок текущего состояния: всегда одна строка
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS game_snapshot (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                epoch INTEGER NOT NULL,
+                head_id INTEGER,
+                prev_id INTEGER,
+                purchase_id INTEGER,
+                current_price INTEGER,
+                user_id INTEGER,
+                photo_id TEXT,
+                text TEXT,
+                user_link TEXT
+            )
+        """)
+        
         # Таблица для блокировки пользователей
         await db.execute("""
             CREATE TABLE IF NOT EXISTS blocked_users (
@@ -27,181 +397,294 @@ async def init_db():
             )
         """)
         
-        # Создаем индексы для быстрого поиска
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_price ON game_state(current_price DESC)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_user ON game_state(user_id)")
+        # Служебные счетчики (версия состояния для кэшей)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS game_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        """)
+        await db.execute("INSERT OR IGNORE INTO game_meta (key, value) VALUES ('state_version', 0)")
+        await db.execute("INSERT OR IGNORE INTO game_meta (key, value) VALUES ('blocklist_version', 0)")
+        await db.execute("INSERT OR IGNORE INTO game_meta (key, value) VALUES ('bid_version', 0)")
         
-        # Проверяем, есть ли хоть одна запись. Если нет - создаем "нулевого царя"
-        async with db.execute("SELECT COUNT(*) FROM game_state") as cursor:
-            count = await cursor.fetchone()
-            if count[0] == 0:
-                print("Database empty, creating initial entry...")
-                await db.execute("""
-                    INSERT INTO game_state (user_id, current_price, photo_id, text, user_link)
-                    VALUES (0, 1, '', 'Throne awaits its first ruler', '')
-                """)
-        await db.commit()
+        # Индексы журнала (частичные - только то, что читают Hall of Fame, история и откат)
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_hall_of_fame_events ON game_events(epoch, price DESC, id)
+            WHERE kind = 'purchase' AND user_id > 0
+        """)
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_purchases ON game_events(epoch, id)
+            WHERE kind = 'purchase' AND user_id > 0
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_rollbacks ON game_events(purchase_id) WHERE kind = 'rollback'")
+        
+        # Лучшие покупки эпохи (копия из журнала: покупки старше горизонта архива уходят из game_events)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS hall_of_fame (
+                id INTEGER PRIMARY KEY,
+                epoch INTEGER NOT NULL,
+                user_id INTEGER,
+                user_link TEXT,
+                price INTEGER,
+                photo_id TEXT,
+                text TEXT
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_hall_of_fame ON hall_of_fame(epoch, price DESC, id)")
+        
+        await db.execute("INSERT OR IGNORE INTO game_snapshot (id, epoch) VALUES (1, 0)")
+        snapshot = await _read_snapshot(db)
+        if snapshot[1] is None:
+            await _init_snapshot(db)
+        async with db.execute("SELECT 1 FROM hall_of_fame LIMIT 1") as cursor:
+            if await cursor.fetchone() is None:
+                # База старой схемы: покупки текущей эпохи еще все в журнале
+                await db.execute(SQL_HALL_REFILL, (HALL_OF_FAME_SIZE,))
+        
+        # Цена, от которой считается следующая покупка (для старых баз - цена текущего царя)
+        await db.execute("""
+            INSERT OR IGNORE INTO game_meta (key, value)
+            VALUES ('price_basis', (SELECT current_price FROM game_snapshot WHERE id = 1))
+        """)
+
+async def _init_snapshot(db):
+    """Первое заполнение снимка: из истории старой таблицы game_state или нулевой царь"""
+    async with db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'game_state'") as cursor:
+        legacy = await cursor.fetchone() is not None
+    if legacy:
+        async with db.execute(SQL_IMPORT_LEGACY_HISTORY) as cursor:
+            print(f"Imported {cursor.rowcount} entries from game_state into game_events")
+    async with db.execute("SELECT MAX(id) FROM game_events") as cursor:
+        head_id = (await cursor.fetchone())[0]
+    if head_id is None:
+        print("Database empty, creating initial entry...")
+        await _append_state(db, 0, "reset", INITIAL_KING, None)
+        return
+    async with db.execute(SQL_STATE_EVENT, (head_id,)) as cursor:
+        price, user_id, photo_id, text, user_link, prev_id, purchase_id = await cursor.fetchone()
+    await db.execute(SQL_SET_SNAPSHOT, (0, head_id, prev_id, purchase_id, price, user_id, photo_id, text, user_link))
+
+@metrics.timed(DB_CALL_SECONDS)
+async def get_versioned_state():
+    """(version, state): текущая запись игры и версия, к которой она относится"""
+    entry = state_cache.get_versioned()
+    if entry is None:
+        db = await get_db()
+        async with db.execute(SQL_STATE_VERSION) as cursor:
+            version = (await cursor.fetchone())[0]
+        state = state_cache.revalidate(version)
+        if state is None:
+            async with db.execute(SQL_CURRENT_STATE) as cursor:
+                state = _state_from_row(await cursor.fetchone())
+            state_cache.store(version, state)
+        entry = version, state
+    return entry
+
+async def get_current_state():
+    """Текущая запись игры словарем (как get_game_state_sync)"""
+    return (await get_versioned_state())[1]
 
 async def get_game_state():
     """Возвращает последнюю (актуальную) запись игры"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT current_price, user_id, photo_id, text, user_link FROM game_state ORDER BY id DESC LIMIT 1") as cursor:
-            row = await cursor.fetchone()
-            if row:
-                return row
-            return (1, 0, "", "", "")
+    return _state_as_tuple(await get_current_state())
+
+@metrics.timed(DB_CALL_SECONDS)
+async def get_state_version():
+    """Текущая версия состояния игры (меняется при каждой записи)"""
+    db = await get_db()
+    async with db.execute(SQL_STATE_VERSION) as cursor:
+        return (await cursor.fetchone())[0]
 
+@metrics.timed(DB_CALL_SECONDS)
+async def check_state_version(known_version):
+    """(version, state), если версия в БД отличается от known_version, иначе None.
+    Один запрос по первичному ключу - для фонового наблюдателя за изменениями из других процессов"""
+    version = await get_state_version()
+    if version == known_version:
+        return None
+    state = state_cache.revalidate(version)
+    if state is None:
+        db = await get_db()
+        async with db.execute(SQL_CURRENT_STATE) as cursor:
+            state = _state_from_row(await cursor.fetchone())
+        state_cache.store(version, state)
+    return version, state
+
+async def _append_purchase(db, user_id, photo_id, text, user_link, new_price):
+    """Делает покупателя царем внутри открытой транзакции; возвращает (версия, состояние) для _state_changed"""
+    epoch, head_id = (await _read_snapshot(db))[:2]
+    await _append_state(db, epoch, "purchase", (new_price, user_id, photo_id, text, user_link), head_id)
+    # Следующая цена - от нового царя. bid_version не меняем: счета по старой цене
+    # не пройдут проверку суммы в bid_engine, а MAX не снизит цену, поднятую другой оплатой
+    await db.execute(SQL_RAISE_PRICE_BASIS, (new_price,))
+    version = await _bump_state_version(db)
+    return version, await _read_current_state(db)
+
+@metrics.timed(DB_CALL_SECONDS)
 async def update_game_state(user_id, photo_id, text, user_link, new_price):
-    """Добавляет нового Царя в историю"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
-            INSERT INTO game_state (user_id, current_price, photo_id, text, user_link)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, new_price, photo_id, text, user_link))
-        await db.commit()
+    """Добавляет нового Царя в историю (без проверки заявки; покупки из бота идут через bid_engine.crown)"""
+    async with transaction() as db:
+        version, state = await _append_purchase(db, user_id, photo_id, text, user_link, new_price)
+    _state_changed(version, state)
 
-async def get_hall_of_fame(limit=10):
-    """Возвращает топ-10 самых дорогих покупок с фото и текстом"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("""
-            SELECT user_id, user_link, current_price, photo_id, text
-            FROM game_state
-            WHERE user_id > 0
-            ORDER BY current_price DESC
-            LIMIT ?
-        """, (limit,)) as cursor:
-            rows = await cursor.fetchall()
-            return [
-                {
-                    "user_id": row[0],
-                    "user_link": row[1],
-                    "price": row[2],
-                    "photo_id": row[3],
-                    "text": row[4]
-                }
-                for row in rows
-            ]
+def encode_hall_cursor(entry):
+    """Курсор следующей страницы Hall of Fame по последней записи страницы"""
+    return f"{entry['price']}_{entry['id']}"
 
-# Синхронные версии для Flask (т.к. Flask не async)
-def get_game_state_sync():
-    """Синхронная версия get_game_state для Flask"""
-    import sqlite3
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT current_price, user_id, photo_id, text, user_link FROM game_state ORDER BY id DESC LIMIT 1")
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        return {
-            "current_price": row[0],
-            "user_id": row[1],
-            "photo_id": row[2],
-            "text": row[3],
-            "user_link": row[4]
-        }
-    return {"current_price": 1, "user_id": 0, "photo_id": "", "text": "", "user_link": ""}
+def _hall_of_fame_query(limit, cursor):
+    """Выбирает SQL и параметры для страницы Hall of Fame (ValueError при битом курсоре)"""
+    limit = max(1, min(int(limit), HALL_OF_FAME_MAX_LIMIT))
+    if not cursor:
+        return SQL_HALL_OF_FAME, (limit,)
+    price, entry_id = (int(part) for part in cursor.split("_", 1))
+    return SQL_HALL_OF_FAME_AFTER, (price, price, entry_id, limit)
 
-def get_hall_of_fame_sync(limit=10):
-    """Синхронная версия get_hall_of_fame для Flask с фото и текстом"""
-    import sqlite3
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT user_id, user_link, current_price, photo_id, text
-        FROM game_state
-        WHERE user_id > 0
-        ORDER BY current_price DESC
-        LIMIT ?
-    """, (limit,))
-    rows = cursor.fetchall()
-    conn.close()
+def _hall_of_fame_entries(rows):
     return [
         {
-            "user_id": row[0],
-            "user_link": row[1],
-            "price": row[2],
-            "photo_id": row[3],
-            "text": row[4]
+            "id": row[0],
+            "user_id": row[1],
+            "user_link": row[2],
+            "price": row[3],
+            "photo_id": row[4],
+            "text": row[5]
         }
         for row in rows
     ]
 
+@metrics.timed(DB_CALL_SECONDS)
+async def get_hall_of_fame(limit=10, cursor=None):
+    """Возвращает топ самых дорогих покупок с фото и текстом (страница после cursor)"""
+    db = await get_db()
+    rows = await db.execute_fetchall(*_hall_of_fame_query(limit, cursor))
+    return _hall_of_fame_entries(rows)
+
+# Синхронные версии для Flask (т.к. Flask не async)
+@metrics.timed(DB_CALL_SECONDS)
+def get_versioned_state_sync():
+    """Синхронная версия get_versioned_state для Flask"""
+    entry = state_cache.get_versioned()
+    if entry is None:
+        conn = _get_sync_conn()
+        version = conn.execute(SQL_STATE_VERSION).fetchone()[0]
+        state = state_cache.revalidate(version)
+        if state is None:
+            state = _state_from_row(conn.execute(SQL_CURRENT_STATE).fetchone())
+            state_cache.store(version, state)
+        entry = version, state
+    return entry
+
+def get_game_state_sync():
+    """Синхронная версия get_game_state для Flask"""
+    return get_versioned_state_sync()[1]
+
+@metrics.timed(DB_CALL_SECONDS)
+def get_hall_of_fame_sync(limit=10, cursor=None):
+    """Синхронная версия get_hall_of_fame для Flask с фото и текстом"""
+    rows = _get_sync_conn().execute(*_hall_of_fame_query(limit, cursor)).fetchall()
+    return _hall_of_fame_entries(rows)
+
 # ============ ADMIN FUNCTIONS ============
 
+@metrics.timed(DB_CALL_SECONDS)
 async def rollback_last_entry():
-    """Удаляет последнюю запись (откат)"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Проверяем, есть ли больше одной записи
-        async with db.execute("SELECT COUNT(*) FROM game_state") as cursor:
-            count = await cursor.fetchone()
-            if count[0] <= 1:
-                return False  # Нельзя удалить последнюю (начальную) запись
+    """Откатывает последнюю покупку: событие rollback и возврат к предыдущему состоянию"""
+    async with transaction() as db:
+        epoch, head_id, prev_id, purchase_id = (await _read_snapshot(db))[:4]
+        if purchase_id is None or prev_id is None:
+            return False  # Нельзя откатить начальную запись (и то, что было до сброса)
         
-        # Удаляем последнюю запись
-        await db.execute("DELETE FROM game_state WHERE id = (SELECT MAX(id) FROM game_state)")
-        await db.commit()
-        return True
-
-async def get_history(limit=10):
-    """Возвращает последние N записей для админа"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("""
-            SELECT id, user_id, user_link, current_price, text, created_at
-            FROM game_state
-            ORDER BY id DESC
-            LIMIT ?
-        """, (limit,)) as cursor:
-            rows = await cursor.fetchall()
-            return [
-                {
-                    "id": row[0],
-                    "user_id": row[1],
-                    "user_link": row[2],
-                    "price": row[3],
-                    "text": row[4],
-                    "created_at": row[5]
-                }
-                for row in rows
-            ]
+        row = await _read_state_event(db, prev_id)
+        if row is None:
+            return False  # Предыдущее состояние уже выгружено из базы в файл архива
+        price, user_id, photo_id, text, user_link, prev_prev_id, prev_purchase_id = row
+        await db.execute(SQL_INSERT_EVENT, (epoch, "rollback", None, price, None, None, None, head_id, purchase_id))
+        await db.execute(SQL_SET_SNAPSHOT, (
+            epoch, prev_id, prev_prev_id, prev_purchase_id, price, user_id, photo_id, text, user_link
+        ))
+        # Освободившееся место занимает лучшая из вытесненных покупок, если она еще в журнале
+        await db.execute("DELETE FROM hall_of_fame WHERE id = ?", (purchase_id,))
+        async with db.execute(SQL_HALL_LAST, (epoch,)) as cursor:
+            last = await cursor.fetchone()
+        if last is None:
+            await db.execute(SQL_HALL_REFILL, (HALL_OF_FAME_SIZE,))
+        else:
+            await db.execute(SQL_HALL_REFILL_NEXT, (last[0], last[0], last[1]))
+        await _reset_price_basis(db)
+        version = await _bump_state_version(db)
+        state = await _read_current_state(db)
+    _state_changed(version, state)
+    return True
+
+@metrics.timed(DB_CALL_SECONDS)
+async def load_blocklist():
+    """Загружает blocked_users в память (при старте и при смене blocklist_version)"""
+    global _blocklist_version
+    db = await get_db()
+    async with db.execute(SQL_BLOCKLIST_VERSION) as cursor:
+        version = await cursor.fetchone()
+    rows = await db.execute_fetchall("SELECT user_id FROM blocked_users")
+    blocked_user_ids.clear()
+    blocked_user_ids.update(row[0] for row in rows)
+    _blocklist_version = version[0] if version else 0
+    return len(blocked_user_ids)
+
+@metrics.timed(DB_CALL_SECONDS)
+async def refresh_blocklist():
+    """Перечитывает блоклист, если его изменил другой процесс. True, если перечитали"""
+    db = await get_db()
+    async with db.execute(SQL_BLOCKLIST_VERSION) as cursor:
+        row = await cursor.fetchone()
+    if row is None or row[0] == _blocklist_version:
+        return False
+    await load_blocklist()
+    return True
 
 async def block_user(user_id: int, reason: str = "Admin action"):
-    """Блокирует пользователя"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
-            INSERT OR REPLACE INTO blocked_users (user_id, reason)
-            VALUES (?, ?)
-        """, (user_id, reason))
-        await db.commit()
+    """Блокирует пользователя (запись в БД и в память)"""
+    await block_users([user_id], reason)
+
+@metrics.timed(DB_CALL_SECONDS)
+async def block_users(user_ids, reason: str = "Bulk import") -> int:
+    """Блокирует пачку пользователей одной транзакцией. Возвращает число новых блокировок"""
+    user_ids = set(user_ids)
+    async with transaction() as db:
+        await db.executemany(SQL_BLOCK_USER, [(user_id, reason) for user_id in user_ids])
+        await db.execute(SQL_BUMP_BLOCKLIST_VERSION)
+    added = len(user_ids - blocked_user_ids)
+    blocked_user_ids.update(user_ids)
+    for listener in blocklist_listeners:
+        listener()
+    return added
 
-async def is_user_blocked(user_id: int) -> bool:
-    """Проверяет, заблокирован ли пользователь"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT user_id FROM blocked_users WHERE user_id = ?", (user_id,)) as cursor:
-            result = await cursor.fetchone()
-            return result is not None
+def is_user_blocked(user_id: int) -> bool:
+    """Проверяет, заблокирован ли пользователь (только память, без I/O)"""
+    return user_id in blocked_user_ids
 
+@metrics.timed(DB_CALL_SECONDS)
 async def reset_database():
-    """Очищает базу данных и создает начальную запись"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Удаляем все записи кроме блокировок
-        await db.execute("DELETE FROM game_state")
-        
-        # Создаем начальную запись
-        await db.execute("""
-            INSERT INTO game_state (user_id, current_price, photo_id, text, user_link)
-            VALUES (0, 1, '', 'Throne awaits its first ruler', '')
-        """)
-        
-        await db.commit()
-        print("Database reset complete. Initial entry created.")
+    """Начинает новую эпоху с начальной записью (история остается в журнале)"""
+    async with transaction() as db:
+        epoch = (await _read_snapshot(db))[0]
+        await _append_state(db, epoch + 1, "reset", INITIAL_KING, None)
+        await _trim_hall_of_fame(db, epoch + 1)
+        await _reset_price_basis(db)
+        version = await _bump_state_version(db)
+        state = await _read_current_state(db)
+    _state_changed(version, state)
+    print(f"Database reset complete. Epoch {epoch + 1} started with initial entry.")
 
+@metrics.timed(DB_CALL_SECONDS)
 async def set_base_price(new_price: int):
-    """Обновляет базовую цену для следующей покупки"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Получаем последнюю запись
-        async with db.execute("SELECT id FROM game_state ORDER BY id DESC LIMIT 1") as cursor:
-            row = await cursor.fetchone()
-            if row:
-                # Обновляем current_price для следующего покупателя
-                await db.execute("UPDATE game_state SET current_price = ? WHERE id = ?", (new_price, row[0]))
-                await db.commit()
+    """Обновляет базовую цену для следующей покупки (событие price_override вместо правки истории)"""
+    async with transaction() as db:
+        epoch, _, prev_id, purchase_id, _, user_id, photo_id, text, user_link = await _read_snapshot(db)
+        # Правка заменяет текущее состояние: откат после нее вернет то, что было до покупки
+        await _append_state(
+            db, epoch, "price_override", (new_price, user_id, photo_id, text, user_link), prev_id, purchase_id
+        )
+        await _reset_price_basis(db)
+        version = await _bump_state_version(db)
+        state = await _read_current_state(db)
+    _state_changed(version, state)
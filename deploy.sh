@@ -63,18 +63,24 @@ Type=simple
 User=theone
 WorkingDirectory=/opt/the_worlds_frame
 Environment="PATH=/opt/the_worlds_frame/venv/bin"
+# Webhook-режим (нужен HTTPS, см. certbot ниже): раскомментируйте и задайте WEBHOOK_URL/WEBHOOK_SECRET в .env
+# Environment="BOT_MODE=webhook"
+# Environment="BOT_WORKERS=2"
 ExecStart=/opt/the_worlds_frame/venv/bin/python bot.py
 Restart=always
 RestartSec=10
+# SIGTERM получает только главный процесс и сам передает его воркерам, те дорабатывают текущие обновления
+KillMode=mixed
+TimeoutStopSec=40
 
 [Install]
 WantedBy=multi-user.target
 EOF
 
-# Flask service
+# Web App service (aiohttp; Flask-версия: gunicorn --workers 2 --bind 127.0.0.1:5000 webapp:app)
 sudo tee /etc/systemd/system/theone-webapp.service > /dev/null <<EOF
 [Unit]
-Description=The World's Frame - Flask Web App
+Description=The World's Frame - Web App
 After=network.target
 
 [Service]
@@ -82,7 +88,9 @@ Type=simple
 User=theone
 WorkingDirectory=/opt/the_worlds_frame
 Environment="PATH=/opt/the_worlds_frame/venv/bin"
-ExecStart=/opt/the_worlds_frame/venv/bin/gunicorn --workers 2 --bind 127.0.0.1:5000 webapp:app
+Environment="WEBAPP_HOST=127.0.0.1"
+Environment="WEBAPP_PORT=5000"
+ExecStart=/opt/the_worlds_frame/venv/bin/python webapp_async.py
 Restart=always
 RestartSec=10
 
@@ -97,6 +105,9 @@ sudo -u theone /opt/the_worlds_frame/venv/bin/pip install gunicorn
 # 10. Настройка Nginx
 echo "🌐 Configuring Nginx..."
 sudo tee /etc/nginx/sites-available/theone > /dev/null <<'EOF'
+# Кэш готовых ответов /api/current и /api/hall-of-fame (snapshots.py)
+proxy_cache_path /var/cache/nginx/theone_api levels=1:2 keys_zone=theone_api:10m max_size=100m inactive=10m;
+
 server {
     listen 80;
     server_name _;
@@ -112,6 +123,41 @@ server {
         add_header Access-Control-Allow-Origin *;
     }
 
+    # Опросы Mini App: nginx отдает ответ из кэша, пока не истек Cache-Control (SNAPSHOT_MAX_AGE),
+    # за обновлением ходит один запрос, остальные тем временем получают предыдущий ответ
+    location ~ ^/api/(current|hall-of-fame)$ {
+        proxy_pass http://127.0.0.1:5000;
+        proxy_set_header Host \$host;
+        proxy_set_header X-Real-IP \$remote_addr;
+        proxy_cache theone_api;
+        proxy_cache_key \$uri\$is_args\$args;
+        proxy_cache_lock on;
+        proxy_cache_use_stale updating error timeout;
+        proxy_cache_background_update on;
+        proxy_cache_revalidate on;
+        add_header X-Cache-Status \$upstream_cache_status;
+    }
+
+    # Поток живых обновлений (SSE): без буферизации и с долгим таймаутом
+    location /api/stream {
+        proxy_pass http://127.0.0.1:5000;
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
+        proxy_set_header X-Real-IP \$remote_addr;
+        proxy_buffering off;
+        proxy_cache off;
+        proxy_read_timeout 1h;
+    }
+
+    # Обновления Telegram для bot.py в режиме BOT_MODE=webhook
+    location /webhook {
+        proxy_pass http://127.0.0.1:8080;
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
+        proxy_set_header X-Real-IP \$remote_addr;
+        proxy_read_timeout 60s;
+    }
+
     location /static {
         alias /opt/the_worlds_frame/static;
         expires 30d;
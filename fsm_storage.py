@@ -0,0 +1,210 @@
+"""
+FSM-хранилище aiogram в общей базе SQLite.
+
+Состояние диалога (GameStates.waiting_for_photo, paid_amount и т.д.) лежит
+в таблице fsm_state, поэтому его видят все процессы бота, работающие с
+одной базой (несколько воркеров webhook), и оно переживает перезапуск.
+
+FSM читается на каждом обновлении, поэтому записи держатся в LRU-кэше
+процесса. Когда PRAGMA data_version показывает чужой коммит (проверка не
+чаще раза в FSM_CACHE_REVALIDATE сек), одним запросом по updated_at
+перечитываются только ключи, измененные с прошлой проверки. Очистка
+состояния пишется пустой записью (она удаляется через FSM_TOMBSTONE_TTL),
+чтобы другие процессы ее тоже увидели.
+Смена состояния (после оплаты - waiting_for_photo вместе с paid_amount)
+пишется в базу до возврата из set_state: падение процесса не должно терять
+оплаченный слот. Остальные изменения данных копятся FSM_FLUSH_INTERVAL сек и
+пишутся одной транзакцией; состояния, не менявшиеся FSM_STATE_TTL сек
+(брошенные диалоги), удаляются.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+from database import get_db, transaction
+
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(30 * 24 * 3600)))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.05"))
+FSM_CACHE_REVALIDATE = 0.02
+FSM_CACHE_SIZE = 10000
+FSM_CLEANUP_INTERVAL = 3600
+FSM_TOMBSTONE_TTL = 2 * FSM_CLEANUP_INTERVAL
+# Запас на запись, чья метка updated_at поставлена чуть раньше коммита
+FSM_SYNC_MARGIN = 0.1
+
+SQL_GET_FSM = "SELECT state, data FROM fsm_state WHERE key = ?"
+SQL_UPSERT_FSM = """
+    INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+"""
+SQL_CHANGED_FSM = "SELECT key, state, data FROM fsm_state WHERE updated_at >= ?"
+SQL_DELETE_EXPIRED_FSM = "DELETE FROM fsm_state WHERE updated_at < ?"
+# Пустые записи (после state.clear()) нужны, только пока их не увидели другие процессы
+SQL_DELETE_TOMBSTONES = "DELETE FROM fsm_state WHERE state IS NULL AND data = '{}' AND updated_at < ?"
+
+EMPTY = (None, {})
+
+
+async def init_fsm_storage():
+    """Создает таблицу состояний FSM и удаляет просроченные"""
+    async with transaction() as db:
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_state (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                updated_at REAL NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm_state(updated_at)")
+        await db.execute(SQL_DELETE_EXPIRED_FSM, (time.time() - FSM_STATE_TTL,))
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM на общем соединении database.py: кэш чтения + пакетная запись"""
+
+    def __init__(self, key_builder=None, flush_interval=FSM_FLUSH_INTERVAL, cache_size=FSM_CACHE_SIZE):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        # key -> (state, data)
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._flushing = {}
+        self._flusher = None
+        self._data_version = None
+        self._checked_at = 0.0
+        self._synced_at = 0.0
+        self._cleaned_at = time.monotonic()
+
+    async def _revalidate(self):
+        """Обновляет в кэше ключи, которые с прошлой проверки менял другой процесс"""
+        now = time.monotonic()
+        if now - self._checked_at < FSM_CACHE_REVALIDATE:
+            return
+        self._checked_at = now
+        db = await get_db()
+        async with db.execute("PRAGMA data_version") as cursor:
+            (version,) = await cursor.fetchone()
+        if version == self._data_version:
+            return
+        synced_at = time.time()
+        if self._data_version is not None:
+            if synced_at - self._synced_at > FSM_TOMBSTONE_TTL:
+                # Пустые записи того времени уже удалены - какие ключи очищены, не узнать
+                self._cache.clear()
+            else:
+                rows = await db.execute_fetchall(SQL_CHANGED_FSM, (self._synced_at - FSM_SYNC_MARGIN,))
+                for storage_key, state, data in rows:
+                    if storage_key in self._cache:
+                        self._cache[storage_key] = (state, json.loads(data)) if state is not None or data != "{}" else EMPTY
+        self._data_version = version
+        self._synced_at = synced_at
+
+    def _remember(self, storage_key, entry):
+        self._cache[storage_key] = entry
+        self._cache.move_to_end(storage_key)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _entry(self, key):
+        storage_key = self.key_builder.build(key)
+        # Еще не записанное в базу - самое свежее
+        entry = self._dirty.get(storage_key) or self._flushing.get(storage_key)
+        if entry is not None:
+            return storage_key, entry
+        await self._revalidate()
+        entry = self._cache.get(storage_key)
+        if entry is not None:
+            self._cache.move_to_end(storage_key)
+            return storage_key, entry
+        db = await get_db()
+        async with db.execute(SQL_GET_FSM, (storage_key,)) as cursor:
+            row = await cursor.fetchone()
+        entry = (row[0], json.loads(row[1])) if row else EMPTY
+        self._remember(storage_key, entry)
+        return storage_key, entry
+
+    def _write(self, storage_key, entry):
+        self._dirty[storage_key] = entry
+        self._remember(storage_key, entry)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self, raise_errors=False):
+        """Пишет накопленные изменения одной транзакцией. При ошибке они остаются в очереди
+        на повтор; с raise_errors ошибка еще и передается вызывающему"""
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        # Запись фоновой пачки может еще идти: ее ключи остаются видны до коммита
+        self._flushing.update(batch)
+        cleanup = time.monotonic() - self._cleaned_at > FSM_CLEANUP_INTERVAL
+        try:
+            async with transaction() as db:
+                # Метка времени - уже под блокировкой записи, перед самым коммитом (см. FSM_SYNC_MARGIN)
+                now = time.time()
+                await db.executemany(SQL_UPSERT_FSM, [
+                    (storage_key, state, json.dumps(data), now) for storage_key, (state, data) in batch.items()
+                ])
+                if cleanup:
+                    await db.execute(SQL_DELETE_EXPIRED_FSM, (now - FSM_STATE_TTL,))
+                    await db.execute(SQL_DELETE_TOMBSTONES, (now - FSM_TOMBSTONE_TTL,))
+        except Exception as e:
+            logging.warning(f"FSM flush failed, will retry: {e}")
+            # Не теряем изменения: более новые записи того же ключа важнее
+            for storage_key, entry in batch.items():
+                self._dirty.setdefault(storage_key, entry)
+            if self._flusher is None or self._flusher.done() or self._flusher is asyncio.current_task():
+                self._flusher = asyncio.create_task(self._flush_later())
+            if raise_errors:
+                raise
+        else:
+            if cleanup:
+                self._cleaned_at = time.monotonic()
+                self._cache.clear()
+        finally:
+            for storage_key, entry in batch.items():
+                if self._flushing.get(storage_key) is entry:
+                    del self._flushing[storage_key]
+
+    async def set_state(self, key, state=None):
+        value = state.state if isinstance(state, State) else state
+        storage_key, (_, data) = await self._entry(key)
+        self._write(storage_key, (value, data))
+        # Состояние пишем сразу, вместе с накопленными данными (paid_amount): транзакции
+        # идут по очереди, так что более ранняя фоновая пачка не перезапишет эту.
+        # Не записалось - обработчик должен узнать об этом, а не считать слот сохраненным
+        await self.flush(raise_errors=True)
+
+    async def get_state(self, key):
+        _, (state, _) = await self._entry(key)
+        return state
+
+    async def set_data(self, key, data):
+        storage_key, (state, _) = await self._entry(key)
+        self._write(storage_key, (state, data.copy()))
+
+    async def get_data(self, key):
+        _, (_, data) = await self._entry(key)
+        return data.copy()
+
+    async def close(self):
+        """Дописывает отложенные изменения (вызывать до database.close_db())"""
+        flusher = self._flusher
+        if flusher is not None and not flusher.done():
+            if self._flushing:
+                await flusher  # запись уже идет - дожидаемся, а не обрываем транзакцию
+            else:
+                flusher.cancel()
+        await self.flush()
@@ -0,0 +1,11 @@
+"""
+Настройки gunicorn для webapp.py (gunicorn подхватывает файл из текущего каталога).
+
+Запуск: gunicorn --workers 2 --bind 127.0.0.1:5000 webapp:app
+"""
+import metrics
+
+
+def post_fork(server, worker):
+    # С --preload webapp импортирован в мастере: после fork метрики воркера включаем заново
+    metrics.start("web")
@@ -0,0 +1,77 @@
+"""
+Живые обновления для Mini App (Server-Sent Events).
+
+Один Broadcaster на процесс: клиенты ждут общего asyncio.Event и при его
+срабатывании получают уже сериализованное последнее событие, так что тысячи
+простаивающих соединений почти ничего не стоят. Изменения, сделанные в этом
+процессе, приходят через database.state_listeners сразу; изменения из
+другого процесса (бот пишет, веб читает) ловит один наблюдатель, который раз
+в STREAM_POLL_INTERVAL сверяет state_version - один запрос на процесс, а не
+на клиента.
+"""
+import asyncio
+import json
+import logging
+import os
+
+from database import check_state_version, state_listeners
+from payloads import current_payload
+
+STREAM_POLL_INTERVAL = float(os.getenv("STREAM_POLL_INTERVAL", "1.0"))
+STREAM_HEARTBEAT = 15
+STREAM_MAX_CLIENTS = int(os.getenv("STREAM_MAX_CLIENTS", "10000"))
+
+
+def format_event(version, state):
+    """SSE-сообщение 'state' с данными как в /api/current"""
+    payload = current_payload(state)
+    data = json.dumps({"version": version, "data": payload["data"]}, separators=(",", ":"))
+    return f"id: {version}\nevent: state\ndata: {data}\n\n".encode()
+
+
+class Broadcaster:
+    """Рассылает последнее состояние всем подписчикам"""
+
+    def __init__(self):
+        self.version = None
+        self.message = None
+        self.clients = 0
+        self.closed = False
+        self._changed = asyncio.Event()
+
+    def publish(self, version, state):
+        if self.version is not None and version <= self.version:
+            return
+        self.version = version
+        self.message = format_event(version, state)
+        # Будим всех ожидающих и ставим новое событие для следующего изменения
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def next_change(self):
+        """Событие, которое сработает при следующем изменении (брать до проверки version)"""
+        return self._changed
+
+    def close(self):
+        """Будит всех подписчиков, чтобы они завершили поток (при остановке сервера)"""
+        self.closed = True
+        self._changed.set()
+
+    async def watch(self):
+        """Фоновая задача: следит за изменениями из других процессов"""
+        while True:
+            try:
+                changed = await check_state_version(self.version)
+                if changed is not None:
+                    self.publish(*changed)
+            except Exception as e:
+                logging.warning(f"Live updates watcher error: {e}")
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+
+    def attach(self):
+        """Подписывается на изменения, сделанные в этом же процессе"""
+        state_listeners.append(self.publish)
+
+    def detach(self):
+        if self.publish in state_listeners:
+            state_listeners.remove(self.publish)
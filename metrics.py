@@ -0,0 +1,330 @@
+"""
+Метрики процесса в текстовом формате Prometheus (/metrics).
+
+Счетчики и гистограммы пишутся в словарь в памяти под threading.Lock метрики,
+без I/O: запись стоит около микросекунды. Значения, которые модуль и так
+считает (попадания кэша фото, счетчики throttling), не дублируются, а
+читаются при выдаче через callback().
+
+Раз в METRICS_FLUSH_INTERVAL сек процесс сбрасывает снимок своих метрик в
+METRICS_DIR/the_one_metrics_<сервис>_<pid>.json, и /metrics любого процесса
+сервиса складывает свои метрики со снимками остальных: воркеры gunicorn или
+webhook-воркеры бота видны целиком, какой бы из них ни ответил. Пустой
+METRICS_DIR - только свой процесс.
+"""
+import atexit
+import bisect
+import glob
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+METRICS_DIR = os.getenv("METRICS_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else "")
+METRICS_FLUSH_INTERVAL = 5
+# Если задан, /metrics требует заголовок "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Границы корзин гистограмм задержек, сек
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = {}
+_registry_lock = threading.Lock()
+_service = None
+_flusher_pid = None
+
+
+class Counter:
+    """Монотонный счетчик с метками"""
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+
+class Histogram:
+    """Распределение значений по корзинам buckets (+Inf добавляется сам), плюс сумма"""
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # метки -> [попаданий в каждую корзину (не накопительно)..., в +Inf, сумма]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self):
+        with self._lock:
+            return [[list(labels), list(state)] for labels, state in self._values.items()]
+
+
+class Callback:
+    """Значение, которое читается при выдаче: число или {кортеж меток: число}"""
+
+    def __init__(self, name, help, read, kind="gauge", labels=()):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.kind = kind
+        self.labels = tuple(labels)
+
+    def samples(self):
+        value = self.read()
+        if isinstance(value, dict):
+            return [[list(labels), number] for labels, number in value.items()]
+        return [[[], value]]
+
+
+def _register(metric):
+    with _registry_lock:
+        # Повторная регистрация (перезагрузка модуля) возвращает уже существующую метрику
+        return _registry.setdefault(metric.name, metric)
+
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram(name, help, labels, buckets))
+
+
+def callback(name, help, read, kind="gauge", labels=()):
+    return _register(Callback(name, help, read, kind, labels))
+
+
+def timed(metric, label=None):
+    """Декоратор: время вызова функции (sync или async) в гистограмму с меткой label или именем функции"""
+    def decorator(fn):
+        labels = (label or fn.__name__,)
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def wrapped(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    metric.observe(time.perf_counter() - started, *labels)
+        else:
+            @wraps(fn)
+            def wrapped(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    metric.observe(time.perf_counter() - started, *labels)
+        return wrapped
+    return decorator
+
+
+def authorized(authorization_header):
+    """Можно ли отдать /metrics запросу с таким заголовком Authorization"""
+    return not METRICS_TOKEN or authorization_header == f"Bearer {METRICS_TOKEN}"
+
+
+# ============ СНИМКИ ДРУГИХ ПРОЦЕССОВ ============
+
+def _snapshot():
+    with _registry_lock:
+        metrics = list(_registry.values())
+    families = {}
+    for metric in metrics:
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            logging.warning(f"Metric {metric.name} failed: {e}")
+            continue
+        families[metric.name] = {
+            "kind": metric.kind,
+            "help": metric.help,
+            "labels": list(metric.labels),
+            "buckets": list(getattr(metric, "buckets", ())),
+            "samples": samples,
+        }
+    return families
+
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f"the_one_metrics_{_service}_{pid}.json")
+
+
+def flush():
+    """Записывает снимок метрик процесса (атомарно, через временный файл)"""
+    if not METRICS_DIR or _service is None:
+        return
+    path = _snapshot_path(os.getpid())
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(_snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            logging.warning(f"Metrics flush failed: {e}")
+
+
+def _remove_snapshot():
+    if METRICS_DIR and _service is not None:
+        try:
+            os.remove(_snapshot_path(os.getpid()))
+        except OSError:
+            pass
+
+
+def _start_flusher():
+    global _flusher_pid
+    if not METRICS_DIR or _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_periodically, name="metrics-flush", daemon=True).start()
+
+
+def start(service):
+    """Включает сбор метрик процесса под именем сервиса ("bot", "web").
+    Имя задается один раз: в runtime.py и бот, и веб-сервер считаются сервисом runtime"""
+    global _service
+    if _service is None:
+        _service = service
+    _start_flusher()
+
+
+def _other_snapshots():
+    """Снимки других живых процессов того же сервиса; файлы умерших удаляются"""
+    if not METRICS_DIR or _service is None:
+        return []
+    snapshots = []
+    for path in glob.glob(os.path.join(METRICS_DIR, f"the_one_metrics_{_service}_*.json")):
+        pid = path.rsplit("_", 1)[1][:-len(".json")]
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        except PermissionError:
+            pass
+        try:
+            if time.time() - os.path.getmtime(path) > METRICS_FLUSH_INTERVAL * 6:
+                continue  # процесс завис или pid занят чужим процессом
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _merge(families, other):
+    for name, family in other.items():
+        mine = families.get(name)
+        if mine is None:
+            families[name] = family
+            continue
+        if mine["kind"] != family["kind"] or mine["buckets"] != family["buckets"]:
+            continue
+        values = {tuple(labels): value for labels, value in mine["samples"]}
+        for labels, value in family["samples"]:
+            labels = tuple(labels)
+            if labels not in values:
+                values[labels] = value
+            elif isinstance(value, list):
+                values[labels] = [a + b for a, b in zip(values[labels], value)]
+            else:
+                values[labels] += value
+        mine["samples"] = [[list(labels), value] for labels, value in values.items()]
+
+
+# ============ ВЫДАЧА ============
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_bound(bound):
+    return f"{bound:g}"
+
+
+def render():
+    """Текст для /metrics: метрики процесса плюс снимки остальных процессов сервиса"""
+    families = _snapshot()
+    for other in _other_snapshots():
+        _merge(families, other)
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['kind']}")
+        names = family["labels"]
+        for labels, value in sorted(family["samples"], key=lambda sample: sample[0]):
+            if family["kind"] != "histogram":
+                lines.append(f"{name}{_label_text(names, labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, hits in zip(family["buckets"] + ["+Inf"], value[:-1]):
+                cumulative += hits
+                le = 'le="+Inf"' if bound == "+Inf" else f'le="{_format_bound(bound)}"'
+                lines.append(f"{name}_bucket{_label_text(names, labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{_label_text(names, labels)} {value[-1]}")
+            lines.append(f"{name}_count{_label_text(names, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def _reset_after_fork():
+    """В дочернем процессе fork значения родителя - чужие (иначе render() сложит их дважды).
+    Снимки пишет только процесс, который сам вызвал start(): воркер gunicorn --preload - в
+    post_fork (gunicorn.conf.py), а пул превью и прочие дочерние процессы - никогда"""
+    global _service, _flusher_pid, _registry_lock
+    _service = None
+    _flusher_pid = None
+    # Блокировки могли быть захвачены потоками родителя в момент fork
+    _registry_lock = threading.Lock()
+    for metric in _registry.values():
+        if hasattr(metric, "_values"):
+            metric._lock = threading.Lock()
+            metric._values = {}
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(_remove_snapshot)
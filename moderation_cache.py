@@ -0,0 +1,204 @@
+"""
+Кэш вердиктов AI-модерации.
+
+Ключи - file_unique_id из Telegram (одинаков для повторной отправки того же
+файла) и 64-битный dHash изображения (ловит пересжатые копии). Вердикты
+хранятся в SQLite с TTL, а последние MODERATION_CACHE_MAX_ENTRIES - в памяти
+процесса (LRU, просроченные выбрасываются): повтор отвечается без обращения
+к Gemini. Похожие отказы ищутся по индексу полос dHash, а не перебором.
+"""
+import os
+import time
+from collections import OrderedDict
+from io import BytesIO
+from typing import NamedTuple
+
+from PIL import Image
+
+from database import get_db, transaction
+
+MODERATION_CACHE_TTL = int(os.getenv("MODERATION_CACHE_TTL", str(7 * 24 * 3600)))
+# Максимальное расстояние Хэмминга между dHash, при котором картинки считаем одной и той же (0 - выкл.)
+MODERATION_HASH_DISTANCE = int(os.getenv("MODERATION_HASH_DISTANCE", "4"))
+# Сколько вердиктов держать в памяти (по каждому из ключей)
+MODERATION_CACHE_MAX_ENTRIES = int(os.getenv("MODERATION_CACHE_MAX_ENTRIES", "100000"))
+
+
+class Verdict(NamedTuple):
+    allowed: bool
+    reason: str
+    phash: int
+    created_at: float
+
+
+# LRU: в начале - давно не нужные, там же оказываются и просроченные
+_by_unique_id = OrderedDict()
+_by_hash = OrderedDict()
+
+
+def _band_layout(distance):
+    """dHash режем на distance + 1 полос: (сдвиг, маска) каждой"""
+    if distance <= 0:
+        return []
+    bounds = [64 * i // (distance + 1) for i in range(distance + 2)]
+    return [(low, (1 << (high - low)) - 1) for low, high in zip(bounds, bounds[1:])]
+
+
+# У хэшей на расстоянии не больше MODERATION_HASH_DISTANCE хотя бы одна полоса совпадает
+# целиком, поэтому кандидаты - хэши отказов с общей полосой: {значение полосы: {dHash}}
+_BANDS = _band_layout(MODERATION_HASH_DISTANCE)
+_rejected_by_band = [{} for _ in _BANDS]
+
+
+def dhash(data, hash_size=8):
+    """64-битный difference hash: сравнение соседних пикселей уменьшенной серой копии"""
+    with Image.open(BytesIO(data)) as image:
+        # Для JPEG декодируем сразу в малом масштабе
+        image.draft("L", (hash_size * 8, hash_size * 8))
+        pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR).getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def _to_sql(phash):
+    """SQLite INTEGER знаковый: храним 64 бита как int64"""
+    return phash - (1 << 64) if phash >= (1 << 63) else phash
+
+
+def _from_sql(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def _fresh(verdict, now):
+    return now - verdict.created_at < MODERATION_CACHE_TTL
+
+
+def _band_keys(phash):
+    return [(phash >> shift) & mask for shift, mask in _BANDS]
+
+
+def _drop_hash(phash):
+    verdict = _by_hash.pop(phash)
+    if not verdict.allowed:
+        for band, key in zip(_rejected_by_band, _band_keys(phash)):
+            hashes = band[key]
+            hashes.discard(phash)
+            if not hashes:
+                del band[key]
+
+
+def _lookup(cache, key, now):
+    """Свежий вердикт из LRU (и отметка использования) или None; просроченный выбрасывается"""
+    verdict = cache.get(key)
+    if verdict is None:
+        return None
+    if not _fresh(verdict, now):
+        if cache is _by_hash:
+            _drop_hash(key)
+        else:
+            del cache[key]
+        return None
+    cache.move_to_end(key)
+    return verdict
+
+
+def get(file_unique_id):
+    """Вердикт по file_unique_id: (allowed, reason) или None"""
+    verdict = _lookup(_by_unique_id, file_unique_id, time.time())
+    if verdict is not None:
+        return verdict.allowed, verdict.reason
+    return None
+
+
+def find_similar(phash):
+    """Вердикт для той же или почти той же картинки: (allowed, reason) или None.
+    Совпадение dHash переиспользует любой вердикт, близкое (в пределах MODERATION_HASH_DISTANCE) -
+    только отказ: мелкая правка может добавить запрещенное, но вряд ли уберет его"""
+    now = time.time()
+    verdict = _lookup(_by_hash, phash, now)
+    if verdict is not None:
+        return verdict.allowed, verdict.reason
+    candidates = set()
+    for band, key in zip(_rejected_by_band, _band_keys(phash)):
+        candidates.update(band.get(key, ()))
+    best = None
+    for candidate_hash in candidates:
+        distance = (candidate_hash ^ phash).bit_count()
+        if distance <= MODERATION_HASH_DISTANCE and (best is None or distance < best[0]):
+            candidate = _lookup(_by_hash, candidate_hash, now)
+            if candidate is not None:
+                best = (distance, candidate)
+    if best is None:
+        return None
+    return best[1].allowed, best[1].reason
+
+
+def _remember_in_memory(file_unique_id, verdict, now):
+    _by_unique_id.pop(file_unique_id, None)
+    _by_unique_id[file_unique_id] = verdict
+    if verdict.phash in _by_hash:
+        _drop_hash(verdict.phash)
+    _by_hash[verdict.phash] = verdict
+    if not verdict.allowed:
+        for band, key in zip(_rejected_by_band, _band_keys(verdict.phash)):
+            band.setdefault(key, set()).add(verdict.phash)
+    # Сверх лимита и просроченные - из начала LRU
+    while _by_unique_id:
+        oldest = next(iter(_by_unique_id.values()))
+        if len(_by_unique_id) <= MODERATION_CACHE_MAX_ENTRIES and _fresh(oldest, now):
+            break
+        _by_unique_id.popitem(last=False)
+    while _by_hash:
+        oldest_hash, oldest = next(iter(_by_hash.items()))
+        if len(_by_hash) <= MODERATION_CACHE_MAX_ENTRIES and _fresh(oldest, now):
+            break
+        _drop_hash(oldest_hash)
+
+
+async def remember(file_unique_id, phash, allowed, reason):
+    """Сохраняет окончательный вердикт модерации"""
+    verdict = Verdict(allowed, reason, phash, time.time())
+    async with transaction() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO moderation_verdicts (file_unique_id, phash, allowed, reason, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (file_unique_id, _to_sql(phash), int(allowed), reason, verdict.created_at),
+        )
+    _remember_in_memory(file_unique_id, verdict, verdict.created_at)
+
+
+async def init_moderation_cache():
+    """Создает таблицу, удаляет просроченные вердикты и загружает остальные в память"""
+    cutoff = time.time() - MODERATION_CACHE_TTL
+    async with transaction() as db:
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS moderation_verdicts (
+                file_unique_id TEXT PRIMARY KEY,
+                phash INTEGER NOT NULL,
+                allowed INTEGER NOT NULL,
+                reason TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_moderation_created ON moderation_verdicts(created_at)")
+        await db.execute("DELETE FROM moderation_verdicts WHERE created_at < ?", (cutoff,))
+
+    db = await get_db()
+    # В память - только самые свежие, в порядке от старых к новым
+    rows = await db.execute_fetchall(
+        "SELECT file_unique_id, phash, allowed, reason, created_at FROM moderation_verdicts "
+        "ORDER BY created_at DESC LIMIT ?",
+        (MODERATION_CACHE_MAX_ENTRIES,),
+    )
+    _by_unique_id.clear()
+    _by_hash.clear()
+    for band in _rejected_by_band:
+        band.clear()
+    now = time.time()
+    for file_unique_id, phash, allowed, reason, created_at in reversed(rows):
+        _remember_in_memory(file_unique_id, Verdict(bool(allowed), reason, _from_sql(phash), created_at), now)
+    return len(_by_unique_id)
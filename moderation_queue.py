@@ -0,0 +1,157 @@
+"""
+Очередь AI-модерации с приоритетом по сумме оплаты.
+
+Фото от всех пользователей попадают в одну asyncio.PriorityQueue, которую
+разбирает фиксированный пул воркеров: число одновременных проверок
+ограничено, а покупатели 100x проверяются раньше покупателей 1x (при равной
+сумме - в порядке поступления). Новое фото от того же пользователя вытесняет
+его предыдущее: из очереди оно просто пропускается, а результат уже идущей
+проверки отбрасывается.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import deque
+
+MODERATION_WORKERS = int(os.getenv("MODERATION_WORKERS", os.getenv("MODERATION_CONCURRENCY", "4")))
+# Сколько последних ожиданий учитывать в статистике
+WAIT_SAMPLES = 100
+
+# Результат для вытесненной заявки
+SUPERSEDED = None
+
+
+class Job:
+    """Заявка на модерацию; await job.future -> (allowed, reason) или SUPERSEDED"""
+
+    def __init__(self, seq, user_id, paid_amount, image_bytes, file_unique_id):
+        self.seq = seq
+        self.user_id = user_id
+        self.paid_amount = paid_amount
+        self.image_bytes = image_bytes
+        self.file_unique_id = file_unique_id
+        self.submitted_at = time.monotonic()
+        self.superseded = False
+        self.future = asyncio.get_running_loop().create_future()
+
+    @property
+    def sort_key(self):
+        return (-self.paid_amount, self.seq)
+
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key
+
+
+class ModerationQueue:
+    """Планировщик модерации: приоритетная очередь + пул воркеров"""
+
+    def __init__(self, moderate, workers=MODERATION_WORKERS):
+        self.moderate = moderate
+        self.workers = workers
+        self.processed = 0
+        self.superseded = 0
+        self.in_flight = 0
+        self._queue = None
+        self._tasks = []
+        self._pending = {}
+        self._latest = {}
+        self._seq = itertools.count()
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+
+    def start(self):
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for job in self._pending.values():
+            if not job.future.done():
+                job.future.cancel()
+        self._pending.clear()
+
+    def submit(self, user_id, paid_amount, image_bytes, file_unique_id=None):
+        """Ставит фото в очередь, вытесняя предыдущую заявку этого пользователя"""
+        previous = self._latest.get(user_id)
+        if previous is not None:
+            self._supersede(previous)
+        job = Job(next(self._seq), user_id, paid_amount, image_bytes, file_unique_id)
+        self._latest[user_id] = job
+        self._pending[job.seq] = job
+        self._queue.put_nowait(job)
+        return job
+
+    def position(self, job):
+        """Место заявки в очереди (1 - следующая), 0 - уже проверяется"""
+        if job.seq not in self._pending:
+            return 0
+        return 1 + sum(1 for other in self._pending.values() if other.sort_key < job.sort_key)
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def stats(self):
+        """Глубина очереди и время ожидания (сек) по последним заявкам"""
+        waits = self._waits
+        now = time.monotonic()
+        oldest = min((job.submitted_at for job in self._pending.values()), default=now)
+        return {
+            "depth": self.depth,
+            "in_flight": self.in_flight,
+            "processed": self.processed,
+            "superseded": self.superseded,
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "max_wait": max(waits, default=0.0),
+            "oldest_wait": now - oldest,
+        }
+
+    def _supersede(self, job):
+        job.superseded = True
+        self.superseded += 1
+        # Ждущая в очереди заявка сразу получает ответ; идущая проверка будет отброшена по завершении
+        if self._pending.pop(job.seq, None) is not None:
+            job.image_bytes = None
+            if not job.future.done():
+                job.future.set_result(SUPERSEDED)
+
+    def _finish(self, job, result=None, error=None):
+        if self._latest.get(job.user_id) is job:
+            del self._latest[job.user_id]
+        if job.future.done():
+            return
+        if job.superseded:
+            job.future.set_result(SUPERSEDED)
+        elif error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.superseded or job.future.done():
+                    # Вытеснена или ее ждущий обработчик отменен - Gemini не вызываем
+                    self._pending.pop(job.seq, None)
+                    self._finish(job)
+                    continue
+                del self._pending[job.seq]
+                self._waits.append(time.monotonic() - job.submitted_at)
+                self.in_flight += 1
+                try:
+                    result = await self.moderate(job.image_bytes, file_unique_id=job.file_unique_id)
+                except Exception as e:
+                    logging.warning(f"Moderation failed for user {job.user_id}: {e}")
+                    self._finish(job, error=e)
+                else:
+                    self.processed += 1
+                    self._finish(job, result)
+                finally:
+                    self.in_flight -= 1
+            finally:
+                self._queue.task_done()
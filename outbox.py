@@ -0,0 +1,262 @@
+"""
+Исходящие сообщения бота (посты в канал) через таблицу outbox.
+
+Обработчик только записывает строку в outbox и сразу отвечает пользователю;
+отправляет фоновый OutboxSender. Он забирает строки пачками (аренда на
+OUTBOX_LEASE сек, чтобы воркеры webhook не отправили одно и то же дважды) и
+шлет их через регулятор скорости: общий лимит OUTBOX_RATE в секунду и
+OUTBOX_CHAT_LIMIT в минуту на чат (ограничения Telegram для каналов).
+Ответ 429 ставит на паузу всех отправителей на retry_after (outbox_paused_until
+в game_meta), строки возвращаются в очередь. Сетевые ошибки - повтор с
+экспоненциальной задержкой, ошибки запроса (400/403/404) - сразу failed.
+
+Строки с одинаковым coalesce_key (пост о новом царе) склеиваются: новая
+строка заменяет еще не отправленную старую и уходит не позже, чем через
+OUTBOX_COALESCE_WINDOW сек после первой из серии.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNotFound, TelegramRetryAfter
+
+import metrics
+from database import get_db, transaction
+from ratelimit import RateLimiter
+
+OUTBOX_RATE = int(os.getenv("OUTBOX_RATE", "25"))  # Telegram: ~30 сообщений в секунду на бота
+OUTBOX_CHAT_LIMIT = int(os.getenv("OUTBOX_CHAT_LIMIT", "20"))  # и 20 в минуту в группу/канал
+OUTBOX_COALESCE_WINDOW = float(os.getenv("OUTBOX_COALESCE_WINDOW", "3"))
+OUTBOX_BATCH = 10
+OUTBOX_LEASE = 120  # Сек; строку, застрявшую в sending дольше (упал процесс), заберет другой отправитель
+OUTBOX_POLL_INTERVAL = 5  # Строки, добавленные другими процессами, видим не позже чем через столько сек
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_MAX_BACKOFF = 300
+OUTBOX_RETENTION_DAYS = 7  # Отправленные и замененные строки потом удаляются
+
+METHODS = ("send_photo", "send_message")
+# Ошибки, которые повтором не исправить: неверный запрос, нет прав, нет чата
+PERMANENT_ERRORS = (TelegramBadRequest, TelegramForbiddenError, TelegramNotFound)
+
+SQL_SUPERSEDE = """
+    UPDATE outbox SET status = 'superseded' WHERE coalesce_key = ? AND status = 'pending' RETURNING not_before
+"""
+SQL_INSERT = """
+    INSERT INTO outbox (method, chat_id, params, coalesce_key, created_at, not_before) VALUES (?, ?, ?, ?, ?, ?)
+    RETURNING id
+"""
+SQL_CLAIM_BATCH = """
+    UPDATE outbox SET status = 'sending', locked_until = ?, attempts = attempts + 1
+    WHERE id IN (
+        SELECT id FROM outbox
+        WHERE (status = 'pending' AND not_before <= ?) OR (status = 'sending' AND locked_until < ?)
+        ORDER BY id
+        LIMIT ?
+    )
+    RETURNING id, method, chat_id, params, attempts
+"""
+# Вернуть в очередь; если за это время пришла более новая строка с тем же ключом - она ее заменяет
+SQL_RELEASE = """
+    UPDATE outbox
+    SET status = CASE WHEN coalesce_key IS NOT NULL AND EXISTS (
+            SELECT 1 FROM outbox AS newer
+            WHERE newer.coalesce_key = outbox.coalesce_key AND newer.id > outbox.id AND newer.status = 'pending'
+        ) THEN 'superseded' ELSE 'pending' END,
+        not_before = ?, attempts = attempts - ?, last_error = ?, locked_until = NULL
+    WHERE id = ? AND status = 'sending'
+"""
+SQL_PAUSED_UNTIL = "SELECT value FROM game_meta WHERE key = 'outbox_paused_until'"
+SQL_PAUSE = "UPDATE game_meta SET value = MAX(value, ?) WHERE key = 'outbox_paused_until'"
+SQL_NEXT_DUE = "SELECT MIN(not_before) FROM outbox WHERE status = 'pending'"
+
+OUTBOX_SENDS = metrics.counter("outbox_sends_total", "Outbox send attempts by result", ("method", "result"))
+
+# Отправители этого процесса: enqueue будит их сразу, без ожидания опроса
+_senders = set()
+
+
+async def init_outbox():
+    async with transaction() as db:
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                method TEXT NOT NULL,
+                chat_id TEXT NOT NULL,
+                params TEXT NOT NULL,
+                coalesce_key TEXT,
+                created_at REAL NOT NULL,
+                not_before REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                locked_until REAL,
+                last_error TEXT,
+                sent_at REAL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, not_before)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_coalesce ON outbox(coalesce_key, status)")
+        await db.execute("INSERT OR IGNORE INTO game_meta (key, value) VALUES ('outbox_paused_until', 0)")
+
+
+async def enqueue(method, chat_id, coalesce_key=None, **params):
+    """Ставит вызов bot.<method>(chat_id=..., **params) в очередь; возвращает id строки после коммита"""
+    if method not in METHODS:
+        raise ValueError(f"Unsupported outbox method: {method}")
+    now = time.time()
+    not_before = now + OUTBOX_COALESCE_WINDOW if coalesce_key else now
+    async with transaction() as db:
+        if coalesce_key:
+            superseded = await db.execute_fetchall(SQL_SUPERSEDE, (coalesce_key,))
+            # Срок берем от первой строки серии: при непрерывном потоке пост все равно выйдет
+            not_before = min([not_before] + [row[0] for row in superseded])
+        async with db.execute(
+            SQL_INSERT, (method, str(chat_id), json.dumps(params), coalesce_key, now, not_before)
+        ) as cursor:
+            (row_id,) = await cursor.fetchone()
+    for sender in _senders:
+        sender.wake()
+    return row_id
+
+
+async def get_outbox_stats():
+    """Число строк outbox по статусам"""
+    db = await get_db()
+    rows = await db.execute_fetchall("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+    stats = {"pending": 0, "sending": 0, "sent": 0, "superseded": 0, "failed": 0}
+    stats.update(dict(rows))
+    return stats
+
+
+class OutboxSender:
+    """Фоновая отправка outbox с регулятором скорости; name - общие лимиты для процессов бота"""
+
+    def __init__(self, bot, name=None, rate=OUTBOX_RATE, chat_limit=OUTBOX_CHAT_LIMIT, batch=OUTBOX_BATCH):
+        self.bot = bot
+        self.batch = batch
+        self.everyone = RateLimiter(rate, 1, name=f"{name}_global" if name else None, slots=16, shards=1)
+        self.chats = RateLimiter(chat_limit, 60, name=f"{name}_chats" if name else None, slots=1024, shards=4)
+        self._task = None
+        self._wakeup = None
+        self._cleaned_at = 0
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        _senders.add(self)
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        _senders.discard(self)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                delay = await self.send_due()
+            except Exception as e:
+                logging.warning(f"Outbox sender failed: {e}")
+                delay = OUTBOX_POLL_INTERVAL
+            if delay > 0:
+                # Не wait_for: в 3.11 он теряет cancel(), если событие выставлено в том же такте,
+                # и stop() сразу после enqueue() ждал бы вечно
+                wakeup = asyncio.ensure_future(self._wakeup.wait())
+                try:
+                    await asyncio.wait((wakeup,), timeout=delay)
+                finally:
+                    wakeup.cancel()
+
+    async def send_due(self):
+        """Отправляет одну пачку; возвращает, сколько секунд можно ждать до следующей"""
+        now = time.time()
+        db = await get_db()
+        async with db.execute(SQL_PAUSED_UNTIL) as cursor:
+            (paused_until,) = await cursor.fetchone()
+        if paused_until > now:
+            return paused_until - now
+        async with transaction() as tx:
+            rows = await tx.execute_fetchall(SQL_CLAIM_BATCH, (now + OUTBOX_LEASE, now, now, self.batch))
+        if not rows:
+            await self._cleanup(now)
+            async with db.execute(SQL_NEXT_DUE) as cursor:
+                (next_due,) = await cursor.fetchone()
+            if next_due is None:
+                return OUTBOX_POLL_INTERVAL
+            return min(OUTBOX_POLL_INTERVAL, max(0.0, next_due - now))
+
+        rows = sorted(rows)
+        for i, row in enumerate(rows):
+            retry_after = await self._send(row)
+            if retry_after:
+                # Flood control: вся очередь ждет, остаток пачки возвращаем без траты попыток
+                resume_at = math.ceil(time.time() + retry_after)
+                async with transaction() as db:
+                    await db.execute(SQL_PAUSE, (resume_at,))
+                    await db.executemany(
+                        SQL_RELEASE, [(resume_at, 1, None, rest[0]) for rest in rows[i + 1:]]
+                    )
+                return retry_after
+        return 0
+
+    async def _acquire(self, chat_id):
+        while not self.chats.allow(chat_id):
+            await asyncio.sleep(60 / self.chats.max_requests)
+        while not self.everyone.allow("all"):
+            await asyncio.sleep(1 / self.everyone.max_requests)
+
+    async def _send(self, row):
+        """Отправляет строку и записывает итог; при 429 возвращает retry_after"""
+        row_id, method, chat_id, params, attempts = row
+        await self._acquire(chat_id)
+        try:
+            await getattr(self.bot, method)(chat_id=chat_id, **json.loads(params))
+        except TelegramRetryAfter as e:
+            logging.warning(f"Outbox: flood control, pausing for {e.retry_after}s")
+            OUTBOX_SENDS.inc(method, "flood_control")
+            async with transaction() as db:
+                await db.execute(SQL_RELEASE, (time.time() + e.retry_after, 1, str(e), row_id))
+            return e.retry_after
+        except Exception as e:
+            if isinstance(e, PERMANENT_ERRORS) or attempts >= OUTBOX_MAX_ATTEMPTS:
+                OUTBOX_SENDS.inc(method, "failed")
+                logging.warning(f"Outbox message {row_id} to {chat_id} failed: {e}")
+                async with transaction() as db:
+                    await db.execute(
+                        "UPDATE outbox SET status = 'failed', last_error = ?, locked_until = NULL WHERE id = ?",
+                        (str(e), row_id),
+                    )
+            else:
+                OUTBOX_SENDS.inc(method, "retry")
+                backoff = min(OUTBOX_MAX_BACKOFF, 2 ** attempts)
+                async with transaction() as db:
+                    await db.execute(SQL_RELEASE, (time.time() + backoff, 0, str(e), row_id))
+            return None
+        OUTBOX_SENDS.inc(method, "sent")
+        async with transaction() as db:
+            await db.execute(
+                "UPDATE outbox SET status = 'sent', sent_at = ?, locked_until = NULL WHERE id = ?",
+                (time.time(), row_id),
+            )
+        return None
+
+    async def _cleanup(self, now):
+        if now - self._cleaned_at < 3600:
+            return
+        self._cleaned_at = now
+        async with transaction() as db:
+            await db.execute(
+                "DELETE FROM outbox WHERE status IN ('sent', 'superseded') AND created_at < ?",
+                (now - OUTBOX_RETENTION_DAYS * 86400,),
+            )
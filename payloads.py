@@ -0,0 +1,41 @@
+"""JSON-ответы API, общие для Flask (webapp.py) и aiohttp (webapp_async.py)"""
+from bid_engine import next_base_price
+from database import encode_hall_cursor
+
+# 1 XTR ≈ $0.013
+XTR_TO_USD = 0.013
+
+
+def current_payload(state):
+    """Ответ /api/current по записи текущего короля"""
+    # Следующая цена для покупателя (предыдущая оплата + 10% с округлением вверх)
+    next_price = next_base_price(state['price_basis'])
+    return {
+        "success": True,
+        "data": {
+            "user_id": state['user_id'],
+            "user_link": state['user_link'],
+            "photo_id": state['photo_id'],
+            "text": state['text'],  # Текст пользователя (до 100 символов)
+            "simulated_price": next_price,  # Показываем цену для следующего покупателя
+            "real_payment_price": 1,  # Реальная цена для оплаты (тестовый режим)
+            "usd_estimate": round(next_price * XTR_TO_USD, 2)
+        }
+    }
+
+
+def hall_of_fame_payload(hall, limit):
+    """Ответ /api/hall-of-fame; курсор следующей страницы, если текущая заполнена целиком"""
+    next_cursor = encode_hall_cursor(hall[-1]) if hall and len(hall) == limit else None
+    return {
+        "success": True,
+        "data": hall,
+        "next_cursor": next_cursor
+    }
+
+
+def error_payload(message):
+    return {"success": False, "error": message}
+
+
+RATE_LIMIT_ERROR = error_payload("Rate limit exceeded. Please try again later.")
@@ -0,0 +1,183 @@
+"""
+Кэш фотографий для /api/photo: LRU в памяти + каталог на диске.
+
+Ключ - photo_id (Telegram file_id), файл на диске называется sha256 от ключа.
+Фото по file_id не меняется, поэтому ETag - хэш содержимого, а Last-Modified -
+время записи в кэш. Каталог общий для бота и веб-сервера: бот кладет фото
+нового короля сразу после update_game_state, и Mini App его уже не ждет.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import NamedTuple
+
+import metrics
+
+PHOTO_CACHE_DIR = os.getenv("PHOTO_CACHE_DIR", "photo_cache")
+PHOTO_CACHE_MEMORY_MB = int(os.getenv("PHOTO_CACHE_MEMORY_MB", "64"))
+PHOTO_CACHE_DISK_MB = int(os.getenv("PHOTO_CACHE_DISK_MB", "1024"))
+
+# Фото по file_id неизменно - клиент может держать его сутки
+PHOTO_CACHE_CONTROL = "public, max-age=86400"
+
+
+class CachedPhoto(NamedTuple):
+    data: bytes
+    etag: str
+    last_modified: float
+    content_type: str
+
+
+def _content_type(key):
+    return "image/webp" if key.endswith(".webp") else "image/jpeg"
+
+
+class PhotoCache:
+    """Двухуровневый кэш: горячие фото в памяти, остальные на диске (оба с LRU-вытеснением)"""
+
+    def __init__(self, directory=PHOTO_CACHE_DIR, memory_limit=PHOTO_CACHE_MEMORY_MB << 20,
+                 disk_limit=PHOTO_CACHE_DISK_MB << 20):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk_size = None  # считаем лениво при первой записи
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def get_memory(self, key):
+        """CachedPhoto из памяти или None, без обращения к диску"""
+        with self._lock:
+            photo = self._memory.get(key)
+            if photo is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+            return photo
+
+    def get(self, key):
+        """CachedPhoto из памяти или с диска, либо None"""
+        photo = self.get_memory(key)
+        if photo is not None:
+            return photo
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            stat = os.stat(path)
+            # atime - признак недавнего использования для вытеснения, mtime остается временем записи
+            os.utime(path, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        photo = CachedPhoto(data, _etag(data), stat.st_mtime, _content_type(key))
+        self._remember(key, photo)
+        self.disk_hits += 1
+        return photo
+
+    def put(self, key, data):
+        """Сохраняет фото в памяти и на диске, возвращает CachedPhoto"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)  # атомарно: читатель не увидит половину файла
+
+        photo = CachedPhoto(data, _etag(data), os.stat(path).st_mtime, _content_type(key))
+        self._remember(key, photo)
+        self._account_disk(len(data))
+        return photo
+
+    def _remember(self, key, photo):
+        size = len(photo.data)
+        if size > self.memory_limit:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_size -= len(old.data)
+            self._memory[key] = photo
+            self._memory_size += size
+            while self._memory_size > self.memory_limit:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted.data)
+
+    def _account_disk(self, added):
+        with self._lock:
+            if self._disk_size is None:
+                self._disk_size = sum(entry.stat().st_size for entry in os.scandir(self.directory))
+            else:
+                self._disk_size += added
+            if self._disk_size <= self.disk_limit:
+                return
+            self._disk_size = self._evict_disk()
+
+    def _evict_disk(self):
+        """Удаляет давно не использованные файлы, пока каталог не станет меньше 90% лимита"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        target = self.disk_limit * 9 // 10
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+
+def _etag(data):
+    return '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+
+
+def photo_headers(photo):
+    """Заголовки ответа для закэшированного фото"""
+    return {
+        "Content-Type": photo.content_type,
+        "ETag": photo.etag,
+        "Last-Modified": formatdate(photo.last_modified, usegmt=True),
+        "Cache-Control": PHOTO_CACHE_CONTROL,
+    }
+
+
+def is_not_modified(photo, if_none_match=None, if_modified_since=None):
+    """True, если клиенту можно ответить 304 (If-None-Match важнее If-Modified-Since).
+    If-None-Match сравнивается слабо: W/ перед тегом (его добавляют прокси со сжатием) не мешает"""
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or photo.etag in tags
+    if if_modified_since:
+        try:
+            return int(photo.last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+photo_cache = PhotoCache()
+
+metrics.callback(
+    "photo_cache_lookups_total", "Photo cache lookups by where the photo was found",
+    lambda: {("memory",): photo_cache.hits, ("disk",): photo_cache.disk_hits, ("miss",): photo_cache.misses},
+    kind="counter", labels=("result",),
+)
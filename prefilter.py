@@ -0,0 +1,215 @@
+"""
+Быстрая локальная пред-модерация перед Gemini.
+
+Цепочка дешевых проверок (подпись, известные плохие картинки, битые и
+слишком маленькие файлы), каждая - доли миллисекунды. Первая сработавшая
+отклоняет фото сразу, без очереди и платного запроса к AI. Проверки
+подключаются через PreFilter.add(name, check): check(image_bytes, caption)
+возвращает причину отказа или None.
+Известные плохие картинки (окончательный отказ AI) живут столько же, сколько
+вердикты moderation_cache: MODERATION_CACHE_TTL, в памяти - не больше
+MODERATION_CACHE_MAX_ENTRIES последних (LRU).
+"""
+import hashlib
+import logging
+import os
+import re
+import time
+from collections import Counter, OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+from database import get_db, transaction
+from moderation_cache import MODERATION_CACHE_MAX_ENTRIES, MODERATION_CACHE_TTL
+
+PREFILTER_MIN_SIDE = int(os.getenv("PREFILTER_MIN_SIDE", "100"))
+PREFILTER_MAX_PIXELS = 40_000_000
+
+# Запрещенные слова из промпта модерации; дополнительные - через PREFILTER_EXTRA_TERMS через запятую
+BANNED_TERMS = (
+    "putin", "zelensky", "zelenskyy", "biden", "trump",
+    "hitler", "nazi", "swastika", "heil",
+    "porn", "porno", "nude", "nudes", "onlyfans",
+    "nigger", "nigga", "faggot",
+)
+EXTRA_TERMS = tuple(term.strip().lower() for term in os.getenv("PREFILTER_EXTRA_TERMS", "").split(",") if term.strip())
+
+
+def _trie_pattern(trie):
+    """Регулярное выражение из префиксного дерева: общие префиксы проверяются один раз"""
+    if "" in trie and len(trie) == 1:
+        return ""
+    branches = []
+    optional = False
+    for char, child in sorted(trie.items()):
+        if char == "":
+            optional = True
+            continue
+        branches.append(re.escape(char) + _trie_pattern(child))
+    pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    if optional:
+        pattern = ("(?:" + pattern + ")?") if len(branches) == 1 else pattern + "?"
+    return pattern
+
+
+def compile_terms(terms):
+    """Один скомпилированный автомат для всех слов (целые слова, без учета регистра)"""
+    trie = {}
+    for term in terms:
+        node = trie
+        for char in term.lower():
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return re.compile(r"\b" + _trie_pattern(trie) + r"\b", re.IGNORECASE)
+
+
+_caption_regex = compile_terms(BANNED_TERMS + EXTRA_TERMS)
+# LRU sha256 -> (причина, created_at): в начале - давно не нужные
+_bad_hashes = OrderedDict()
+
+
+def image_digest(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def check_caption(image_bytes, caption):
+    if caption:
+        match = _caption_regex.search(caption)
+        if match:
+            return f"Caption contains a forbidden term: {match.group(0)}"
+    return None
+
+
+def check_bad_hash(image_bytes, caption):
+    digest = image_digest(image_bytes)
+    entry = _bad_hashes.get(digest)
+    if entry is None:
+        return None
+    reason, created_at = entry
+    if time.time() - created_at >= MODERATION_CACHE_TTL:
+        del _bad_hashes[digest]
+        return None
+    _bad_hashes.move_to_end(digest)
+    return reason
+
+
+def _remember_in_memory(digest, reason, created_at, now):
+    _bad_hashes.pop(digest, None)
+    _bad_hashes[digest] = (reason or "Known forbidden image", created_at)
+    # Сверх лимита и просроченные - из начала LRU
+    while _bad_hashes:
+        _, oldest_at = next(iter(_bad_hashes.values()))
+        if len(_bad_hashes) <= MODERATION_CACHE_MAX_ENTRIES and now - oldest_at < MODERATION_CACHE_TTL:
+            break
+        _bad_hashes.popitem(last=False)
+
+
+def check_image_sanity(image_bytes, caption):
+    """Заголовок картинки (без полного декодирования): формат, размеры, обрезанный JPEG"""
+    try:
+        with Image.open(BytesIO(image_bytes)) as image:
+            width, height = image.size
+            fmt = image.format
+    except Exception:
+        return "The file is not a valid image."
+    if min(width, height) < PREFILTER_MIN_SIDE:
+        return f"Image is too small (min {PREFILTER_MIN_SIDE}px per side)."
+    if width * height > PREFILTER_MAX_PIXELS:
+        return "Image is too large."
+    if fmt == "JPEG" and not image_bytes.rstrip(b"\0").endswith(b"\xff\xd9"):
+        return "The image file is corrupted. Please send it again."
+    return None
+
+
+class PreFilter:
+    """Цепочка локальных проверок со статистикой сэкономленных вызовов AI"""
+
+    def __init__(self):
+        self.checks = []
+        self.checked = 0
+        self.rejected = Counter()
+        self.elapsed = 0.0
+
+    def add(self, name, check):
+        self.checks.append((name, check))
+        return self
+
+    def run(self, image_bytes, caption=""):
+        """(allowed, reason): отказ первой сработавшей проверки или (True, "OK")"""
+        started = time.perf_counter()
+        self.checked += 1
+        try:
+            for name, check in self.checks:
+                reason = check(image_bytes, caption)
+                if reason is not None:
+                    self.rejected[name] += 1
+                    return False, reason
+            return True, "OK"
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+    @property
+    def saved_calls(self):
+        """Сколько запросов к Gemini не понадобилось"""
+        return sum(self.rejected.values())
+
+    def stats(self):
+        return {
+            "checked": self.checked,
+            "saved_calls": self.saved_calls,
+            "rejected": dict(self.rejected),
+            "avg_ms": self.elapsed / self.checked * 1000 if self.checked else 0.0,
+        }
+
+
+# Сначала самые дешевые проверки
+prefilter = (
+    PreFilter()
+    .add("caption", check_caption)
+    .add("bad_hash", check_bad_hash)
+    .add("sanity", check_image_sanity)
+)
+
+
+async def remember_bad_image(image_bytes, reason):
+    """Добавляет картинку, отклоненную AI, в индекс известных плохих"""
+    digest = image_digest(image_bytes)
+    now = time.time()
+    try:
+        async with transaction() as db:
+            # Повторный отказ продлевает срок: INSERT OR IGNORE оставил бы старый created_at
+            await db.execute(
+                "INSERT OR REPLACE INTO bad_image_hashes (sha256, reason, created_at) VALUES (?, ?, ?)",
+                (digest, reason, now),
+            )
+    except Exception as e:
+        logging.warning(f"Cannot save bad image hash: {e}")
+        return
+    _remember_in_memory(digest, reason, now, now)
+
+
+async def init_prefilter():
+    """Создает таблицу известных плохих картинок, удаляет просроченные и загружает остальные в память"""
+    cutoff = time.time() - MODERATION_CACHE_TTL
+    async with transaction() as db:
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS bad_image_hashes (
+                sha256 TEXT PRIMARY KEY,
+                reason TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_bad_image_created ON bad_image_hashes(created_at)")
+        await db.execute("DELETE FROM bad_image_hashes WHERE created_at < ?", (cutoff,))
+    db = await get_db()
+    # В память - только самые свежие, в порядке от старых к новым
+    rows = await db.execute_fetchall(
+        "SELECT sha256, reason, created_at FROM bad_image_hashes ORDER BY created_at DESC LIMIT ?",
+        (MODERATION_CACHE_MAX_ENTRIES,),
+    )
+    _bad_hashes.clear()
+    now = time.time()
+    for digest, reason, created_at in reversed(rows):
+        _remember_in_memory(digest, reason, created_at, now)
+    return len(_bad_hashes)
@@ -0,0 +1,135 @@
+"""
+Ограничитель запросов по IP для веб-серверов (token bucket).
+
+У каждого IP ведро на max_requests токенов, которое полностью пополняется за
+window секунд; запрос тратит токен. Ведра лежат в хеш-таблице фиксированного
+размера с открытой адресацией, разбитой на шарды: проверка стоит O(1) при
+любом числе клиентов, памяти - не больше RATE_LIMIT_SLOTS ячеек. Ведро,
+которое успело пополниться до конца, ничем не отличается от нового, поэтому
+его ячейка просто считается свободной (ленивая очистка, без обхода всех IP).
+
+С name таблица лежит в mmap-файле в RATE_LIMIT_DIR (/dev/shm), и лимит общий
+для всех процессов (воркеров gunicorn). Шард блокируется threading.Lock и
+fcntl-блокировкой своего диапазона файла. Без name или без fcntl таблица -
+в памяти процесса.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # не POSIX: только лимит в памяти процесса
+    fcntl = None
+
+RATE_LIMIT_SLOTS = int(os.getenv("RATE_LIMIT_SLOTS", str(1 << 18)))
+RATE_LIMIT_DIR = os.getenv("RATE_LIMIT_DIR", "/dev/shm")
+RATE_LIMIT_SHARDS = 64
+# Сколько соседних ячеек просматриваем; если все заняты живыми ведрами, вытесняем самое старое
+PROBE_LIMIT = 16
+# X-Real-IP принимаем только от nginx на этой же машине
+TRUSTED_PROXIES = frozenset(
+    ip.strip() for ip in os.getenv("TRUSTED_PROXIES", "127.0.0.1,::1").split(",") if ip.strip()
+)
+
+RATE_LIMIT_REJECTIONS = metrics.counter("ratelimit_rejected_total", "Requests rejected by a rate limiter", ("limiter",))
+
+# Ячейка: хеш IP (0 - никогда не занималась), токены, время последнего обновления
+SLOT = struct.Struct("<Qdd")
+
+
+def client_ip(remote_addr, headers):
+    """IP клиента: X-Real-IP, если запрос пришел через доверенный прокси"""
+    if remote_addr in TRUSTED_PROXIES:
+        real_ip = headers.get("X-Real-IP")
+        if real_ip:
+            return real_ip.strip()
+    return remote_addr or "unknown"
+
+
+def _key_hash(key):
+    # hash() в каждом процессе свой, а таблица общая - нужен стабильный хеш
+    digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+    return digest or 1
+
+
+class RateLimiter:
+    """Rate limiter: max_requests per window seconds"""
+
+    def __init__(self, max_requests=30, window=60, name=None, slots=RATE_LIMIT_SLOTS, shards=RATE_LIMIT_SHARDS):
+        self.max_requests = max_requests
+        self.window = window
+        self.rate = max_requests / window
+        self.name = name or "local"
+        self.shards = max(1, min(shards, slots))
+        self.shard_slots = max(PROBE_LIMIT, slots // self.shards)
+        self.shard_bytes = self.shard_slots * SLOT.size
+        self._locks = [threading.Lock() for _ in range(self.shards)]
+        self._fd = None
+        size = self.shard_bytes * self.shards
+        if name and fcntl is not None and os.path.isdir(RATE_LIMIT_DIR):
+            path = os.path.join(RATE_LIMIT_DIR, f"the_one_ratelimit_{name}")
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size != size:
+                    os.ftruncate(self._fd, size)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+            self._table = mmap.mmap(self._fd, size)
+        else:
+            self._table = bytearray(size)
+
+    @property
+    def shared(self):
+        return self._fd is not None
+
+    def allow(self, key):
+        """True, если запрос с ключа key укладывается в лимит (и учитывает его)"""
+        digest = _key_hash(key)
+        shard = digest % self.shards
+        start = (digest // self.shards) % self.shard_slots
+        with self._locks[shard]:
+            if self._fd is None:
+                allowed = self._take(shard, start, digest, time.monotonic())
+            else:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, self.shard_bytes, shard * self.shard_bytes)
+                try:
+                    # Часы берем под блокировкой: время в ячейках шарда только растет
+                    allowed = self._take(shard, start, digest, time.monotonic())
+                finally:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN, self.shard_bytes, shard * self.shard_bytes)
+        if not allowed:
+            RATE_LIMIT_REJECTIONS.inc(self.name)
+        return allowed
+
+    def _take(self, shard, start, digest, now):
+        table = self._table
+        base = shard * self.shard_bytes
+        free = None
+        oldest, oldest_updated = None, None
+        for i in range(PROBE_LIMIT):
+            offset = base + (start + i) % self.shard_slots * SLOT.size
+            slot_key, tokens, updated = SLOT.unpack_from(table, offset)
+            if slot_key == digest:
+                tokens = min(self.max_requests, tokens + (now - updated) * self.rate)
+                allowed = tokens >= 1
+                SLOT.pack_into(table, offset, digest, tokens - 1 if allowed else tokens, now)
+                return allowed
+            if slot_key == 0:
+                # Дальше ключа быть не может: новые ведра занимают первую свободную ячейку
+                if free is None:
+                    free = offset
+                break
+            if free is None and now - updated >= self.window:
+                free = offset
+            if oldest is None or updated < oldest_updated:
+                oldest, oldest_updated = offset, updated
+        # Новое ведро - полное, минус текущий запрос
+        SLOT.pack_into(table, free if free is not None else oldest, digest, self.max_requests - 1, now)
+        return True
@@ -0,0 +1,99 @@
+"""
+Бот и сервер Mini App в одном процессе: aiogram и webapp_async на общем цикле событий.
+
+Соединение с БД, state_cache, снимки API и photo_cache общие: покупка, которую
+записал бот, сразу видна в /api/current и /api/stream без запросов к БД, а фото,
+которое бот положил в кэш, веб отдает из памяти. BOT_MODE=webhook - обновления
+приходят на WEBHOOK_PATH этого же сервера, polling - их забирает воркер 0.
+
+RUNTIME_WORKERS > 1 - столько процессов на одном порту (reuse_port); о своих
+записях они сообщают друг другу через cache_bus.
+
+Запуск: python runtime.py
+"""
+import asyncio
+import logging
+import os
+
+from aiohttp import web
+
+import bot
+import metrics
+import webapp_async
+from cache_bus import CacheBus
+
+RUNTIME_HOST = os.getenv("RUNTIME_HOST", webapp_async.WEBAPP_HOST)
+RUNTIME_PORT = int(os.getenv("RUNTIME_PORT", str(webapp_async.WEBAPP_PORT)))
+RUNTIME_WORKERS = int(os.getenv("RUNTIME_WORKERS", "1"))
+
+
+def register_polling(app):
+    """Long polling фоновой задачей приложения; останавливается раньше, чем закроется БД"""
+    async def start_polling(app):
+        app["polling"] = asyncio.create_task(bot.dp.start_polling(bot.bot, handle_signals=False))
+
+    async def stop_polling(app):
+        task = app["polling"]
+        try:
+            await bot.dp.stop_polling()
+        except RuntimeError:
+            task.cancel()  # опрос еще не успел начаться
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # Остальная остановка (закрытие БД) должна пройти и после падения опроса
+            logging.warning(f"Polling failed: {e}")
+
+    app.on_startup.append(start_polling)
+    app.on_cleanup.insert(0, stop_polling)
+
+
+def create_app(worker=0):
+    """Mini App + бот; worker - номер процесса при RUNTIME_WORKERS > 1"""
+    metrics.start("runtime")
+    app = webapp_async.create_app()
+    if bot.BOT_MODE == "webhook":
+        bot.register_webhook(app)
+    elif worker == 0:
+        register_polling(app)
+
+    bus = CacheBus()
+
+    async def start_bus(app):
+        bus.start()
+
+    async def stop_bus(app):
+        await bus.stop()
+
+    app.on_startup.append(start_bus)
+    app.on_cleanup.insert(0, stop_bus)
+    # Раньше остановки бота: его on_shutdown закрывает общую БД, которую читает наблюдатель SSE
+    app.on_cleanup.insert(0, webapp_async.stop_live_updates)
+    return app
+
+
+def run_worker(worker):
+    web.run_app(
+        create_app(worker),
+        host=RUNTIME_HOST,
+        port=RUNTIME_PORT,
+        reuse_port=RUNTIME_WORKERS > 1,
+        shutdown_timeout=bot.WEBHOOK_DRAIN_TIMEOUT,
+        print=None,
+    )
+
+
+def main():
+    if bot.BOT_MODE == "webhook" and bot.WEBHOOK_URL:
+        asyncio.run(bot.set_webhook())
+    print(f"Runtime on http://{RUNTIME_HOST}:{RUNTIME_PORT} (bot: {bot.BOT_MODE}, {RUNTIME_WORKERS} workers)")
+    if RUNTIME_WORKERS <= 1:
+        run_worker(0)
+        return
+    bot.run_workers(run_worker, RUNTIME_WORKERS, "runtime-worker")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Бенчмарк слоя SQLite: connect-per-call (как было) против общего соединения.
+
+Запуск:
+    python scripts/bench_db.py --rows 20000 --iterations 2000
+
+Печатает p50/p99 задержки каждого запроса в микросекундах.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import aiosqlite
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database  # noqa: E402
+
+
+# ---------- старый путь: новое соединение на каждый вызов, история в game_state ----------
+
+LEGACY_SCHEMA = """
+    CREATE TABLE game_state (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        current_price INTEGER,
+        photo_id TEXT,
+        text TEXT,
+        user_link TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX idx_hall_of_fame ON game_state(current_price DESC, id) WHERE user_id > 0;
+"""
+LEGACY_CURRENT_STATE = "SELECT current_price, user_id, photo_id, text, user_link FROM game_state ORDER BY id DESC LIMIT 1"
+LEGACY_INSERT_STATE = "INSERT INTO game_state (user_id, current_price, photo_id, text, user_link) VALUES (?, ?, ?, ?, ?)"
+LEGACY_HALL_OF_FAME = """
+    SELECT id, user_id, user_link, current_price, photo_id, text
+    FROM game_state WHERE user_id > 0 ORDER BY current_price DESC, id LIMIT ?
+"""
+
+
+async def legacy_get_game_state():
+    async with aiosqlite.connect(database.DB_NAME) as db:
+        async with db.execute(LEGACY_CURRENT_STATE) as cursor:
+            return await cursor.fetchone()
+
+async def legacy_is_user_blocked(user_id):
+    async with aiosqlite.connect(database.DB_NAME) as db:
+        async with db.execute("SELECT user_id FROM blocked_users WHERE user_id = ?", (user_id,)) as cursor:
+            return await cursor.fetchone() is not None
+
+async def legacy_get_hall_of_fame(limit=10):
+    async with aiosqlite.connect(database.DB_NAME) as db:
+        async with db.execute(LEGACY_HALL_OF_FAME, (limit,)) as cursor:
+            return await cursor.fetchall()
+
+async def legacy_update_game_state(user_id, photo_id, text, user_link, new_price):
+    async with aiosqlite.connect(database.DB_NAME) as db:
+        await db.execute(LEGACY_INSERT_STATE, (user_id, new_price, photo_id, text, user_link))
+        await db.commit()
+
+
+LEGACY = {
+    "get_game_state": legacy_get_game_state,
+    "is_user_blocked": lambda: legacy_is_user_blocked(random.randint(1, 10**6)),
+    "get_hall_of_fame": legacy_get_hall_of_fame,
+    "update_game_state": lambda: legacy_update_game_state(42, "photo", "bench", "@bench", random.randint(1, 10**6)),
+}
+
+# ---------- новый путь: общее соединение и кэши в памяти ----------
+
+async def pooled_is_user_blocked(user_id):
+    # Блоклист теперь в памяти; обертка нужна только для единообразного замера
+    return database.is_user_blocked(user_id)
+
+
+POOLED = {
+    "get_game_state": database.get_game_state,
+    "is_user_blocked": lambda: pooled_is_user_blocked(random.randint(1, 10**6)),
+    "get_hall_of_fame": database.get_hall_of_fame,
+    "update_game_state": lambda: database.update_game_state(42, "photo", "bench", "@bench", random.randint(1, 10**6)),
+}
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def measure(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await func()
+        samples.append((time.perf_counter() - started) * 1e6)
+    return samples
+
+
+async def populate(rows):
+    # Старая таблица с историей; init_db переносит ее в журнал событий, как при обновлении рабочей базы
+    with sqlite3.connect(database.DB_NAME) as conn:
+        conn.executescript(LEGACY_SCHEMA)
+        conn.execute(LEGACY_INSERT_STATE, (0, 1, "", "Throne awaits its first ruler", ""))
+        conn.executemany(
+            LEGACY_INSERT_STATE,
+            [(i, random.randint(1, 10**6), f"photo_{i}", "seed", f"@user{i}") for i in range(1, rows + 1)],
+        )
+    conn.close()
+    await database.open_db()
+    await database.init_db()
+
+
+async def run(rows, iterations):
+    await populate(rows)
+
+    results = {}
+    # Старый путь меряем при закрытом общем соединении, чтобы не давать ему фору
+    await database.close_db()
+    for name, func in LEGACY.items():
+        results[(name, "before")] = await measure(func, iterations)
+
+    await database.open_db()
+    for name, func in POOLED.items():
+        results[(name, "after")] = await measure(func, iterations)
+    await database.close_db()
+
+    print(f"rows={rows} iterations={iterations} (latency in µs)")
+    print(f"{'query':<20} {'before p50':>11} {'before p99':>11} {'after p50':>10} {'after p99':>10}")
+    for name in POOLED:
+        before = results[(name, "before")]
+        after = results[(name, "after")]
+        print(
+            f"{name:<20} {percentile(before, 50):>11.0f} {percentile(before, 99):>11.0f}"
+            f" {percentile(after, 50):>10.0f} {percentile(after, 99):>10.0f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000, help="сколько записей истории создать")
+    parser.add_argument("--iterations", type=int, default=2000, help="вызовов на каждый запрос")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, "bench.db")
+        asyncio.run(run(args.rows, args.iterations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Бенчмарк админских операций: история в game_state (как было) против журнала
+событий game_events со снимком game_snapshot.
+
+Для каждого размера истории обе схемы заполняются одинаково (журнал - переносом
+из game_state через init_db), затем меряются чтение текущего царя без кэша,
+откат, правка цены и сброс. Старые запросы повторены здесь дословно.
+
+    python scripts/bench_events.py --rows 1000,100000 --iterations 200
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database  # noqa: E402
+from bench_db import LEGACY_SCHEMA, LEGACY_CURRENT_STATE, LEGACY_INSERT_STATE, percentile  # noqa: E402
+
+
+# ---------- старый путь ----------
+
+async def legacy_current_state():
+    db = await database.get_db()
+    async with db.execute(LEGACY_CURRENT_STATE) as cursor:
+        return await cursor.fetchone()
+
+
+async def legacy_rollback():
+    async with database.transaction() as db:
+        async with db.execute("SELECT COUNT(*) FROM game_state") as cursor:
+            if (await cursor.fetchone())[0] <= 1:
+                return False
+        await db.execute("DELETE FROM game_state WHERE id = (SELECT MAX(id) FROM game_state)")
+    return True
+
+
+async def legacy_set_base_price():
+    async with database.transaction() as db:
+        async with db.execute("SELECT id FROM game_state ORDER BY id DESC LIMIT 1") as cursor:
+            row = await cursor.fetchone()
+        await db.execute("UPDATE game_state SET current_price = ? WHERE id = ?", (random.randint(1, 10**6), row[0]))
+
+
+async def legacy_reset():
+    async with database.transaction() as db:
+        await db.execute("DELETE FROM game_state")
+        await db.execute(LEGACY_INSERT_STATE, (0, 1, "", "Throne awaits its first ruler", ""))
+
+
+# ---------- журнал событий ----------
+
+async def current_state():
+    database.state_cache.invalidate()
+    return await database.get_current_state()
+
+
+async def set_base_price():
+    await database.set_base_price(random.randint(1, 10**6))
+
+
+OPERATIONS = (
+    ("current_state", legacy_current_state, current_state),
+    ("rollback", legacy_rollback, database.rollback_last_entry),
+    ("set_base_price", legacy_set_base_price, set_base_price),
+)
+
+
+async def measure(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await func()
+        samples.append((time.perf_counter() - started) * 1e6)
+    return samples
+
+
+async def run(rows, iterations):
+    with sqlite3.connect(database.DB_NAME) as conn:
+        conn.executescript(LEGACY_SCHEMA)
+        conn.execute(LEGACY_INSERT_STATE, (0, 1, "", "Throne awaits its first ruler", ""))
+        conn.executemany(
+            LEGACY_INSERT_STATE,
+            [(i, random.randint(1, 10**6), f"photo_{i}", "seed", f"@user{i}") for i in range(1, rows + 1)],
+        )
+    conn.close()
+    await database.open_db()
+    await database.init_db()
+
+    results = []
+    for name, legacy, current in OPERATIONS:
+        results.append((name, await measure(legacy, iterations), await measure(current, iterations)))
+    # Сброс разрушает историю - по одному замеру
+    results.append(("reset", await measure(legacy_reset, 1), await measure(database.reset_database, 1)))
+    await database.close_db()
+
+    print(f"rows={rows} iterations={iterations} (latency in µs)")
+    print(f"{'operation':<16} {'before p50':>11} {'before p99':>11} {'after p50':>10} {'after p99':>10}")
+    for name, before, after in results:
+        print(
+            f"{name:<16} {percentile(before, 50):>11.0f} {percentile(before, 99):>11.0f}"
+            f" {percentile(after, 50):>10.0f} {percentile(after, 99):>10.0f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="1000,100000", help="размеры истории через запятую")
+    parser.add_argument("--iterations", type=int, default=200, help="вызовов на каждую операцию")
+    args = parser.parse_args()
+
+    for rows in (int(value) for value in args.rows.split(",")):
+        if rows <= args.iterations:
+            parser.error("--rows must be larger than --iterations (each rollback removes an entry)")
+        with tempfile.TemporaryDirectory() as tmp:
+            database.DB_NAME = os.path.join(tmp, "bench.db")
+            asyncio.run(run(rows, args.iterations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Бенчмарк FSM-хранилищ: updates/s через всю цепочку обработчиков бота.
+
+Каждый симулированный пользователь проходит /start -> successful_payment ->
+выбор приватности; обновления идут через dp.feed_update с FakeSession
+(без сети) на временной базе. Сравниваются MemoryStorage, SQLiteStorage без
+кэша и пакетной записи (как было) и SQLiteStorage по умолчанию.
+
+    python scripts/bench_fsm.py --users 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("GOOGLE_API_KEY", "bench")
+# Меряется FSM, а не общий лимит обновлений в секунду
+os.environ.setdefault("THROTTLE_GLOBAL_RATE", "0")
+
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+import bot as bot_module  # noqa: E402
+import database  # noqa: E402
+from fake_session import FakeSession  # noqa: E402
+from fsm_storage import SQLiteStorage  # noqa: E402
+
+
+def user_updates(user_id, first_update_id):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    now = int(time.time())
+    return [
+        {"update_id": first_update_id, "message": {
+            "message_id": 1, "date": now, "chat": chat, "from": user, "text": "/start"}},
+        {"update_id": first_update_id + 1, "message": {
+            "message_id": 2, "date": now, "chat": chat, "from": user,
+            "successful_payment": {
+                "currency": "XTR", "total_amount": 110, "invoice_payload": "king_buy_1",
+                "telegram_payment_charge_id": f"c{user_id}", "provider_payment_charge_id": f"p{user_id}"}}},
+        {"update_id": first_update_id + 2, "callback_query": {
+            "id": str(first_update_id), "from": user, "chat_instance": "bench", "data": "privacy_hide",
+            "message": {"message_id": 3, "date": now, "chat": chat, "text": "Payment Successful!"}}},
+    ]
+
+
+async def run_users(users, concurrency, offset):
+    dp, bot = bot_module.dp, bot_module.bot
+    pending = iter(range(users))
+    handled = 0
+
+    async def client():
+        nonlocal handled
+        for i in pending:
+            user_id = offset + i
+            # Обновления одного пользователя - по очереди, как их шлет Telegram
+            for raw in user_updates(user_id, user_id * 10):
+                await dp.feed_update(bot, Update.model_validate(raw, context={"bot": bot}))
+                handled += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return handled, time.perf_counter() - started
+
+
+async def check_states(storage, users, offset):
+    """Все пользователи должны дойти до waiting_for_photo с paid_amount"""
+    from aiogram.fsm.storage.base import StorageKey
+    bot_id = bot_module.bot.id
+    for i in range(users):
+        key = StorageKey(bot_id=bot_id, chat_id=offset + i, user_id=offset + i)
+        state = await storage.get_state(key)
+        data = await storage.get_data(key)
+        assert state == bot_module.GameStates.waiting_for_photo.state, (offset + i, state)
+        assert data.get("paid_amount") == 110 and data.get("show_username") is False, data
+
+
+async def accept_payment(user_id, payload, charge_id):
+    return True
+
+
+async def run(users, concurrency):
+    bot_module.bot.session = FakeSession()
+    # Меряется FSM: заявок на трон у симулированных оплат нет, bid_engine в замер не входит
+    bot_module.confirm_payment = accept_payment
+    await bot_module.on_startup()
+    storages = {
+        "memory": MemoryStorage(),
+        "sqlite, no cache/batching": SQLiteStorage(flush_interval=0, cache_size=0),
+        "sqlite": SQLiteStorage(),
+    }
+    print(f"users={users} updates={users * 3} concurrency={concurrency}")
+    try:
+        for n, (name, storage) in enumerate(storages.items()):
+            bot_module.dp.fsm.storage = storage
+            offset = (n + 1) * 1_000_000
+            handled, elapsed = await run_users(users, concurrency, offset)
+            if isinstance(storage, SQLiteStorage):
+                await storage.close()
+                # Проверяем то, что реально дошло до базы, свежим хранилищем
+                await check_states(SQLiteStorage(), users, offset)
+            print(f"{name:<28} {handled / elapsed:>8.0f} updates/s")
+    finally:
+        bot_module.dp.fsm.storage = storages["sqlite"]
+        await bot_module.on_shutdown()
+
+
+def main():
+    # Лог "Update id=... is handled" на каждое обновление сам по себе стоит больше FSM
+    logging.disable(logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, "bench.db")
+        asyncio.run(run(args.users, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Стоимость метрик на горячем пути: inc(), observe(), обертка timed() и
+выдача /metrics при заданном числе наборов меток.
+
+    python scripts/bench_metrics.py --calls 200000 --labels 50
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import metrics  # noqa: E402
+
+
+def per_call_ns(fn, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - started) / calls * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--labels", type=int, default=50, help="наборов меток у каждой метрики")
+    args = parser.parse_args()
+
+    counter = metrics.counter("bench_total", "bench", ("handler",))
+    histogram = metrics.histogram("bench_seconds", "bench", ("handler",))
+
+    def plain():
+        return None
+
+    wrapped = metrics.timed(histogram, "plain")(plain)
+
+    baseline = per_call_ns(plain, args.calls)
+    print(f"{'call':<28} {'ns/call':>8}")
+    print(f"{'plain function':<28} {baseline:>8.0f}")
+    print(f"{'Counter.inc':<28} {per_call_ns(lambda: counter.inc('cmd_start'), args.calls):>8.0f}")
+    print(f"{'Histogram.observe':<28} {per_call_ns(lambda: histogram.observe(0.004, 'cmd_start'), args.calls):>8.0f}")
+    print(f"{'timed() wrapper (overhead)':<28} {per_call_ns(wrapped, args.calls) - baseline:>8.0f}")
+
+    for i in range(args.labels):
+        counter.inc(f"handler_{i}")
+        histogram.observe(i / 1000, f"handler_{i}")
+    started = time.perf_counter()
+    text = metrics.render()
+    print(f"render: {len(text.splitlines())} lines in {(time.perf_counter() - started) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Проверка неблокирующей модерации на локальной заглушке Gemini.
+
+Заглушка отвечает "OK" после блокирующего time.sleep (как синхронный SDK).
+N фото отправляются в check_image одновременно; если вызовы не блокируют
+event loop и идут параллельно, общее время близко к самому медленному
+вызову, а не к их сумме. Заодно меряется задержка event loop.
+
+Запуск:
+    python scripts/bench_moderation.py --photos 4 --latency 1.0
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("GOOGLE_API_KEY", "bench")
+
+from PIL import Image  # noqa: E402
+
+import ai_check  # noqa: E402
+
+
+class StubResponse:
+    text = "OK"
+
+
+class StubModel:
+    """Синхронная модель с задержкой, как generate_content у SDK"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.durations = []
+
+    def generate_content(self, contents, request_options=None):
+        delay = self.latency * random.uniform(0.5, 1.0)
+        self.durations.append(delay)
+        time.sleep(delay)
+        return StubResponse()
+
+
+def make_photos(count):
+    photos = []
+    for i in range(count):
+        out = BytesIO()
+        Image.new("RGB", (64, 64), (i * 37 % 256, i * 91 % 256, i * 13 % 256)).save(out, format="JPEG")
+        photos.append(out.getvalue())
+    return photos
+
+
+async def watch_loop_lag(stop, interval=0.01):
+    """Максимальное опоздание таймера event loop (сек)"""
+    worst = 0.0
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        worst = max(worst, loop.time() - started - interval)
+    return worst
+
+
+async def run(photos):
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(watch_loop_lag(stop))
+    started = time.perf_counter()
+    results = await asyncio.gather(*(ai_check.check_image(photo) for photo in photos))
+    wall = time.perf_counter() - started
+    stop.set()
+    return results, wall, await lag_task
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--photos", type=int, default=ai_check.MODERATION_CONCURRENCY, help="одновременных фото")
+    parser.add_argument("--latency", type=float, default=1.0, help="максимальная задержка заглушки, сек")
+    args = parser.parse_args()
+
+    stub = StubModel(args.latency)
+    ai_check.model = stub
+    ai_check.genai.upload_file = lambda path, **kwargs: path
+
+    results, wall, lag = asyncio.run(run(make_photos(args.photos)))
+
+    # Больше MODERATION_CONCURRENCY вызовов идут волнами - ожидаем время самой долгой волны
+    waves = -(-args.photos // ai_check.MODERATION_CONCURRENCY)
+    slowest = max(stub.durations)
+    total = sum(stub.durations)
+    print(f"photos={args.photos} concurrency={ai_check.MODERATION_CONCURRENCY}")
+    print(f"wall={wall:.2f}s slowest={slowest:.2f}s sum={total:.2f}s max loop lag={lag * 1000:.1f}ms")
+    assert all(allowed for allowed, _ in results), results
+    if wall > slowest * waves + 0.5 or lag > 0.1:
+        print("FAIL: moderation calls are serialized or block the event loop")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
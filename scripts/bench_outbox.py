@@ -0,0 +1,153 @@
+"""
+Outbox постов в канал: задержка обработчика, склейка царей и flood control.
+
+1. Обработчик: отправка поста в канал прямо из обработчика (Bot API с
+   задержкой --latency) против записи строки в outbox.
+2. Серия царей: --kings постов о новом царе с интервалом --interval в один
+   канал; сколько постов реально ушло и ушел ли последний царь.
+3. Рассылка: --messages сообщений в разные чаты через заглушку Bot API,
+   которая отвечает 429 (retry_after=1), если за секунду больше --flood-limit
+   вызовов. Все должны дойти, очередь - переждать паузы.
+
+    python scripts/bench_outbox.py --kings 30 --interval 0.2 --messages 200
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiogram import Bot  # noqa: E402
+from aiogram.exceptions import TelegramRetryAfter  # noqa: E402
+
+import database  # noqa: E402
+import outbox  # noqa: E402
+from database import close_db, init_db, open_db, transaction  # noqa: E402
+from fake_session import FakeSession  # noqa: E402
+from outbox import OutboxSender, enqueue, get_outbox_stats, init_outbox  # noqa: E402
+
+
+class SlowFloodSession(FakeSession):
+    """Заглушка Bot API с задержкой ответа и лимитом вызовов в секунду (иначе 429)"""
+
+    def __init__(self, latency=0.0, flood_limit=None):
+        super().__init__()
+        self.latency = latency
+        self.flood_limit = flood_limit
+        self.window = (0, 0)  # (секунда, вызовов в ней)
+        self.flood_errors = 0
+        self.captions = []
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_limit is not None:
+            second = int(time.monotonic())
+            count = self.window[1] + 1 if self.window[0] == second else 1
+            self.window = (second, count)
+            if count > self.flood_limit:
+                self.flood_errors += 1
+                raise TelegramRetryAfter(method=method, message="Too Many Requests: retry after 1", retry_after=1)
+        if getattr(method, "caption", None):
+            self.captions.append(method.caption)
+        return await super().make_request(bot, method, timeout)
+
+
+async def wait_drained(timeout):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        stats = await get_outbox_stats()
+        if stats["pending"] == 0 and stats["sending"] == 0:
+            return time.perf_counter() - started
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"outbox not drained in {timeout}s: {await get_outbox_stats()}")
+
+
+async def handler_latency(latency, samples):
+    bot = Bot("123456:bench", session=SlowFloodSession(latency=latency))
+    inline, queued = [], []
+    for i in range(samples):
+        started = time.perf_counter()
+        await bot.send_photo(chat_id="@bench", photo="photo", caption=f"king {i}")
+        inline.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        await enqueue("send_photo", "@bench", photo="photo", caption=f"king {i}")
+        queued.append(time.perf_counter() - started)
+    async with transaction() as db:
+        await db.execute("DELETE FROM outbox")
+    print(f"handler path, Bot API latency {latency * 1000:.0f} ms:")
+    print(f"  send_photo inline: p50 {statistics.median(inline) * 1000:7.1f} ms")
+    print(f"  outbox enqueue:    p50 {statistics.median(queued) * 1000:7.1f} ms")
+
+
+async def king_burst(kings, interval):
+    session = SlowFloodSession(latency=0.05)
+    sender = OutboxSender(Bot("123456:bench", session=session))
+    sender.start()
+    try:
+        for i in range(kings):
+            await enqueue("send_photo", "@channel", coalesce_key="king:@channel", photo="photo", caption=f"king {i}")
+            await asyncio.sleep(interval)
+        elapsed = await wait_drained(60)
+    finally:
+        await sender.stop()
+    stats = await get_outbox_stats()
+    print(f"{kings} kings every {interval}s into one channel (coalesce window {outbox.OUTBOX_COALESCE_WINDOW}s):")
+    print(f"  posts sent: {len(session.captions)}, coalesced: {stats['superseded']}, drained {elapsed:.1f}s after the last king")
+    assert session.captions and session.captions[-1] == f"king {kings - 1}", session.captions
+    assert stats["failed"] == 0
+
+
+async def flood(messages, flood_limit):
+    session = SlowFloodSession(flood_limit=flood_limit)
+    # Регулятор нарочно выше лимита заглушки: 429 должен случиться и быть пережит
+    sender = OutboxSender(Bot("123456:bench", session=session), rate=flood_limit * 2)
+    started = time.perf_counter()
+    for i in range(messages):
+        await enqueue("send_message", 1000 + i, text=f"message {i}")
+    sender.start()
+    try:
+        await wait_drained(120)
+    finally:
+        await sender.stop()
+    elapsed = time.perf_counter() - started
+    stats = await get_outbox_stats()
+    delivered = session.calls.get("SendMessage", 0)  # ответы 429 сюда не попадают
+    print(f"{messages} messages to distinct chats, stub allows {flood_limit}/s:")
+    print(f"  delivered: {delivered}, 429 responses: {session.flood_errors}, failed: {stats['failed']}, {elapsed:.1f}s")
+    assert delivered == messages and stats["failed"] == 0
+
+
+async def run(args):
+    await open_db()
+    try:
+        await init_db()
+        await init_outbox()
+        await handler_latency(args.latency, args.samples)
+        await king_burst(args.kings, args.interval)
+        await flood(args.messages, args.flood_limit)
+    finally:
+        await close_db()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.3, help="задержка Bot API, сек")
+    parser.add_argument("--samples", type=int, default=20)
+    parser.add_argument("--kings", type=int, default=30)
+    parser.add_argument("--interval", type=float, default=0.2)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--flood-limit", type=int, default=30)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, "bench.db")
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
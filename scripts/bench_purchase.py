@@ -0,0 +1,402 @@
+"""
+Сквозной бенчмарк покупки трона: весь путь пользователя через Dispatcher бота
+и параллельная нагрузка на веб-API Mini App, без сети и Telegram.
+
+Каждый пользователь проходит /buy -> кнопка buy_1 (send_invoice) ->
+pre_checkout_query -> successful_payment -> выбор приватности -> фото.
+Обновления идут через dp.feed_update с заглушкой Bot API, модерация -
+заглушка с задержкой --moderation-latency. Если трон перекупили между счетом
+и оплатой или чужая покупка еще не завершилась, pre-checkout отказывает, и
+пользователь через --retry-delay запрашивает новый счет, как в жизни. Бот работает в --processes процессах на общей SQLite. В это же
+время клиенты бьют в webapp.py (Flask, отдельный процесс) по /api/current и
+/api/hall-of-fame.
+
+Печатаются updates/s и покупки/s, p50/p95/p99 по шагам, ожидание блокировки
+записи SQLite, повторы после отказов pre-checkout и req/s и p50/p99 веб-API.
+
+    python scripts/bench_purchase.py --users 200 --concurrency 10
+    python scripts/bench_purchase.py --users 200 --processes 2 --web-concurrency 50
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+STEPS = ("buy", "invoice", "pre_checkout", "payment", "privacy", "photo")
+
+
+def bench_environment(tmp):
+    """Окружение процессов бенчмарка: временные каталоги, без лимитов throttling"""
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("GOOGLE_API_KEY", "bench")
+    os.environ["CHANNEL_ID"] = "@bench_channel"
+    os.environ["RATE_LIMIT_DIR"] = tmp
+    os.environ["METRICS_DIR"] = ""
+    os.environ["PHOTO_CACHE_DIR"] = os.path.join(tmp, "photo_cache")
+    # Меряем путь покупки, а не защиту от спама
+    os.environ["THROTTLE_USER_LIMIT"] = "1000000"
+    os.environ["THROTTLE_GLOBAL_RATE"] = "0"
+    os.environ["THROTTLE_DEDUPE_WINDOW"] = "0"
+
+
+def make_photo():
+    from PIL import Image
+
+    out = BytesIO()
+    Image.linear_gradient("L").resize((640, 480)).convert("RGB").save(out, format="JPEG", quality=85)
+    return out.getvalue()
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def bucket_percentile(buckets, counts, pct):
+    """Верхняя граница корзины гистограммы, в которую попадает перцентиль"""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    seen = 0
+    for bound, hits in zip(list(buckets) + [float("inf")], counts):
+        seen += hits
+        if seen >= pct / 100 * total:
+            return bound
+    return float("inf")
+
+
+# ============ ПРОЦЕСС БОТА ============
+
+def bot_worker(tmp, db_path, index, users, concurrency, moderation_latency, max_retries, retry_delay, barrier, results):
+    bench_environment(tmp)
+    logging.disable(logging.WARNING)
+
+    from aiogram.methods import AnswerPreCheckoutQuery, GetFile, SendInvoice
+    from aiogram.types import File, Update
+
+    import bid_engine
+    import bot as bot_module
+    import database
+    from fake_session import FakeSession
+
+    database.DB_NAME = db_path
+    photo = make_photo()
+
+    class PurchaseSession(FakeSession):
+        """Заглушка Bot API: запоминает счета и ответы pre-checkout, отдает файл фото"""
+
+        def __init__(self):
+            super().__init__()
+            self.invoices = {}
+            self.pre_checkout = {}
+
+        async def make_request(self, bot, method, timeout=None):
+            if isinstance(method, SendInvoice):
+                self.invoices[method.chat_id] = (method.payload, method.prices[0].amount)
+            elif isinstance(method, AnswerPreCheckoutQuery):
+                self.pre_checkout[method.pre_checkout_query_id] = method.ok
+            elif isinstance(method, GetFile):
+                self.calls["GetFile"] = self.calls.get("GetFile", 0) + 1
+                return File(file_id=method.file_id, file_unique_id=method.file_id, file_path=f"photos/{method.file_id}.jpg")
+            return await super().make_request(bot, method, timeout)
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield photo
+
+    async def stub_moderation(image_bytes, file_unique_id=None):
+        await asyncio.sleep(moderation_latency)
+        return True, "OK"
+
+    session = PurchaseSession()
+    bot, dp = bot_module.bot, bot_module.dp
+    bot.session = session
+    bot_module.moderation_queue.moderate = stub_moderation
+    update_ids = itertools.count(index * 10**8)
+    latencies = {step: [] for step in STEPS}
+    counters = {"purchases": 0, "updates": 0, "stale_retries": 0, "gave_up": 0, "failed": 0}
+    errors = {}
+
+    async def feed(step, payload):
+        update_id = next(update_ids)
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(bot, Update.model_validate({"update_id": update_id, **payload}, context={"bot": bot}))
+        except Exception as e:
+            # Ошибка обработчика (например, "database is locked") - тоже результат замера
+            error = f"{step}: {type(e).__name__}: {e}"
+            errors[error] = errors.get(error, 0) + 1
+            raise
+        finally:
+            latencies[step].append(time.perf_counter() - started)
+            counters["updates"] += 1
+        return update_id
+
+    async def purchase(user_id):
+        user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+        chat = {"id": user_id, "type": "private"}
+        bot_user = {"id": bot.id, "is_bot": True, "first_name": "Bot"}
+        now = int(time.time())
+
+        def message(**fields):
+            return {"message": {"message_id": 1, "date": now, "chat": chat, "from": user, **fields}}
+
+        def callback(data):
+            return {"callback_query": {
+                "id": str(next(update_ids)), "from": user, "chat_instance": "bench", "data": data,
+                "message": {"message_id": 2, "date": now, "chat": chat, "from": bot_user, "text": "menu"}}}
+
+        try:
+            await complete_purchase(user_id, user, message, callback)
+        except Exception:
+            counters["failed"] += 1
+
+    async def complete_purchase(user_id, user, message, callback):
+        await feed("buy", message(text="/buy"))
+        for attempt in range(max_retries + 1):
+            await feed("invoice", callback("buy_1"))
+            payload, amount = session.invoices.pop(user_id)
+            query_id = str(next(update_ids))
+            await feed("pre_checkout", {"pre_checkout_query": {
+                "id": query_id, "from": user, "currency": "XTR", "total_amount": amount, "invoice_payload": payload}})
+            if session.pre_checkout.pop(query_id):
+                break
+            counters["stale_retries"] += 1
+            await asyncio.sleep(retry_delay)
+        else:
+            counters["gave_up"] += 1
+            return
+        await feed("payment", message(successful_payment={
+            "currency": "XTR", "total_amount": amount, "invoice_payload": payload,
+            "telegram_payment_charge_id": f"c{user_id}", "provider_payment_charge_id": f"p{user_id}"}))
+        await feed("privacy", callback("privacy_show"))
+        await feed("photo", message(caption=f"King {user_id}", photo=[{
+            "file_id": f"photo_{user_id}", "file_unique_id": f"u{user_id}", "width": 640, "height": 480}]))
+        counters["purchases"] += 1
+
+    async def run():
+        await bot_module.on_startup()
+        barrier.wait()
+        pending = iter(range(users))
+
+        async def client():
+            for i in pending:
+                await purchase(index * 1_000_000 + i)
+
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(client() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+        finally:
+            lock_wait = database.DB_LOCK_WAIT_SECONDS.samples()
+            claims = dict((labels[0], value) for labels, value in bid_engine.BID_CLAIMS.samples())
+            refunds = dict((labels[0], value) for labels, value in bid_engine.BID_RELEASES.samples())
+            await bot_module.on_shutdown()
+        results.put({
+            "elapsed": elapsed,
+            "latencies": latencies,
+            "counters": counters,
+            "errors": errors,
+            "lock_wait": lock_wait[0][1] if lock_wait else [],
+            "claims": claims,
+            "refunds": refunds,
+        })
+
+    asyncio.run(run())
+
+
+# ============ ВЕБ-API ============
+
+def web_worker(tmp, db_path, ports):
+    bench_environment(tmp)
+    logging.disable(logging.WARNING)
+    from werkzeug.serving import make_server
+
+    import database
+    database.DB_NAME = db_path
+    import webapp
+
+    server = make_server("127.0.0.1", 0, webapp.app, threaded=True)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+async def web_load(base_url, concurrency, stop):
+    import aiohttp
+
+    paths = ("/api/current", "/api/hall-of-fame?limit=10")
+    latencies = []
+    statuses = {}
+    failures = {}  # статус -> тело первого неуспешного ответа
+    # Разные X-Real-IP от "локального nginx": лимит 60 запросов в минуту на IP не мешает замеру
+    ips = itertools.count(1)
+
+    async def client(session, path):
+        while not stop.is_set():
+            n = next(ips)
+            headers = {"X-Real-IP": f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}"}
+            started = time.perf_counter()
+            try:
+                async with session.get(base_url + path, headers=headers) as response:
+                    body = await response.read()
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+                    if response.status != 200:
+                        failures.setdefault(response.status, body[:200].decode(errors="replace"))
+            except aiohttp.ClientError:
+                statuses["error"] = statuses.get("error", 0) + 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        await asyncio.gather(*(client(session, paths[i % len(paths)]) for i in range(concurrency)))
+    return latencies, statuses, failures, time.perf_counter() - started
+
+
+# ============ ЗАПУСК ============
+
+def report(args, outcomes, web):
+    elapsed = max(outcome["elapsed"] for outcome in outcomes)
+    counters = {key: sum(outcome["counters"][key] for outcome in outcomes) for key in outcomes[0]["counters"]}
+    print(f"users={args.users} processes={args.processes} concurrency={args.concurrency}/process "
+          f"moderation={args.moderation_latency * 1000:.0f}ms")
+    print(f"purchases={counters['purchases']} updates={counters['updates']} in {elapsed:.2f}s: "
+          f"{counters['updates'] / elapsed:.0f} updates/s, {counters['purchases'] / elapsed:.1f} purchases/s")
+    print(f"refused invoices re-requested: {counters['stale_retries']}, gave up: {counters['gave_up']}, "
+          f"failed: {counters['failed']}")
+    errors = {}
+    for outcome in outcomes:
+        for error, count in outcome["errors"].items():
+            errors[error] = errors.get(error, 0) + count
+    for error, count in sorted(errors.items(), key=lambda item: -item[1]):
+        print(f"  {count:>5} x {error}")
+
+    print(f"{'step':<14} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for step in STEPS:
+        samples = [value for outcome in outcomes for value in outcome["latencies"][step]]
+        print(f"{step:<14} {len(samples):>7} {percentile(samples, 50) * 1000:>8.2f} "
+              f"{percentile(samples, 95) * 1000:>8.2f} {percentile(samples, 99) * 1000:>8.2f}")
+
+    import database
+    buckets = database.DB_LOCK_WAIT_SECONDS.buckets
+    counts = [0] * (len(buckets) + 1)
+    total_wait = 0.0
+    for outcome in outcomes:
+        if outcome["lock_wait"]:
+            counts = [a + b for a, b in zip(counts, outcome["lock_wait"][:-1])]
+            total_wait += outcome["lock_wait"][-1]
+    claims = {}
+    for outcome in outcomes:
+        for result, value in outcome["claims"].items():
+            claims[result] = claims.get(result, 0) + value
+    print(f"SQLite write lock: {sum(counts)} transactions, p50 <= {bucket_percentile(buckets, counts, 50) * 1000:g}ms, "
+          f"p99 <= {bucket_percentile(buckets, counts, 99) * 1000:g}ms, total wait {total_wait:.2f}s")
+    print(f"throne claims: {claims}")
+    refunds = {}
+    for outcome in outcomes:
+        for reason, value in outcome["refunds"].items():
+            refunds[reason] = refunds.get(reason, 0) + value
+    # Оплаты, не ставшие царем (их Stars возвращаются)
+    print(f"claims not crowned: {refunds or 0}")
+
+    if web is not None:
+        latencies, statuses, failures, web_elapsed = web
+        print(f"web API ({args.web_concurrency} clients): {len(latencies) / web_elapsed:.0f} req/s "
+              f"p50={percentile(latencies, 50) * 1000:.1f}ms p99={percentile(latencies, 99) * 1000:.1f}ms "
+              f"statuses={statuses}")
+        for status, body in failures.items():
+            print(f"  {status}: {body.strip()}")
+
+
+def collect(workers, results):
+    """Результаты всех процессов бота; падение процесса - ошибка, а не вечное ожидание"""
+    outcomes = []
+    while len(outcomes) < len(workers):
+        try:
+            outcomes.append(results.get(timeout=1))
+        except queue.Empty:
+            dead = [worker.name for worker in workers if worker.exitcode not in (None, 0)]
+            if dead:
+                raise RuntimeError(f"bot worker crashed: {', '.join(dead)}")
+    return outcomes
+
+
+async def drive(args, workers, barrier, results, web_url):
+    """Ждет процессы бота, параллельно нагружая веб-API"""
+    # Старт вместе с ботами: до их on_startup в базе еще нет таблиц
+    await asyncio.to_thread(barrier.wait)
+    stop = asyncio.Event()
+    web_task = None
+    if web_url is not None:
+        web_task = asyncio.create_task(web_load(web_url, args.web_concurrency, stop))
+    try:
+        outcomes = await asyncio.to_thread(collect, workers, results)
+    finally:
+        stop.set()
+    web = await web_task if web_task is not None else None
+    return outcomes, web
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="покупателей всего")
+    parser.add_argument("--concurrency", type=int, default=10, help="одновременных покупателей в процессе")
+    parser.add_argument("--processes", type=int, default=1, help="процессов бота на общей базе")
+    parser.add_argument("--moderation-latency", type=float, default=0.05, help="задержка заглушки модерации, сек")
+    parser.add_argument("--max-retries", type=int, default=1000, help="повторов счета на пользователя")
+    parser.add_argument("--retry-delay", type=float, default=0.05, help="пауза перед новым счетом после отказа, сек")
+    parser.add_argument("--web-concurrency", type=int, default=20, help="клиентов веб-API (0 - без веб-нагрузки)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_environment(tmp)
+        db_path = os.path.join(tmp, "bench.db")
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(args.processes + 1)
+        results = context.Queue()
+        share = [args.users // args.processes + (i < args.users % args.processes) for i in range(args.processes)]
+        workers = [
+            context.Process(target=bot_worker, args=(
+                tmp, db_path, i, share[i], args.concurrency, args.moderation_latency, args.max_retries,
+                args.retry_delay, barrier, results))
+            for i in range(args.processes)
+        ]
+        server = None
+        web_url = None
+        try:
+            for worker in workers:
+                worker.start()
+            if args.web_concurrency > 0:
+                ports = context.Queue()
+                server = context.Process(target=web_worker, args=(tmp, db_path, ports), daemon=True)
+                server.start()
+                web_url = f"http://127.0.0.1:{ports.get(timeout=60)}"
+            outcomes, web = asyncio.run(drive(args, workers, barrier, results, web_url))
+            for worker in workers:
+                worker.join()
+        finally:
+            for process in workers + [server]:
+                if process is not None and process.is_alive():
+                    process.terminate()
+                    process.join()
+        report(args, outcomes, web)
+    failed = sum(outcome["counters"]["failed"] for outcome in outcomes)
+    if failed:
+        print(f"FAIL: {failed} purchases broke on handler errors")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
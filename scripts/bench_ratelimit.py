@@ -0,0 +1,106 @@
+"""
+Микробенчмарк ограничителя запросов: прежний (списки времен по всем IP) против
+token bucket в общей памяти, при разном числе активных IP.
+
+Сначала каждый IP делает по запросу (таблица заполнена), затем меряется
+средняя стоимость allow() на случайных IP. Напоследок несколько процессов бьют
+в один IP через общую таблицу: суммарно пропущено должно быть ровно
+max_requests.
+
+    python scripts/bench_ratelimit.py --ips 1000,10000,100000
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import ratelimit  # noqa: E402
+from ratelimit import RateLimiter  # noqa: E402
+
+
+class LegacyRateLimiter:
+    """Прежняя реализация: на каждый запрос чистит историю всех IP"""
+
+    def __init__(self, max_requests=30, window=60):
+        self.max_requests = max_requests
+        self.window = window
+        self.history = {}
+
+    def allow(self, key):
+        now = time.time()
+        for ip in list(self.history.keys()):
+            self.history[ip] = [req for req in self.history[ip] if now - req < self.window]
+        requests = self.history.setdefault(key, [])
+        if len(requests) >= self.max_requests:
+            return False
+        requests.append(now)
+        return True
+
+
+def cost_us(limiter, ips, calls):
+    if isinstance(limiter, LegacyRateLimiter):
+        # Заполнить через allow() - O(n^2), поэтому пишем историю напрямую
+        now = time.time()
+        limiter.history = {ip: [now] for ip in ips}
+    else:
+        for ip in ips:
+            limiter.allow(ip)
+    sample = [random.choice(ips) for _ in range(calls)]
+    started = time.perf_counter()
+    for ip in sample:
+        limiter.allow(ip)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def hammer(directory, name, requests, barrier, results):
+    ratelimit.RATE_LIMIT_DIR = directory
+    limiter = RateLimiter(max_requests=60, window=60, name=name)
+    barrier.wait()
+    results.put(sum(limiter.allow("203.0.113.7") for _ in range(requests)))
+
+
+def check_shared(directory, processes, requests):
+    name = "bench_shared"
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    workers = [context.Process(target=hammer, args=(directory, name, requests, barrier, results)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    allowed = sum(results.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    return allowed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ips", default="1000,10000,100000", help="числа активных IP через запятую")
+    parser.add_argument("--calls", type=int, default=100000, help="замеров allow() для token bucket")
+    parser.add_argument("--legacy-calls", type=int, default=50, help="замеров для прежнего (он медленный)")
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ratelimit.RATE_LIMIT_DIR = tmp
+        print(f"{'ips':>8} {'legacy µs/call':>15} {'local µs/call':>14} {'shared µs/call':>15}")
+        for count in (int(value) for value in args.ips.split(",")):
+            ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(count)]
+            legacy = cost_us(LegacyRateLimiter(60, 60), ips, args.legacy_calls)
+            local = cost_us(RateLimiter(60, 60), ips, args.calls)
+            shared = cost_us(RateLimiter(60, 60, name=f"bench_{count}"), ips, args.calls)
+            print(f"{count:>8} {legacy:>15.1f} {local:>14.2f} {shared:>15.2f}")
+
+        allowed = check_shared(tmp, args.processes, 100)
+    print(f"shared limit: {args.processes} processes x 100 requests from one IP -> {allowed} allowed (limit 60)")
+    if allowed != 60:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
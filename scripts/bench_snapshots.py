@@ -0,0 +1,104 @@
+"""
+Ответы /api/current и /api/hall-of-fame из готовых снимков против сборки на
+каждый запрос (jsonify, как было раньше): время на запрос через Flask test
+client (одинаковая обвязка для обоих), ответ 304 по ETag и размер тела без
+сжатия, с gzip и brotli ("-", если пакет brotli не установлен).
+
+    python scripts/bench_snapshots.py --requests 5000 --kings 200
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def per_request_us(fn, count, rounds=5):
+    """Лучший из rounds прогонов по count / rounds запросов: разброс машины меньше разницы путей"""
+    per_round = max(1, count // rounds)
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(per_round):
+            fn()
+        elapsed = (time.perf_counter() - started) / per_round * 1e6
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--kings", type=int, default=200, help="покупок в истории")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["RATE_LIMIT_DIR"] = tmp
+        os.environ["METRICS_DIR"] = ""
+        import database  # noqa: E402
+        database.DB_NAME = os.path.join(tmp, "bench.db")
+
+        async def seed():
+            await database.open_db()
+            await database.init_db()
+            for i in range(args.kings):
+                await database.update_game_state(
+                    user_id=1000 + i, photo_id=f"AgACAgIAAxkBAAI{i:08d}", text=f"King number {i} 👑",
+                    user_link=f"@king_{i}", new_price=10 + i,
+                )
+            await database.close_db()
+
+        asyncio.run(seed())
+
+        from flask import jsonify, request  # noqa: E402
+
+        import webapp  # noqa: E402
+        from payloads import current_payload, hall_of_fame_payload  # noqa: E402
+
+        client = webapp.app.test_client()
+        # 127.0.0.1 - доверенный прокси: у каждого запроса свой X-Real-IP, лимит 60/мин не мешает
+        ips = itertools.count(1)
+
+        def get(url, **headers):
+            n = next(ips)
+            headers["X-Real-IP"] = f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}"
+            return client.get(url, headers=headers)
+
+        # Прежние обработчики: сборка и jsonify на каждый запрос, с тем же rate limit
+        @webapp.app.route("/bench/jsonify/current")
+        @webapp.rate_limit(webapp.api_limiter)
+        def jsonify_current():
+            return jsonify(current_payload(database.get_game_state_sync()))
+
+        @webapp.app.route("/bench/jsonify/hall-of-fame")
+        @webapp.rate_limit(webapp.api_limiter)
+        def jsonify_hall():
+            limit = int(request.args.get("limit", 10))
+            return jsonify(hall_of_fame_payload(database.get_hall_of_fame_sync(limit=limit), limit))
+
+        print(f"{'endpoint':<28} {'jsonify':>9} {'snapshot':>9} {'304':>9}  bytes (plain/gzip/br)")
+        for name, url, old_url in (
+            ("/api/current", "/api/current", "/bench/jsonify/current"),
+            ("/api/hall-of-fame?limit=50", "/api/hall-of-fame?limit=50", "/bench/jsonify/hall-of-fame?limit=50"),
+        ):
+            old = per_request_us(lambda: get(old_url), args.requests)
+            plain = get(url)
+            gzipped = get(url, **{"Accept-Encoding": "gzip"})
+            brotli = get(url, **{"Accept-Encoding": "br"})
+            served = per_request_us(lambda: get(url, **{"Accept-Encoding": "gzip"}), args.requests)
+            etag = gzipped.headers["ETag"]
+            revalidated = per_request_us(lambda: get(url, **{"If-None-Match": etag}), args.requests)
+            assert get(url, **{"If-None-Match": etag}).status_code == 304
+            sizes = "/".join(
+                str(len(response.data)) if response.headers.get("Content-Encoding") == encoding else "-"
+                for response, encoding in ((plain, None), (gzipped, "gzip"), (brotli, "br"))
+            )
+            print(f"{name:<28} {old:>7.0f}us {served:>7.0f}us {revalidated:>7.0f}us  {sizes}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Сколько вызовов Bot API экономит ThrottlingMiddleware при спаме.
+
+Через dp.feed_update с FakeSession (без сети) прогоняются спамеры, которые
+жмут /start, /buy и кнопку buy_1 очередями, и обычные пользователи с одним
+/start. Сравниваются вызовы Bot API без middleware и с ним, плюс счетчики
+middleware.
+
+    python scripts/bench_throttling.py --spammers 50 --burst 20 --users 200
+"""
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("GOOGLE_API_KEY", "bench")
+# Ведра лимитера - во временном каталоге, чтобы прогоны не влияли друг на друга
+RATE_LIMIT_DIR = tempfile.mkdtemp()
+os.environ["RATE_LIMIT_DIR"] = RATE_LIMIT_DIR
+
+from aiogram.types import Update  # noqa: E402
+
+import bot as bot_module  # noqa: E402
+import database  # noqa: E402
+from fake_session import FakeSession  # noqa: E402
+from throttling import ThrottlingMiddleware  # noqa: E402
+
+
+def message(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+        "from": user, "text": text}}
+
+
+def callback(update_id, user_id, data):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user, "chat_instance": "bench", "data": data,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": 123456, "is_bot": True, "first_name": "Bot"}, "text": "Choose Your Entry"}}}
+
+
+def scenario(spammers, burst, users, offset):
+    """Очереди обновлений по пользователям: спамеры и обычные"""
+    update_ids = iter(range(offset, offset + 10**7))
+    queues = []
+    for i in range(spammers):
+        user_id = offset + i
+        queue = [message(next(update_ids), user_id, "/start") for _ in range(burst)]
+        queue += [message(next(update_ids), user_id, "/buy") for _ in range(burst // 2)]
+        queue += [callback(next(update_ids), user_id, "buy_1") for _ in range(burst)]
+        queues.append(queue)
+    for i in range(users):
+        queues.append([message(next(update_ids), offset + spammers + i, "/start")])
+    return queues
+
+
+async def feed(queues):
+    dp, bot = bot_module.dp, bot_module.bot
+    bot.session = FakeSession()
+    started = time.perf_counter()
+
+    async def client(queue):
+        for raw in queue:
+            await dp.feed_update(bot, Update.model_validate(raw, context={"bot": bot}))
+
+    await asyncio.gather(*(client(queue) for queue in queues))
+    return bot.session.calls, time.perf_counter() - started
+
+
+async def run(spammers, burst, users):
+    bot_module.bot.session = FakeSession()
+    await bot_module.on_startup()
+    dp = bot_module.dp
+    try:
+        # Без middleware
+        dp.message.outer_middleware.unregister(bot_module.throttling)
+        dp.callback_query.outer_middleware.unregister(bot_module.throttling)
+        before, before_elapsed = await feed(scenario(spammers, burst, users, 1_000_000))
+
+        throttling = ThrottlingMiddleware(name="bench")
+        dp.message.outer_middleware(throttling)
+        dp.callback_query.outer_middleware(throttling)
+        after, after_elapsed = await feed(scenario(spammers, burst, users, 2_000_000))
+    finally:
+        await bot_module.on_shutdown()
+
+    updates = spammers * (burst * 2 + burst // 2) + users
+    print(f"spammers={spammers} burst={burst} users={users} updates={updates}")
+    print(f"{'Bot API method':<24} {'without':>8} {'with':>8}")
+    for method in sorted(set(before) | set(after)):
+        print(f"{method:<24} {before.get(method, 0):>8} {after.get(method, 0):>8}")
+    print(f"{'total':<24} {sum(before.values()):>8} {sum(after.values()):>8}")
+    print(f"elapsed: {before_elapsed:.2f}s without, {after_elapsed:.2f}s with")
+    print(f"middleware: {throttling.stats()}")
+
+
+def main():
+    logging.disable(logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--spammers", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=20, help="повторов /start и buy_1 у каждого спамера")
+    parser.add_argument("--users", type=int, default=200, help="обычных пользователей с одним /start")
+    args = parser.parse_args()
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            database.DB_NAME = os.path.join(tmp, "bench.db")
+            asyncio.run(run(args.spammers, args.burst, args.users))
+    finally:
+        shutil.rmtree(RATE_LIMIT_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
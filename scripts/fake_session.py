@@ -0,0 +1,41 @@
+"""
+Сессия aiogram без сети: отвечает на методы Bot API готовыми объектами.
+
+Позволяет гонять обновления через dp.feed_update и мерить цепочку
+обработчиков (FSM, БД, логика бота) без Telegram.
+"""
+import itertools
+import time
+import typing
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message
+
+
+class FakeSession(BaseSession):
+    """Считает вызовы методов; Message-методы возвращают сообщение, остальные - True"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = {}
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        returning = method.__returning__
+        if returning is Message or Message in typing.get_args(returning):
+            chat_id = getattr(method, "chat_id", None)
+            chat_id = chat_id if isinstance(chat_id, int) else 1
+            return Message(
+                message_id=next(self._message_ids),
+                date=int(time.time()),
+                chat=Chat(id=chat_id, type="private"),
+            ).as_(bot)
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
@@ -0,0 +1,160 @@
+"""
+Нагрузочный тест веб-API против локальной заглушки Telegram Bot API.
+
+По умолчанию поднимает в одном процессе заглушку Telegram (с искусственной
+задержкой) и webapp_async на временной БД, затем гоняет N параллельных
+клиентов по выбранному эндпоинту и печатает req/s и p50/p99.
+
+    python scripts/load_webapp.py --concurrency 50 --duration 10
+    python scripts/load_webapp.py --path /health
+    python scripts/load_webapp.py --path "/api/photo/uncached_{n}"   # {n} - номер запроса, мимо кэша фото
+    python scripts/load_webapp.py --path "/api/photo/load_test_photo?size=128"
+
+Чтобы сравнить с Flask/gunicorn, запустите заглушку отдельно и направьте
+сервер на нее через TELEGRAM_API_URL:
+
+    python scripts/load_webapp.py --stub-only --stub-port 8099
+    TELEGRAM_API_URL=http://127.0.0.1:8099 gunicorn --workers 2 --bind 127.0.0.1:5000 webapp:app
+    python scripts/load_webapp.py --target http://127.0.0.1:5000
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+
+def make_fake_photo(width=1280, height=960):
+    """Настоящий JPEG, чтобы ?size= мог построить превью"""
+    from io import BytesIO
+    from PIL import Image
+
+    out = BytesIO()
+    Image.linear_gradient("L").resize((width, height)).convert("RGB").save(out, format="JPEG", quality=85)
+    return out.getvalue()
+
+
+FAKE_PHOTO = make_fake_photo()
+
+
+def create_stub(latency):
+    """Заглушка Telegram: getFile и скачивание файла, каждый с задержкой latency секунд"""
+    async def get_file(request):
+        await asyncio.sleep(latency)
+        file_id = request.query.get("file_id", "")
+        return web.json_response({"ok": True, "result": {"file_id": file_id, "file_path": f"photos/{file_id}.jpg"}})
+
+    async def download(request):
+        await asyncio.sleep(latency)
+        return web.Response(body=FAKE_PHOTO, content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/bot{token}/getFile", get_file)
+    app.router.add_get("/file/bot{token}/{path:.*}", download)
+    return app
+
+
+async def start_site(app, port=0):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_load(url, concurrency, duration):
+    latencies = []
+    statuses = {}
+    deadline = time.perf_counter() + duration
+    counter = itertools.count()
+
+    async def client(session):
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                async with session.get(url.replace("{n}", str(next(counter)))) as response:
+                    await response.read()
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+            except aiohttp.ClientError:
+                statuses["error"] = statuses.get("error", 0) + 1
+                continue
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    print(f"GET {url}")
+    print(f"concurrency={concurrency} duration={elapsed:.1f}s requests={len(latencies)} statuses={statuses}")
+    if latencies:
+        print(
+            f"throughput={len(latencies) / elapsed:.1f} req/s "
+            f"p50={percentile(latencies, 50):.1f}ms p99={percentile(latencies, 99):.1f}ms"
+        )
+
+
+async def main(args):
+    stub_runner, stub_url = await start_site(create_stub(args.latency), args.stub_port)
+    print(f"Telegram stub at {stub_url} (latency {args.latency * 1000:.0f}ms per call)")
+
+    if args.stub_only:
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await stub_runner.cleanup()
+
+    app_runner = None
+    target = args.target
+    if target is None:
+        import database
+        import webapp_async
+        from photo_cache import photo_cache
+
+        database.DB_NAME = os.path.join(args.tmp, "load.db")
+        photo_cache.directory = os.path.join(args.tmp, "photo_cache")
+        webapp_async.TELEGRAM_API_URL = stub_url
+        webapp_async.BOT_TOKEN = "stub"
+        app_runner, target = await start_site(webapp_async.create_app())
+
+    try:
+        await run_load(target + args.path, args.concurrency, args.duration)
+    finally:
+        if app_runner is not None:
+            await app_runner.cleanup()
+        await stub_runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=50, help="параллельных клиентов")
+    parser.add_argument("--duration", type=float, default=10, help="длительность, сек")
+    parser.add_argument("--path", default="/api/photo/load_test_photo", help="эндпоинт под нагрузкой")
+    parser.add_argument("--latency", type=float, default=0.2, help="задержка заглушки Telegram на вызов, сек")
+    parser.add_argument("--target", help="URL уже запущенного сервера (иначе webapp_async в этом процессе)")
+    parser.add_argument("--stub-only", action="store_true", help="только поднять заглушку Telegram и ждать")
+    parser.add_argument("--stub-port", type=int, default=0, help="порт заглушки (0 - любой свободный)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        args.tmp = tmp
+        try:
+            asyncio.run(main(args))
+        except KeyboardInterrupt:
+            pass
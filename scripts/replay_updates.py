@@ -0,0 +1,155 @@
+"""
+Воспроизведение записанных обновлений Telegram на webhook бота.
+
+Шлет JSON-обновления (файл с массивом или по одному на строку) на локальный
+webhook с заголовком секрета и печатает статусы, updates/s и p50/p99.
+Заодно может поднять заглушку Bot API, чтобы ответы бота (sendMessage,
+sendInvoice, ...) не уходили в настоящий Telegram:
+
+    python scripts/replay_updates.py --stub-only --stub-port 8099
+    BOT_MODE=webhook BOT_WORKERS=2 TELEGRAM_API_URL=http://127.0.0.1:8099 python bot.py
+    python scripts/replay_updates.py --file updates.jsonl --concurrency 20
+    python scripts/replay_updates.py --synthetic 500     # /start от 500 разных пользователей
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from load_webapp import start_site, percentile  # noqa: E402
+
+# Методы Bot API, которые возвращают Message
+MESSAGE_METHODS = {"sendMessage", "sendPhoto", "sendInvoice", "sendDocument", "editMessageText"}
+
+
+def create_stub():
+    """Заглушка Bot API: отвечает ok на любой метод"""
+    message_ids = itertools.count(1)
+
+    async def method(request):
+        name = request.match_info["method"]
+        params = dict(await request.post()) if request.can_read_body else {}
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        elif name in MESSAGE_METHODS:
+            chat_id = params.get("chat_id", "1")
+            chat_id = int(chat_id) if str(chat_id).lstrip("-").isdigit() else 1
+            result = {
+                "message_id": next(message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", method)
+    app.router.add_get("/bot{token}/{method}", method)
+    return app
+
+
+def load_updates(path):
+    with open(path, encoding="utf-8") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def synthetic_updates(count):
+    """/start от count разных пользователей"""
+    now = int(time.time())
+    updates = []
+    for i in range(1, count + 1):
+        user = {"id": 10_000 + i, "is_bot": False, "first_name": f"User{i}"}
+        updates.append({
+            "update_id": i,
+            "message": {
+                "message_id": i,
+                "date": now,
+                "chat": {"id": user["id"], "type": "private"},
+                "from": user,
+                "text": "/start",
+            },
+        })
+    return updates
+
+
+async def replay(url, secret, updates, concurrency):
+    statuses = {}
+    samples = []
+    queue = iter(updates)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+
+    async def client(session):
+        for update in queue:
+            started = time.perf_counter()
+            try:
+                async with session.post(url, json=update, headers=headers) as response:
+                    await response.read()
+                    status = response.status
+            except aiohttp.ClientError as e:
+                status = type(e).__name__
+            samples.append((time.perf_counter() - started) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    print(f"updates={len(samples)} concurrency={concurrency} elapsed={elapsed:.2f}s")
+    print(f"updates/s={len(samples) / elapsed:.0f} p50={percentile(samples, 50):.1f}ms p99={percentile(samples, 99):.1f}ms")
+    print(f"statuses={statuses}")
+    return statuses
+
+
+async def serve_stub(port):
+    runner, url = await start_site(create_stub(), port)
+    print(f"Bot API stub on {url} (TELEGRAM_API_URL={url}), Ctrl+C to stop")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook", help="адрес webhook бота")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET"), help="WEBHOOK_SECRET бота")
+    parser.add_argument("--file", help="записанные обновления (JSON-массив или JSON lines)")
+    parser.add_argument("--synthetic", type=int, default=0, help="сгенерировать N обновлений /start")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--stub-only", action="store_true", help="только поднять заглушку Bot API")
+    parser.add_argument("--stub-port", type=int, default=8099)
+    args = parser.parse_args()
+
+    if args.stub_only:
+        try:
+            asyncio.run(serve_stub(args.stub_port))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.file:
+        updates = load_updates(args.file)
+    elif args.synthetic:
+        updates = synthetic_updates(args.synthetic)
+    else:
+        parser.error("нужен --file или --synthetic")
+    statuses = asyncio.run(replay(args.url, args.secret, updates, args.concurrency))
+    if set(statuses) != {200}:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
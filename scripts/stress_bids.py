@@ -0,0 +1,163 @@
+"""
+Стресс-тест bid_engine: сотни покупателей одновременно пытаются купить трон.
+
+Каждый покупатель берет котировку и сразу подает заявку (как pre-checkout);
+при отказе из-за перекупки или чужой незавершенной покупки берет новую
+котировку и пробует снова, пока не купит. Победитель сразу завершает покупку:
+оплата и коронация. Покупатели распределены по нескольким процессам с отдельными
+соединениями к одной базе, как воркеры webhook.
+
+В конце проверяется, что ни одна покупка не потерялась и не задвоилась:
+каждый покупатель купил ровно один раз, каждый царь заплатил не меньше
+предыдущего +10%, а price_basis равна последней оплате. Оплата, которую
+перекупили до коронации (outbid), возвращается, и покупатель пробует снова.
+
+    python scripts/stress_bids.py --buyers 300 --processes 4
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# Котировки без кэша по времени: устаревшие все равно отсеет claim_throne, но так меньше лишних попыток
+os.environ.setdefault("STATE_CACHE_TTL", "0")
+
+import database  # noqa: E402
+from bid_engine import (  # noqa: E402
+    quote, claim_throne, confirm_payment, crown, CROWNED, init_bid_engine, next_base_price, BUSY_ERROR, PENDING_ERROR,
+)
+
+
+async def buyer(user_id, start, stats):
+    await start.wait()
+    while True:
+        price = await quote(1)
+        ok, error = await claim_throne(user_id, price.payload, price.price)
+        stats["attempts"] += 1
+        if ok:
+            if not await confirm_payment(user_id, price.payload, f"charge_{user_id}"):
+                stats["refused"] += 1
+                continue
+            result, _ = await crown(user_id, f"photo_{user_id}", "", "")
+            if result != CROWNED:
+                stats["refused"] += 1
+                continue
+            return
+        if error == BUSY_ERROR:
+            stats["busy"] += 1
+        elif error == PENDING_ERROR:
+            stats["pending"] += 1
+        # Перекупили - пользователь запрашивает новый счет не мгновенно
+        await asyncio.sleep(random.uniform(0, 0.05))
+
+
+async def run_buyers(db_name, user_ids):
+    database.DB_NAME = db_name
+    await database.open_db()
+    stats = {"attempts": 0, "busy": 0, "pending": 0, "refused": 0}
+    start = asyncio.Event()
+    tasks = [asyncio.create_task(buyer(user_id, start, stats)) for user_id in user_ids]
+    start.set()
+    await asyncio.gather(*tasks)
+    await database.close_db()
+    return stats
+
+
+def worker(db_name, user_ids, barrier, results):
+    # Отказы "база занята" считаются в статистике, не в логе
+    logging.disable(logging.WARNING)
+    barrier.wait()
+    results.put(asyncio.run(run_buyers(db_name, user_ids)))
+
+
+async def prepare(db_name):
+    database.DB_NAME = db_name
+    await database.open_db()
+    await database.init_db()
+    await init_bid_engine()
+    await database.close_db()
+
+
+async def verify(db_name, buyers):
+    database.DB_NAME = db_name
+    await database.open_db()
+    db = await database.get_db()
+    # Цари в порядке коронации
+    bids = await db.execute_fetchall(
+        "SELECT e.id, b.user_id, b.amount FROM bids b JOIN game_events e ON e.user_id = b.user_id AND e.kind = 'purchase' "
+        "WHERE b.status = 'settled' ORDER BY e.id"
+    )
+    async with db.execute("SELECT value FROM game_meta WHERE key = 'price_basis'") as cursor:
+        price_basis = (await cursor.fetchone())[0]
+    await database.close_db()
+
+    errors = []
+    winners = [user_id for _, user_id, _ in bids]
+    if sorted(winners) != list(range(1, buyers + 1)):
+        errors.append(f"expected every buyer to win once, got {len(winners)} bids from {len(set(winners))} buyers")
+    previous = 1
+    for event_id, user_id, amount in bids:
+        if amount < next_base_price(previous):
+            errors.append(f"king {user_id}: amount {amount} < {next_base_price(previous)}")
+            break
+        previous = amount
+    if bids and price_basis != bids[-1][2]:
+        errors.append(f"price_basis {price_basis} != last bid {bids[-1][2]}")
+    return len(bids), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # Цена растет на 10% за покупку: ~450 покупок - предел INTEGER в SQLite
+    parser.add_argument("--buyers", type=int, default=300)
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+    if args.buyers > 400:
+        parser.error("--buyers must be <= 400 (price overflows int64 after ~450 purchases)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_name = os.path.join(tmp, "stress.db")
+        asyncio.run(prepare(db_name))
+
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(args.processes + 1)
+        results = context.Queue()
+        user_ids = list(range(1, args.buyers + 1))
+        processes = [
+            context.Process(target=worker, args=(db_name, user_ids[i::args.processes], barrier, results))
+            for i in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        barrier.wait()
+        started = time.perf_counter()
+        stats = [results.get() for _ in processes]
+        attempts = sum(s["attempts"] for s in stats)
+        busy = sum(s["busy"] for s in stats)
+        pending = sum(s["pending"] for s in stats)
+        refused = sum(s["refused"] for s in stats)
+        elapsed = time.perf_counter() - started
+        for process in processes:
+            process.join()
+
+        accepted, errors = asyncio.run(verify(db_name, args.buyers))
+
+    print(f"buyers={args.buyers} processes={args.processes} elapsed={elapsed:.2f}s")
+    print(f"accepted={accepted} attempts={attempts} conflicts={attempts - accepted - busy - pending} "
+          f"pending={pending} busy={busy} refunded={refused}")
+    print(f"claims/s={accepted / elapsed:.0f} attempts/s={attempts / elapsed:.0f}")
+    if errors:
+        for error in errors:
+            print(f"FAIL: {error}")
+        sys.exit(1)
+    print("OK: no lost or duplicated purchases")
+
+
+if __name__ == "__main__":
+    main()
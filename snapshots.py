@@ -0,0 +1,142 @@
+"""
+Готовые JSON-ответы /api/current и /api/hall-of-fame.
+
+Оба ответа зависят только от state_version: ее увеличивает любая запись, меняющая
+царя или историю покупок. Поэтому тело сериализуется и сжимается (gzip и, если
+установлен пакет brotli, br) один раз на версию, а запросы отдают готовые байты
+с ETag и 304. Cache-Control разрешает nginx (proxy_cache в deploy.sh) держать
+ответ SNAPSHOT_MAX_AGE секунд - почти все опросы Mini App не доходят до Python.
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # без brotli отдаем gzip
+    brotli = None
+
+# Столько же, сколько STATE_CACHE_TTL: дольше ответ устаревает и без nginx
+SNAPSHOT_MAX_AGE = int(os.getenv("SNAPSHOT_MAX_AGE", "1"))
+SNAPSHOT_CACHE_CONTROL = f"public, max-age={SNAPSHOT_MAX_AGE}, stale-while-revalidate={SNAPSHOT_MAX_AGE * 5}"
+# Ответов на одну версию: /api/current и страницы Hall of Fame (limit x cursor)
+SNAPSHOT_MAX_ENTRIES = 256
+
+SNAPSHOT_RESULTS = metrics.counter("api_snapshots_total", "Snapshot lookups by result", ("result",))
+
+
+class Snapshot:
+    """Сериализованный ответ: исходные байты и сжатые варианты (None, если сжатие не помогло)"""
+
+    def __init__(self, version, payload):
+        self.version = version
+        self.body = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode()
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        # mtime=0: одинаковые байты во всех воркерах gunicorn
+        self.encodings = {"gzip": _smaller(gzip.compress(self.body, compresslevel=9, mtime=0), self.body)}
+        if brotli is not None:
+            self.encodings["br"] = _smaller(brotli.compress(self.body, quality=11), self.body)
+        # Заголовки тоже один раз на версию: запрос только выбирает готовый словарь
+        self.headers = {None: _headers(self.etag, None)}
+        self.not_modified_headers = {None: _not_modified(self.headers[None])}
+        for encoding, body in self.encodings.items():
+            if body is not None:
+                self.headers[encoding] = _headers(self.etag, encoding)
+                self.not_modified_headers[encoding] = _not_modified(self.headers[encoding])
+
+
+def _smaller(compressed, body):
+    return compressed if len(compressed) < len(body) else None
+
+
+class SnapshotCache:
+    """Ответы для последней увиденной версии; новая версия выбрасывает все старые"""
+
+    def __init__(self, max_entries=SNAPSHOT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._version = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, version, key):
+        """Готовый ответ для (version, key) или None"""
+        with self._lock:
+            snapshot = self._entries.get(key) if version == self._version else None
+        SNAPSHOT_RESULTS.inc("hit" if snapshot is not None else "miss")
+        return snapshot
+
+    def put(self, version, key, payload):
+        """Сериализует payload; запоминает, если версия не старее последней"""
+        snapshot = Snapshot(version, payload)
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._version = version
+                self._entries = {}
+            if version == self._version and len(self._entries) < self.max_entries:
+                self._entries[key] = snapshot
+        return snapshot
+
+
+def pick_encoding(snapshot, accept_encoding):
+    """Лучшее сжатие, которое принимает клиент и которое есть у ответа; None - без сжатия"""
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.partition(";")
+        try:
+            weight = float(params.strip().removeprefix("q=") or 1)
+        except ValueError:
+            weight = 1
+        if weight > 0:
+            accepted.add(name.strip().lower())
+    for encoding in ("br", "gzip"):
+        if (encoding in accepted or "*" in accepted) and snapshot.encodings.get(encoding) is not None:
+            return encoding
+    return None
+
+
+def _headers(etag, encoding):
+    """Заголовки ответа; у каждого варианта сжатия свой ETag"""
+    headers = {
+        "Content-Type": "application/json",
+        "ETag": f'"{etag}-{encoding}"' if encoding else f'"{etag}"',
+        "Cache-Control": SNAPSHOT_CACHE_CONTROL,
+        "Vary": "Accept-Encoding",
+    }
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return headers
+
+
+def _not_modified(headers):
+    """Заголовки 304: без Content-Type и Content-Encoding, тела нет"""
+    return {name: value for name, value in headers.items() if name not in ("Content-Type", "Content-Encoding")}
+
+
+def snapshot_headers(snapshot, encoding):
+    """Готовые заголовки ответа (общие для всех запросов - не изменять)"""
+    return snapshot.headers[encoding]
+
+
+def snapshot_body(snapshot, encoding):
+    return snapshot.encodings[encoding] if encoding else snapshot.body
+
+
+def snapshot_not_modified(snapshot, if_none_match):
+    """Готовые заголовки 304, если у клиента уже есть эта версия ответа (в любом сжатии;
+    W/ добавляет nginx), иначе None. ETag в 304 - того варианта, что прислал клиент"""
+    if not if_none_match:
+        return None
+    for tag in if_none_match.split(","):
+        tag = tag.strip().removeprefix("W/").strip('"')
+        etag, _, encoding = tag.partition("-")
+        if tag == "*" or etag == snapshot.etag:
+            SNAPSHOT_RESULTS.inc("not_modified")
+            return snapshot.not_modified_headers.get(encoding or None, snapshot.not_modified_headers[None])
+    return None
+
+
+snapshots = SnapshotCache()
@@ -37,7 +37,7 @@ function displayCurrentKing(data) {
     const photoContainer = document.getElementById('kingPhoto');
     if (data.photo_id && data.photo_id !== '') {
         // Показываем фото напрямую через наш API
-        const photoUrl = `${API_BASE}/api/photo/${data.photo_id}`;
+        const photoUrl = `${API_BASE}/api/photo/${data.photo_id}?size=480`;
         photoContainer.innerHTML = `<img src="${photoUrl}" alt="THE ONE" onerror="this.parentElement.innerHTML='<div style=\\'font-size: 5em;\\'>👑</div>'">`;
     } else {
         photoContainer.innerHTML = '<div style="font-size: 5em;">👑</div>';
@@ -110,7 +110,7 @@ function displayHallOfFame(data) {
         
         // Фото для Hall of Fame
         const photoHtml = item.photo_id 
-            ? `<div class="hall-photo"><img src="${API_BASE}/api/photo/${item.photo_id}" alt="${displayName}"></div>`
+            ? `<div class="hall-photo"><img src="${API_BASE}/api/photo/${item.photo_id}?size=128" alt="${displayName}" loading="lazy"></div>`
             : `<div class="hall-photo" style="display: flex; align-items: center; justify-content: center; font-size: 1.5em;">👑</div>`;
         
         // Текст (если есть)
@@ -194,17 +194,56 @@ document.getElementById('shareBtn').addEventListener('click', () => {
     tg.openTelegramLink(`https://t.me/share/url?url=${encodeURIComponent(shareUrl)}&text=${encodeURIComponent(shareText)}`);
 });
 
-// Initialize app
-async function init() {
-    await loadCurrentKing();
-    await loadHallOfFame();
-    
+// Polling - запасной вариант, пока поток обновлений недоступен
+let pollTimer = null;
+let liveVersion = null;
+
+function startPolling() {
+    if (pollTimer) return;
     // Обновляем данные каждые 30 секунд
-    setInterval(async () => {
+    pollTimer = setInterval(async () => {
         await loadCurrentKing();
         await loadHallOfFame();
     }, 30000);
 }
 
+function stopPolling() {
+    if (!pollTimer) return;
+    clearInterval(pollTimer);
+    pollTimer = null;
+}
+
+// Live updates: сервер сам присылает нового короля (Server-Sent Events)
+function subscribeToUpdates() {
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+
+    const source = new EventSource(`${API_BASE}/api/stream`);
+
+    source.addEventListener('state', (event) => {
+        const message = JSON.parse(event.data);
+        const changed = liveVersion !== null && message.version !== liveVersion;
+        liveVersion = message.version;
+        currentKingData = message.data;
+        displayCurrentKing(message.data);
+        // Hall of Fame перезагружаем только если что-то изменилось
+        if (changed) loadHallOfFame();
+    });
+
+    source.addEventListener('open', () => stopPolling());
+
+    // Браузер сам переподключается; пока соединения нет - опрашиваем по таймеру
+    source.addEventListener('error', () => startPolling());
+}
+
+// Initialize app
+async function init() {
+    await loadCurrentKing();
+    await loadHallOfFame();
+    subscribeToUpdates();
+}
+
 // Start app
 init();
@@ -0,0 +1,113 @@
+"""
+Защита бота от спама командами и кнопками (outer middleware aiogram).
+
+Каждая команда и нажатие кнопки стоят чтения БД, расчета цены и вызова
+Bot API (sendMessage / sendInvoice). Middleware отсекает лишнее до фильтров
+и обработчиков:
+- одинаковая команда или кнопка от того же пользователя в течение
+  THROTTLE_DEDUPE_WINDOW сек не обрабатывается повторно: ответ на первую
+  (сообщение, счет) уже у пользователя на экране;
+- token bucket на пользователя (THROTTLE_USER_LIMIT за THROTTLE_USER_WINDOW сек)
+  и общий на бота (THROTTLE_GLOBAL_RATE в секунду, 0 - без общего лимита).
+
+Ведра - ratelimit.RateLimiter в общей памяти, лимиты едины для всех воркеров
+webhook; окно повторов и счетчики - свои в каждом процессе. Обычный текст
+(ответы в диалогах: пароль админа, ID для блокировки, подпись), оплата, фото,
+файлы и все от exempt_user_ids (админ) не ограничиваются никогда.
+"""
+import os
+import time
+from collections import Counter, OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message
+
+from ratelimit import RateLimiter
+
+THROTTLE_USER_LIMIT = int(os.getenv("THROTTLE_USER_LIMIT", "5"))
+THROTTLE_USER_WINDOW = float(os.getenv("THROTTLE_USER_WINDOW", "5"))
+THROTTLE_GLOBAL_RATE = int(os.getenv("THROTTLE_GLOBAL_RATE", "100"))
+THROTTLE_DEDUPE_WINDOW = float(os.getenv("THROTTLE_DEDUPE_WINDOW", "1.0"))
+
+SLOW_DOWN = "⏳ Too many requests, please slow down."
+
+
+def _classify(event):
+    """(ограничивать ли, ключ для склейки повторов или None)"""
+    if isinstance(event, CallbackQuery):
+        return True, f"callback:{event.data}"
+    if isinstance(event, Message) and event.text and event.text.startswith("/"):
+        return True, f"command:{event.text}"
+    return False, None
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Склейка повторов + token bucket на пользователя и на бота; счетчики в stats()"""
+
+    def __init__(self, name=None, user_limit=THROTTLE_USER_LIMIT, user_window=THROTTLE_USER_WINDOW,
+                 global_rate=THROTTLE_GLOBAL_RATE, dedupe_window=THROTTLE_DEDUPE_WINDOW, exempt_user_ids=()):
+        self.users = RateLimiter(user_limit, user_window, name=f"{name}_users" if name else None)
+        self.everyone = None
+        if global_rate > 0:
+            self.everyone = RateLimiter(global_rate, 1, name=f"{name}_global" if name else None, slots=16, shards=1)
+        self.dedupe_window = dedupe_window
+        self.exempt_user_ids = frozenset(exempt_user_ids)
+        # (user_id, ключ) -> время первого запроса; порядок вставки = порядок времени
+        self._recent = OrderedDict()
+        self.counters = Counter()
+
+    def _seen(self, user_id, key, now):
+        """True, если такой же запрос прошел меньше dedupe_window назад"""
+        while self._recent:
+            oldest_key, seen_at = next(iter(self._recent.items()))
+            if now - seen_at < self.dedupe_window:
+                break
+            del self._recent[oldest_key]
+        return (user_id, key) in self._recent
+
+    def _remember(self, user_id, key, now):
+        # Только прошедшие ведра: повтор отброшенного запроса - не дубль, его надо обработать
+        if key is not None:
+            self._recent[(user_id, key)] = now
+
+    async def __call__(self, handler, event, data):
+        throttled, key = _classify(event)
+        if not throttled or event.from_user is None or event.from_user.id in self.exempt_user_ids:
+            return await handler(event, data)
+
+        user_id = event.from_user.id
+        now = time.monotonic()
+        if key is not None and self._seen(user_id, key, now):
+            self.counters["coalesced"] += 1
+            if isinstance(event, CallbackQuery):
+                await event.answer()  # убираем "часики" на кнопке, счет уже отправлен
+            return None
+        if not self.users.allow(str(user_id)):
+            self.counters["dropped_user"] += 1
+            return await self._reject(event)
+        if self.everyone is not None and not self.everyone.allow("all"):
+            self.counters["dropped_global"] += 1
+            return await self._reject(event)
+        self._remember(user_id, key, now)
+        self.counters["passed"] += 1
+        return await handler(event, data)
+
+    async def _reject(self, event):
+        # На кнопку ответить нужно в любом случае; сообщения отбрасываем молча
+        if isinstance(event, CallbackQuery):
+            await event.answer(SLOW_DOWN)
+        return None
+
+    @property
+    def saved_calls(self):
+        """Сколько обработчиков (и их вызовов Bot API) не понадобилось"""
+        return self.counters["coalesced"] + self.counters["dropped_user"] + self.counters["dropped_global"]
+
+    def stats(self):
+        return {
+            "passed": self.counters["passed"],
+            "coalesced": self.counters["coalesced"],
+            "dropped_user": self.counters["dropped_user"],
+            "dropped_global": self.counters["dropped_global"],
+            "saved_calls": self.saved_calls,
+        }
@@ -0,0 +1,89 @@
+"""
+Квадратные превью фото короля для Mini App.
+
+Для каждого принятого photo_id один раз считаются квадратные (center-crop)
+варианты фиксированных размеров в WebP и JPEG и кладутся в photo_cache под
+ключами вида "<photo_id>@128.webp". Ресайз идет в пуле процессов, чтобы не
+блокировать event loop бота и веб-сервера.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from photo_cache import photo_cache
+
+# 128 - плитки Hall of Fame (50px при DPR до 2.5), 480 - фото текущего короля
+THUMBNAIL_SIZES = (128, 256, 480)
+THUMBNAIL_FORMATS = ("webp", "jpeg")
+THUMBNAIL_QUALITY = 82
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+
+_pool = None
+
+
+def variant_key(photo_id, size, fmt):
+    """Ключ варианта в photo_cache"""
+    return f"{photo_id}@{size}.{fmt}"
+
+
+def render_thumbnails(data):
+    """Все варианты превью для исходных байт фото: {(size, fmt): bytes}. Выполняется в пуле процессов"""
+    largest = max(THUMBNAIL_SIZES)
+    with Image.open(BytesIO(data)) as image:
+        # JPEG можно декодировать сразу в уменьшенном масштабе - это основная экономия CPU
+        image.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        # Обрезаем по центру до квадрата, как и обещаем пользователю; меньшие размеры - из большего
+        square = ImageOps.fit(image, (largest, largest), Image.Resampling.LANCZOS)
+        variants = {}
+        for size in sorted(THUMBNAIL_SIZES, reverse=True):
+            if size != square.width:
+                square = square.resize((size, size), Image.Resampling.LANCZOS)
+            for fmt in THUMBNAIL_FORMATS:
+                out = BytesIO()
+                square.save(out, format=fmt.upper(), quality=THUMBNAIL_QUALITY)
+                variants[(size, fmt)] = out.getvalue()
+    return variants
+
+
+def store_thumbnails(photo_id, variants):
+    """Кладет посчитанные варианты в photo_cache (блокирующий дисковый I/O)"""
+    for (size, fmt), data in variants.items():
+        photo_cache.put(variant_key(photo_id, size, fmt), data)
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # Не fork: у процесса уже есть потоки (aiosqlite, модерация, сброс метрик), и дочерний
+        # процесс унаследовал бы захваченные ими блокировки и копию состояния родителя
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _pool = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _pool
+
+
+async def generate_thumbnails(photo_id, data):
+    """Считает и сохраняет все превью для photo_id, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    variants = await loop.run_in_executor(_get_pool(), render_thumbnails, data)
+    await asyncio.to_thread(store_thumbnails, photo_id, variants)
+    return variants
+
+
+def shutdown_pool():
+    """Останавливает пул процессов (при завершении бота или веб-сервера)"""
+    global _pool
+    if _pool is not None:
+        # Ждем воркеров (очередь уже отменена, досчитываются только начатые превью): после
+        # shutdown(wait=False) выход процесса может навсегда зависнуть в join воркеров
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+
+def pick_format(accept_header):
+    """WebP, если клиент его принимает, иначе JPEG"""
+    return "webp" if accept_header and "image/webp" in accept_header else "jpeg"
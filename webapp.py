@@ -1,10 +1,17 @@
 import os
-from flask import Flask, jsonify, send_from_directory, request
+import time
+import requests
+from flask import Flask, Response, g, jsonify, send_from_directory, request
 from flask_cors import CORS
 from dotenv import load_dotenv
-from database import get_game_state_sync, get_hall_of_fame_sync
+import metrics
+from database import get_versioned_state_sync, get_hall_of_fame_sync, HALL_OF_FAME_MAX_LIMIT
+from payloads import current_payload, hall_of_fame_payload, error_payload, RATE_LIMIT_ERROR
+from ratelimit import RateLimiter, client_ip
+from photo_cache import photo_cache, photo_headers, is_not_modified
+from snapshots import snapshots, pick_encoding, snapshot_headers, snapshot_body, snapshot_not_modified
+from thumbnails import THUMBNAIL_SIZES, variant_key, render_thumbnails, store_thumbnails, pick_format
 from functools import wraps
-from time import time
 
 load_dotenv()
 
@@ -13,113 +20,148 @@ CORS(app)  # Разрешаем кросс-доменные запросы дл
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
-# Simple rate limiting
-request_history = {}
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
 
-def rate_limit(max_requests=30, window=60):
-    """Rate limiter: max_requests per window seconds"""
+# Метрики всех воркеров gunicorn на /metrics любого из них
+metrics.start("web")
+REQUEST_SECONDS = metrics.histogram("web_request_seconds", "Mini App request latency", ("endpoint",))
+RESPONSES = metrics.counter("web_responses_total", "Mini App responses by status", ("endpoint", "status"))
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or "not_found"
+    REQUEST_SECONDS.observe(time.perf_counter() - g.started, endpoint)
+    RESPONSES.inc(endpoint, str(response.status_code))
+    return response
+
+# Rate limiting (один лимит на оба API-эндпоинта, общий для всех воркеров gunicorn)
+api_limiter = RateLimiter(max_requests=60, window=60, name="api")
+
+def rate_limit(limiter):
+    """Rate limiter decorator: отклоняет запрос с 429, если IP превысил лимит"""
     def decorator(f):
         @wraps(f)
         def wrapped(*args, **kwargs):
-            now = time()
-            # Clean old entries
-            for ip in list(request_history.keys()):
-                request_history[ip] = [req for req in request_history[ip] if now - req < window]
-            
-            # Check current IP
-            from flask import request
-            ip = request.remote_addr
-            if ip not in request_history:
-                request_history[ip] = []
-            
-            if len(request_history[ip]) >= max_requests:
-                return jsonify({"success": False, "error": "Rate limit exceeded. Please try again later."}), 429
-            
-            request_history[ip].append(now)
+            if not limiter.allow(client_ip(request.remote_addr, request.headers)):
+                return jsonify(RATE_LIMIT_ERROR), 429
             return f(*args, **kwargs)
         return wrapped
     return decorator
 
+def snapshot_response(snapshot):
+    """Готовые байты снимка в подходящем сжатии или 304"""
+    # Сначала 304: ему не нужен ни выбор сжатия, ни тело
+    not_modified = snapshot_not_modified(snapshot, request.headers.get('If-None-Match'))
+    if not_modified is not None:
+        return Response(status=304, headers=not_modified)
+    encoding = pick_encoding(snapshot, request.headers.get('Accept-Encoding'))
+    return Response(snapshot_body(snapshot, encoding), headers=snapshot_headers(snapshot, encoding))
+
 @app.route('/')
 def index():
     """Главная страница Mini App"""
     return send_from_directory('static', 'index.html')
 
 @app.route('/api/current', methods=['GET'])
-@rate_limit(max_requests=60, window=60)
+@rate_limit(api_limiter)
 def api_current():
     """API: Получить текущего короля и цену"""
     try:
-        import math
-        state = get_game_state_sync()
-        
-        # Вычисляем следующую цену для покупателя (предыдущая + 10% с округлением вверх)
-        last_paid_price = state['current_price']
-        next_price = math.ceil(last_paid_price * 1.1)
-        
-        return jsonify({
-            "success": True,
-            "data": {
-                "user_id": state['user_id'],
-                "user_link": state['user_link'],
-                "photo_id": state['photo_id'],
-                "text": state['text'],  # Текст пользователя (до 40 символов)
-                "simulated_price": next_price,  # Показываем цену для следующего покупателя
-                "real_payment_price": 1,  # Реальная цена для оплаты (тестовый режим)
-                "usd_estimate": round(next_price * 0.013, 2)  # 1 XTR ≈ $0.013
-            }
-        })
+        version, state = get_versioned_state_sync()
+        snapshot = snapshots.get(version, "current") or snapshots.put(version, "current", current_payload(state))
+        return snapshot_response(snapshot)
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+        return jsonify(error_payload(str(e))), 500
 
 @app.route('/api/hall-of-fame', methods=['GET'])
-@rate_limit(max_requests=60, window=60)
+@rate_limit(api_limiter)
 def api_hall_of_fame():
     """API: Получить топ-N самых дорогих покупок"""
     try:
-        limit = int(request.args.get('limit', 10))
-        hall = get_hall_of_fame_sync(limit=limit)
-        return jsonify({
-            "success": True,
-            "data": hall
-        })
+        try:
+            limit = max(1, min(int(request.args.get('limit', 10)), HALL_OF_FAME_MAX_LIMIT))
+            cursor = request.args.get('cursor')
+            # Страница Hall of Fame меняется только вместе с версией состояния
+            version = get_versioned_state_sync()[0]
+            key = ("hall", limit, cursor)
+            snapshot = snapshots.get(version, key)
+            if snapshot is None:
+                hall = get_hall_of_fame_sync(limit=limit, cursor=cursor)
+                snapshot = snapshots.put(version, key, hall_of_fame_payload(hall, limit))
+        except ValueError:
+            return jsonify(error_payload("Invalid limit or cursor")), 400
+        return snapshot_response(snapshot)
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+        return jsonify(error_payload(str(e))), 500
+
+def fetch_photo(photo_id):
+    """Скачивает фото из Telegram; None, если такого file_id нет"""
+    # Получаем file_path
+    file_url = f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}/getFile?file_id={photo_id}"
+    response = requests.get(file_url, timeout=10)
+    data = response.json()
+    
+    if not data.get('ok'):
+        return None
+    
+    file_path = data['result']['file_path']
+    photo_url = f"{TELEGRAM_API_URL}/file/bot{BOT_TOKEN}/{file_path}"
+    
+    photo_response = requests.get(photo_url, timeout=10)
+    photo_response.raise_for_status()
+    return photo_response.content
+
+def load_photo(photo_id):
+    """Фото из кэша, при промахе - из Telegram (None, если такого file_id нет)"""
+    photo = photo_cache.get(photo_id)
+    if photo is None:
+        data = fetch_photo(photo_id)
+        if data is None:
+            return None
+        photo = photo_cache.put(photo_id, data)
+    return photo
+
+def load_thumbnail(photo_id, size, fmt):
+    """Квадратное превью из кэша; при промахе считаем все варианты из оригинала"""
+    key = variant_key(photo_id, size, fmt)
+    photo = photo_cache.get(key)
+    if photo is None:
+        original = load_photo(photo_id)
+        if original is None:
+            return None
+        store_thumbnails(photo_id, render_thumbnails(original.data))
+        photo = photo_cache.get(key)
+    return photo
 
 @app.route('/api/photo/<photo_id>')
 def get_photo(photo_id):
-    """API: Прокси для получения фото напрямую из Telegram"""
-    import requests
+    """API: Фото из кэша (при промахе - прокси из Telegram), с ETag и 304; ?size= - квадратное превью"""
     try:
         # Безопасная валидация photo_id
         if not photo_id or len(photo_id) > 200:
             return "Invalid photo_id", 400
         
-        # Получаем file_path
-        file_url = f"https://api.telegram.org/bot{BOT_TOKEN}/getFile?file_id={photo_id}"
-        response = requests.get(file_url, timeout=10)
-        data = response.json()
-        
-        if not data.get('ok'):
+        size = request.args.get('size')
+        if size is None:
+            photo = load_photo(photo_id)
+        elif size.isdigit() and int(size) in THUMBNAIL_SIZES:
+            photo = load_thumbnail(photo_id, int(size), pick_format(request.headers.get('Accept')))
+        else:
+            return f"Unsupported size, use one of {THUMBNAIL_SIZES}", 400
+        if photo is None:
             return "Photo not found", 404
         
-        file_path = data['result']['file_path']
-        photo_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-        
-        # Скачиваем и возвращаем картинку напрямую
-        photo_response = requests.get(photo_url, timeout=10, stream=True)
-        photo_response.raise_for_status()
-        
-        # Возвращаем как image
-        from flask import Response
-        return Response(
-            photo_response.iter_content(chunk_size=8192),
-            mimetype='image/jpeg',
-            headers={
-                'Cache-Control': 'public, max-age=3600',
-                'Content-Type': 'image/jpeg'
-            }
-        )
+        headers = photo_headers(photo)
+        if size is not None:
+            headers['Vary'] = 'Accept'
+        if is_not_modified(photo, request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since')):
+            del headers['Content-Type']
+            return Response(status=304, headers=headers)
+        return Response(photo.data, headers=headers)
     except requests.RequestException as e:
         return f"Network error: {str(e)}", 500
     except Exception as e:
@@ -130,6 +172,13 @@ def health():
     """Проверка работоспособности сервера"""
     return jsonify({"status": "ok", "service": "THE ONE Mini App"})
 
+@app.route('/metrics')
+def metrics_view():
+    """Метрики веб-сервера в формате Prometheus"""
+    if not metrics.authorized(request.headers.get('Authorization')):
+        return Response(status=401)
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == '__main__':
     print("Flask server starting...")
     print("Mini App will be available at: http://localhost:5000")
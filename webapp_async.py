@@ -0,0 +1,335 @@
+"""
+Асинхронный сервер Mini App на aiohttp (альтернатива Flask + gunicorn).
+
+Те же эндпоинты, что и в webapp.py, но один процесс обслуживает много
+медленных запросов к Telegram одновременно: БД - общее соединение из
+database.py, HTTP - одна ClientSession с пулом соединений, фото - photo_cache.
+
+Запуск: python webapp_async.py
+"""
+import asyncio
+import os
+import time
+
+import aiohttp
+from aiohttp import web
+from dotenv import load_dotenv
+
+import metrics
+from database import open_db, close_db, init_db, get_versioned_state, get_hall_of_fame, HALL_OF_FAME_MAX_LIMIT
+from photo_cache import photo_cache, photo_headers, is_not_modified
+from snapshots import snapshots, pick_encoding, snapshot_headers, snapshot_body, snapshot_not_modified
+from thumbnails import THUMBNAIL_SIZES, variant_key, generate_thumbnails, pick_format, shutdown_pool
+from live_updates import Broadcaster, STREAM_HEARTBEAT, STREAM_MAX_CLIENTS
+from payloads import current_payload, hall_of_fame_payload, error_payload, RATE_LIMIT_ERROR
+from ratelimit import RateLimiter, client_ip
+
+load_dotenv()
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "5000"))
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+# Таймаут на каждый запрос к Telegram и размер пула соединений
+TELEGRAM_TIMEOUT = aiohttp.ClientTimeout(total=10)
+TELEGRAM_POOL_SIZE = 100
+
+# Rate limiting (один лимит на оба API-эндпоинта, как в webapp.py)
+api_limiter = RateLimiter(max_requests=60, window=60, name="api")
+
+REQUEST_SECONDS = metrics.histogram("web_request_seconds", "Mini App request latency", ("endpoint",))
+RESPONSES = metrics.counter("web_responses_total", "Mini App responses by status", ("endpoint", "status"))
+
+
+def rate_limited(handler):
+    """Отклоняет запрос с 429, если IP превысил лимит"""
+    async def wrapped(request):
+        if not api_limiter.allow(client_ip(request.remote, request.headers)):
+            return web.json_response(RATE_LIMIT_ERROR, status=429)
+        return await handler(request)
+    return wrapped
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Время и статус ответа по маршруту (для /api/stream - время жизни потока)"""
+    route = request.match_info.route.resource
+    endpoint = route.canonical if route is not None else "not_found"
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint)
+        RESPONSES.inc(endpoint, str(status))
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """Разрешаем кросс-доменные запросы для Telegram Mini App"""
+    response = await handler(request)
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
+def snapshot_response(request, snapshot):
+    """Готовые байты снимка в подходящем сжатии или 304"""
+    # Сначала 304: ему не нужен ни выбор сжатия, ни тело
+    not_modified = snapshot_not_modified(snapshot, request.headers.get("If-None-Match"))
+    if not_modified is not None:
+        return web.Response(status=304, headers=not_modified)
+    encoding = pick_encoding(snapshot, request.headers.get("Accept-Encoding"))
+    return web.Response(body=snapshot_body(snapshot, encoding), headers=snapshot_headers(snapshot, encoding))
+
+
+async def index(request):
+    """Главная страница Mini App"""
+    return web.FileResponse(os.path.join(STATIC_DIR, "index.html"))
+
+
+@rate_limited
+async def api_current(request):
+    """API: Получить текущего короля и цену"""
+    try:
+        version, state = await get_versioned_state()
+        snapshot = snapshots.get(version, "current") or snapshots.put(version, "current", current_payload(state))
+        return snapshot_response(request, snapshot)
+    except Exception as e:
+        return web.json_response(error_payload(str(e)), status=500)
+
+
+@rate_limited
+async def api_hall_of_fame(request):
+    """API: Получить топ-N самых дорогих покупок"""
+    try:
+        try:
+            limit = max(1, min(int(request.query.get('limit', 10)), HALL_OF_FAME_MAX_LIMIT))
+            cursor = request.query.get('cursor')
+            # Страница Hall of Fame меняется только вместе с версией состояния
+            version = (await get_versioned_state())[0]
+            key = ("hall", limit, cursor)
+            snapshot = snapshots.get(version, key)
+            if snapshot is None:
+                hall = await get_hall_of_fame(limit=limit, cursor=cursor)
+                snapshot = snapshots.put(version, key, hall_of_fame_payload(hall, limit))
+        except ValueError:
+            return web.json_response(error_payload("Invalid limit or cursor"), status=400)
+        return snapshot_response(request, snapshot)
+    except Exception as e:
+        return web.json_response(error_payload(str(e)), status=500)
+
+
+async def _fetch_photo(session, photo_id):
+    """Скачивает фото из Telegram; None, если такого file_id нет"""
+    # Получаем file_path
+    async with session.get(f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}/getFile", params={"file_id": photo_id}) as response:
+        data = await response.json(content_type=None)
+    if not data.get('ok'):
+        return None
+
+    file_path = data['result']['file_path']
+    async with session.get(f"{TELEGRAM_API_URL}/file/bot{BOT_TOKEN}/{file_path}") as photo_response:
+        photo_response.raise_for_status()
+        return await photo_response.read()
+
+
+async def _fetch_and_store(session, photo_id):
+    data = await _fetch_photo(session, photo_id)
+    if data is None:
+        return None
+    return await asyncio.to_thread(photo_cache.put, photo_id, data)
+
+
+async def _single_flight(app, key, factory):
+    """Одна задача на ключ для всех одновременных запросов (защита от лавины промахов)"""
+    fetches = app["photo_fetches"]
+    task = fetches.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        fetches[key] = task
+        task.add_done_callback(lambda _: fetches.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def _cached(key):
+    """Фото из памяти сразу, с диска - в потоке: чтение файла и utime не блокируют event loop"""
+    photo = photo_cache.get_memory(key)
+    if photo is not None:
+        return photo
+    return await asyncio.to_thread(photo_cache.get, key)
+
+
+async def load_photo(app, photo_id):
+    """Фото из кэша; при промахе одна загрузка из Telegram на все одновременные запросы"""
+    photo = await _cached(photo_id)
+    if photo is not None:
+        return photo
+    return await _single_flight(app, photo_id, lambda: _fetch_and_store(app["http"], photo_id))
+
+
+async def load_thumbnail(app, photo_id, size, fmt):
+    """Квадратное превью из кэша; при промахе считаем все варианты из оригинала"""
+    key = variant_key(photo_id, size, fmt)
+    photo = await _cached(key)
+    if photo is not None:
+        return photo
+
+    async def render():
+        original = await load_photo(app, photo_id)
+        if original is None:
+            return False
+        await generate_thumbnails(photo_id, original.data)
+        return True
+
+    if not await _single_flight(app, f"{photo_id}@thumbnails", render):
+        return None
+    return await _cached(key)
+
+
+async def get_photo(request):
+    """API: Фото из кэша (при промахе - прокси из Telegram), с ETag и 304; ?size= - квадратное превью"""
+    photo_id = request.match_info["photo_id"]
+    # Безопасная валидация photo_id
+    if not photo_id or len(photo_id) > 200:
+        return web.Response(text="Invalid photo_id", status=400)
+
+    size = request.query.get("size")
+    if size is not None and (not size.isdigit() or int(size) not in THUMBNAIL_SIZES):
+        return web.Response(text=f"Unsupported size, use one of {THUMBNAIL_SIZES}", status=400)
+
+    try:
+        if size is None:
+            photo = await load_photo(request.app, photo_id)
+        else:
+            photo = await load_thumbnail(request.app, photo_id, int(size), pick_format(request.headers.get("Accept")))
+    except aiohttp.ClientError as e:
+        return web.Response(text=f"Network error: {str(e)}", status=500)
+    except Exception as e:
+        return web.Response(text=f"Error: {str(e)}", status=500)
+    if photo is None:
+        return web.Response(text="Photo not found", status=404)
+
+    headers = photo_headers(photo)
+    if size is not None:
+        headers["Vary"] = "Accept"
+    if is_not_modified(photo, request.headers.get("If-None-Match"), request.headers.get("If-Modified-Since")):
+        del headers["Content-Type"]
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=photo.data, headers=headers)
+
+
+async def api_stream(request):
+    """API: Поток обновлений текущего короля (Server-Sent Events)"""
+    broadcaster = request.app["broadcaster"]
+    if broadcaster.clients >= STREAM_MAX_CLIENTS:
+        return web.json_response(error_payload("Too many live connections"), status=503)
+
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # nginx не должен буферизовать поток
+    })
+    await response.prepare(request)
+    broadcaster.clients += 1
+    streams = request.app["streams"]
+    streams.add(asyncio.current_task())
+    try:
+        # При переподключении браузер присылает последний полученный id
+        sent_version = request.headers.get("Last-Event-ID")
+        await response.write(b"retry: 5000\n\n")
+        while not broadcaster.closed:
+            changed = broadcaster.next_change()
+            if broadcaster.message is not None and str(broadcaster.version) != sent_version:
+                sent_version = str(broadcaster.version)
+                await response.write(broadcaster.message)
+                continue
+            try:
+                await asyncio.wait_for(changed.wait(), STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                await response.write(b": ping\n\n")
+    except ConnectionResetError:
+        pass  # клиент ушел
+    finally:
+        broadcaster.clients -= 1
+        streams.discard(asyncio.current_task())
+    return response
+
+
+async def metrics_view(request):
+    """Метрики веб-сервера в формате Prometheus"""
+    if not metrics.authorized(request.headers.get("Authorization")):
+        return web.Response(status=401)
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def health(request):
+    """Проверка работоспособности сервера"""
+    return web.json_response({"status": "ok", "service": "THE ONE Mini App"})
+
+
+async def on_startup(app):
+    metrics.start("web")
+    await open_db()
+    await init_db()
+    app["photo_fetches"] = {}
+    app["broadcaster"] = Broadcaster()
+    app["broadcaster"].attach()
+    app["streams"] = set()
+    app["stream_watcher"] = asyncio.create_task(app["broadcaster"].watch())
+    app["http"] = aiohttp.ClientSession(
+        timeout=TELEGRAM_TIMEOUT,
+        connector=aiohttp.TCPConnector(limit=TELEGRAM_POOL_SIZE),
+    )
+
+
+async def on_shutdown(app):
+    # Завершаем открытые SSE-потоки, иначе остановка ждала бы их таймаута
+    app["broadcaster"].close()
+
+
+async def stop_live_updates(app):
+    """Останавливает наблюдатель и оставшиеся SSE-потоки и дожидается их: до close_db,
+    иначе наблюдатель обратится к уже закрытой БД"""
+    app["broadcaster"].close()
+    app["broadcaster"].detach()
+    tasks = {app["stream_watcher"], *app["streams"]}
+    for task in tasks:
+        task.cancel()
+    await asyncio.wait(tasks)
+
+
+async def on_cleanup(app):
+    await stop_live_updates(app)
+    await app["http"].close()
+    shutdown_pool()
+    await close_db()
+
+
+def create_app():
+    """Собирает aiohttp-приложение со всеми маршрутами Mini App"""
+    app = web.Application(middlewares=[metrics_middleware, cors_middleware])
+    app.router.add_get('/', index)
+    app.router.add_get('/api/current', api_current)
+    app.router.add_get('/api/hall-of-fame', api_hall_of_fame)
+    app.router.add_get('/api/photo/{photo_id}', get_photo)
+    app.router.add_get('/api/stream', api_stream)
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics_view)
+    app.router.add_static('/static', STATIC_DIR)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    print(f"aiohttp server starting on http://{WEBAPP_HOST}:{WEBAPP_PORT}")
+    web.run_app(create_app(), host=WEBAPP_HOST, port=WEBAPP_PORT)